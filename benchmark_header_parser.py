@@ -0,0 +1,117 @@
+import argparse
+import time
+import ujson
+from email import message_from_string
+from header_map import parse_headers
+from extract_header_features import get_features_from_msg
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", "-i", nargs="+", help="parsed JSONL files (parse_emails.py output) whose raw_headers are also compared and timed", required=False)
+parser.add_argument("--count", "-n", type=int, default=1000, help="how many times each generated header block is parsed per run (default 1000)", required=False)
+parser.add_argument("--repeat", "-r", type=int, default=3, help="runs per input, the fastest is reported (default 3)", required=False)
+
+
+
+
+'''
+benchmark_header_parser.py Usage:
+
+python benchmark_header_parser.py [-i {Parsed File(s)}] [-n {Count}] [-r {Repeats}]
+    Times parse_headers (header_map.py) against email.message_from_string on generated header blocks (a typical
+    message, a long relay path, long folded headers, CRLF line endings, unix-from and malformed lines), both the parse
+    alone and parse plus all header features. Both must give the same features, every mismatch is printed.
+    -i is optional, parsed JSONL files whose raw_headers are also compared and timed
+    -n is optional, how many times each generated block is parsed per run
+    -r is optional, how many times each input is run
+
+No output file is created by this script, it is only for checking and timing the header parser
+'''
+
+TYPICAL = """Return-Path: <bounce-123@mail.example.com>
+Received: from mail.example.com (mail.example.com [203.0.113.5])
+\tby mx.example.org (Postfix) with ESMTPS id 4F2A81C0
+\tfor <user@example.org>; Mon, 6 Jan 2025 09:15:02 +0000 (UTC)
+Received: from internal.example.com ([10.0.0.12])
+\tby mail.example.com with ESMTP id abc123; Mon, 6 Jan 2025 09:15:01 +0000
+DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=s1;
+\th=from:to:subject:date:message-id; bh=47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=;
+\tb=dGhpcyBpcyBub3QgYSByZWFsIHNpZ25hdHVyZSBidXQgaXQgaXMgYXMgbG9uZyBhcyBvbmU=
+Authentication-Results: mx.example.org; spf=pass smtp.mailfrom=example.com;
+ dkim=pass header.d=example.com; dmarc=pass
+From: "Example Support" <support@example.com>
+Reply-To: support@example.com
+To: user@example.org
+Subject: =?UTF-8?B?WW91ciBhY2NvdW50IHN0YXRlbWVudA==?=
+Date: Mon, 6 Jan 2025 09:15:00 +0000
+Message-ID: <20250106091500.12345@mail.example.com>
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="b1_5f3a"
+X-Mailer: Example Mailer 2.1
+List-Unsubscribe: <mailto:unsubscribe@example.com>, <https://example.com/u?id=123>
+"""
+
+
+def generated_blocks():
+    yield "typical message", TYPICAL
+    yield "200 relay hops", "".join(f"Received: from relay{i}.example.net ([198.51.100.{i % 250}])\n\tby relay{i + 1}.example.net; Mon, 6 Jan 2025 09:15:00 +0000\n" for i in range(200)) + TYPICAL
+    yield "long folded headers", "".join(f"X-Long-{i}: " + "\n\t".join(f"token{j}=value{j};" for j in range(100)) + "\n" for i in range(5)) + TYPICAL
+    yield "crlf line endings", TYPICAL.replace("\n", "\r\n")
+    yield "unix-from, malformed", "From sender@example.com Mon Jan  6 09:15:00 2025\n\tstray continuation\n: no name\n" + TYPICAL + "From misplaced\nNot a header line\nX-After-Body: not a header\n"
+
+
+def time_both(text, repeat, count = 1):
+    map_parse = msg_parse = map_total = msg_total = float("inf")
+    for _ in range(repeat):
+        # interleaved, so both see the same machine load
+        t1 = time.perf_counter()
+        for _ in range(count):
+            headers = parse_headers(text)
+        t2 = time.perf_counter()
+        for _ in range(count):
+            map_features = get_features_from_msg(parse_headers(text), "")
+        t3 = time.perf_counter()
+        for _ in range(count):
+            msg = message_from_string(text)
+        t4 = time.perf_counter()
+        for _ in range(count):
+            msg_features = get_features_from_msg(message_from_string(text), "")
+        t5 = time.perf_counter()
+        map_parse = min(map_parse, t2 - t1)
+        map_total = min(map_total, t3 - t2)
+        msg_parse = min(msg_parse, t4 - t3)
+        msg_total = min(msg_total, t5 - t4)
+    return map_features == msg_features, len(msg), (msg_parse, map_parse, msg_total, map_total)
+
+
+def print_row(name, n_headers, same, times):
+    msg_parse, map_parse, msg_total, map_total = times
+    print(f"{name:24s} {n_headers:>8} {msg_parse * 1000:>10.1f} {map_parse * 1000:>10.1f} {msg_parse / max(map_parse, 1e-9):>7.1f}x {msg_total * 1000:>10.1f} {map_total * 1000:>10.1f} {msg_total / max(map_total, 1e-9):>7.1f}x{'' if same else '  MISMATCH'}")
+
+
+def benchmark(fnames = None, count = 1000, repeat = 3):
+    mismatches = 0
+    print(f"{'input':24s} {'headers':>8} {'msg ms':>10} {'map ms':>10} {'parse':>8} {'msg+feat':>10} {'map+feat':>10} {'total':>8}")
+    for name, text in generated_blocks():
+        same, n_headers, times = time_both(text, repeat, count)
+        mismatches += not same
+        print_row(f"{name} x{count}", n_headers, same, times)
+    for fname in fnames or []:
+        checked = n_headers = 0
+        totals = [0, 0, 0, 0]
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                same, found, times = time_both(ujson.loads(line).get("raw_headers", ""), repeat)
+                if not same:
+                    mismatches += 1
+                    print(f"MISMATCH {fname} line {checked + 1}")
+                checked += 1
+                n_headers += found
+                totals = [total + t for total, t in zip(totals, times)]
+        print_row(f"{checked} emails", n_headers, True, totals)
+    print(f"{mismatches} mismatches")
+    return mismatches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    benchmark(args.input, args.count, args.repeat)
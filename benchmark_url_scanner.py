@@ -0,0 +1,93 @@
+import argparse
+import base64
+import random
+import time
+import ujson
+from url_scanner import scan_urls, extract_urls_regex
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", "-i", nargs="+", help="parsed JSONL files (parse_emails.py output) to also compare and time on", required=False)
+parser.add_argument("--sizes", "-n", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="lengths in characters of the generated adversarial inputs (default 10000 100000 1000000)", required=False)
+parser.add_argument("--repeat", "-r", type=int, default=3, help="runs per input, the fastest is reported (default 3)", required=False)
+
+
+
+
+'''
+benchmark_url_scanner.py Usage:
+
+python benchmark_url_scanner.py [-i {Parsed File(s)}] [-n {Sizes}] [-r {Repeats}]
+    Times scan_urls (url_scanner.py) against the original three regex extract_urls on generated adversarial bodies
+    of each size: long dotted strings, www. and http:// prefixed label chains that never reach a TLD, base64 blobs,
+    long paths the protocol-less pattern has to backtrack over, and email-like tokens.
+    Both must find the same URLs, every mismatch is printed.
+    -i is optional, parsed JSONL files whose bodies are also compared and timed
+    -n is optional, the lengths of the generated inputs
+    -r is optional, how many times each input is run
+
+No output file is created by this script, it is only for checking and timing the URL scanner
+'''
+
+def adversarial_inputs(size):
+    rng = random.Random(size)
+    yield "dotted labels", "a." * (size // 2)
+    yield "dotted, no tld", "ab-c1." * (size // 6)
+    yield "www. dotted", "www." + "a." * (size // 2)
+    yield "http:// dotted, no tld", "http://" + "a1." * (size // 3)
+    yield "63 char labels", ("a" * 63 + ".") * (size // 64)
+    yield "base64 blob", base64.b64encode(rng.randbytes(size * 3 // 4)).decode()
+    yield "base64 lines", base64.encodebytes(rng.randbytes(size * 3 // 4)).decode()
+    yield "long path, no end", "see example.com/" + ",x" * (size // 2) + "<"
+    yield "email-like tokens", ("a." * 20 + "com@ ") * (size // 46)
+    yield "urls in text", ("visit www.example.com/a?b=1, or https://sub.example.org/x and docs.example.net. " * (size // 80))
+
+
+def time_both(text, repeat):
+    scan_time = regex_time = float("inf")
+    for _ in range(repeat):
+        # interleaved, so both see the same machine load
+        t1 = time.perf_counter()
+        scanned = [url for url, _, _ in scan_urls(text)]
+        t2 = time.perf_counter()
+        original = extract_urls_regex(text)
+        t3 = time.perf_counter()
+        scan_time = min(scan_time, t2 - t1)
+        regex_time = min(regex_time, t3 - t2)
+    return scanned == original, len(scanned), scan_time, regex_time
+
+
+def print_row(name, length, same, n_urls, scan_time, regex_time):
+    print(f"{name:24s} {length:>10,} {n_urls:>6} {regex_time * 1000:>10.1f} {scan_time * 1000:>10.1f} {regex_time / max(scan_time, 1e-9):>7.1f}x{'' if same else '  MISMATCH'}")
+
+
+def benchmark(fnames = None, sizes = (10_000, 100_000, 1_000_000), repeat = 3):
+    mismatches = 0
+    print(f"{'input':24s} {'chars':>10} {'urls':>6} {'regex ms':>10} {'scan ms':>10} {'speedup':>8}")
+    for size in sizes:
+        for name, text in adversarial_inputs(size):
+            same, n_urls, scan_time, regex_time = time_both(text, repeat)
+            mismatches += not same
+            print_row(name, len(text), same, n_urls, scan_time, regex_time)
+    for fname in fnames or []:
+        checked = n_urls = chars = 0
+        scan_time = regex_time = 0
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                body = ujson.loads(line)["body"]
+                same, found, t_scan, t_regex = time_both(body, repeat)
+                if not same:
+                    mismatches += 1
+                    print(f"MISMATCH {fname} line {checked + 1}")
+                checked += 1
+                n_urls += found
+                chars += len(body)
+                scan_time += t_scan
+                regex_time += t_regex
+        print_row(f"{checked} bodies", chars, True, n_urls, scan_time, regex_time)
+    print(f"{mismatches} mismatches")
+    return mismatches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    benchmark(args.input, args.sizes, args.repeat)
@@ -0,0 +1,83 @@
+import re
+from functools import cached_property
+from keyword_engine import BODY_MATCHER
+from url_scanner import extract_urls
+
+'''
+Shared, lazily computed views of an email body for the body feature extractors (extract_body_features.py and
+extract_body_features_lambda.py).
+'''
+
+SENTENCE_SPLIT = re.compile(r'[.!?]+')
+# for ascii text, str.isupper/str.isalpha are only true for these bytes
+ASCII_UPPER = bytes(range(ord('A'), ord('Z') + 1))
+ASCII_LETTERS = ASCII_UPPER + bytes(range(ord('a'), ord('z') + 1))
+
+
+class BodyView:
+    """
+    A body text plus the transforms the feature functions need, each computed on first use and then cached.
+    Reasoning: every get_*_features function lowered the body on its own (seven copies per email), and the word
+    split and the per character loops ran once per function that needed them. With one BodyView passed to all
+    of them, each transform runs at most once per email.
+    """
+    def __init__(self, text):
+        self.text = text
+
+    @cached_property
+    def lower(self):
+        return self.text.lower()
+
+    @cached_property
+    def words(self):
+        return self.text.split()
+
+    @cached_property
+    def words_lower(self):
+        # lowercasing never adds or removes whitespace, so this is [w.lower() for w in self.words]
+        return self.lower.split()
+
+    @cached_property
+    def sentences(self):
+        # stripped, non empty sentences, split on runs of . ! ?
+        return [s.strip() for s in SENTENCE_SPLIT.split(self.text) if s.strip()]
+
+    @cached_property
+    def ascii_bytes(self):
+        # the body encoded as ascii, or None if it has any other character
+        return self.text.encode('ascii') if self.text.isascii() else None
+
+    @cached_property
+    def uppercase_count(self):
+        if self.ascii_bytes is not None:
+            # counted by how many bytes deleting A-Z removes, instead of a python level call per character
+            return len(self.ascii_bytes) - len(self.ascii_bytes.translate(None, ASCII_UPPER))
+        return sum(map(str.isupper, self.text))
+
+    @cached_property
+    def letter_count(self):
+        if self.ascii_bytes is not None:
+            return len(self.ascii_bytes) - len(self.ascii_bytes.translate(None, ASCII_LETTERS))
+        return sum(map(str.isalpha, self.text))
+
+    @cached_property
+    def non_ascii_count(self):
+        # characters with ord(char) > 127, which is everything the ascii codec drops
+        if self.ascii_bytes is not None:
+            return 0
+        return len(self.text) - len(self.text.encode('ascii', 'ignore'))
+
+    @cached_property
+    def matches(self):
+        # every keyword list in one pass, see keyword_engine.py
+        return BODY_MATCHER.scan(self.lower)
+
+    @cached_property
+    def urls(self):
+        # extract_urls of the body, used for both the URL features and the URL output
+        return extract_urls(self.text)
+
+
+def get_body_view(body):
+    # feature functions accept either a plain body string or a BodyView shared between them
+    return body if isinstance(body, BodyView) else BodyView(body)
@@ -1,12 +1,24 @@
 import argparse
 import ujson
 from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 import os
+import random
+from math import sqrt
+from io_helpers import get_byte_ranges, iter_range_lines, reservoir_sample, offset_sample_lines, open_stream, is_compressed, positive_int
+from sketches import HyperLogLog, SpaceSaving, Histogram
 parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", help="The name of the file to fix", required=True)
 parser.add_argument("--pull-headers", "-p", nargs="+", help="the headers that we want to extract data from", required=False)
 parser.add_argument("--disregard", "-d", default=False, action='store_true', help="(Optional) If instead of specifying headers you WANT to inspect, this inverts it to ignore the headers you specify. Useful for when you want all but one header analyzed")
 parser.add_argument("--all-headers", "-a", action='store_true', help="(Optional) use to check all headers", required=False)
+parser.add_argument("--workers", "-w", type=int, default=1, help="(Optional) number of worker processes profiling byte ranges of the file (default 1, no pool)", required=False)
+parser.add_argument("--chunk-mb", type=positive_int, default=64, help="(Optional) size of the byte ranges the file is cut into, in MB (default 64)", required=False)
+parser.add_argument("--top-k", "-k", type=int, default=200, help="(Optional) how many of the most frequent values are kept per header (default 200). Counts are exact while a header has no more distinct values than this", required=False)
+parser.add_argument("--sample", "-s", type=int, help="(Optional) only check this many randomly sampled lines, and estimate the value distributions and missing percentages of the whole file with 95%% confidence intervals", required=False)
+parser.add_argument("--sample-method", choices=["offsets", "reservoir"], default="offsets", help="(Optional) offsets (default) reads only random small blocks of the file (at least 100, of up to 64KB), every line starting in a picked block, reservoir reads every line but only decodes a uniform sample of them", required=False)
+parser.add_argument("--seed", type=int, help="(Optional) random seed, to sample the same lines again", required=False)
 
 
 
@@ -17,56 +29,326 @@ check_dataset.py Usage:
 python check_dataset.py -i {Input File} -p {Whatever headers you want to look at}
     Optional: "-d" for "disregard" useful if you have a lot of headers, and you want to analyze most of them. Use "-p" to specify the headers you want to disregard, followed by "-d"
     ex. python check_dataset.py -i {Input File} -p {Whatever headers you want disregard} -d
+    Optional: "-a" to check every header (the default without -p), "-w" to profile with several worker processes
+    Optional: "-s {Lines}" to only check a random sample of lines, "--sample-method reservoir" for an exactly uniform sample
 
 Input file should be in the following format:
     {key1:value1, key2:value2}
     {key1:value3, key2:value4}
     {key1:value5, key2:value6}
     ...
+The file is read once, in byte ranges that can be profiled in parallel. Every header keeps a fixed size summary
+(sketches.py) instead of a count of every distinct value, so a body or email_id header does not have to fit in memory:
+the top -k values (exact counts while there are no more distinct values than that, otherwise the REPORTED_TOP most
+frequent are printed with how much their count may be over), an estimated distinct count and a histogram of numbers.
+A header missing from some lines only gets the percentage of lines without it, as before.
+With -s only that many sampled lines are decoded. The offsets method seeks to random blocks (sized for the sample to
+span at least 100 of them) and reads every line that starts in them, so a multi GB file is checked in seconds; the reservoir method reads every line but decodes only
+the sample. The check_sanity output is then followed by the estimated share of every top value and of lines missing the
+header in the whole file, with confidence intervals that take the variance across the sampled blocks (neighbouring
+lines, like those of a file sorted by label, are not independent draws).
 No output file is created by this script, it is only for sanity checking a json lines file
 '''
 
-def get_counter(fname, headers, disregard = False):
-
-    if disregard:
-        all_k_set = get_all_keys(fname)
-        headers = list(all_k_set - set(headers))
-
-
-    out_d = {h:Counter() for h in headers}
-    print(f"Checking Keys: \n{headers}\n\n")
-    with open(fname, "r") as f:
-        for i, line in enumerate(f, 1):
-            temp_d = ujson.loads(line)
-            for h in headers:
-                v = temp_d[h]
-                if isinstance(v, list):
-                    out_d[h][f"list_length_{len(v)}"] += 1
-                elif h in temp_d.keys():
-                    out_d[h][v] += 1
-            line_count = i
-        #print(f"Final Value Counts per Header: \n{out_d}")
-        for k in out_d:
-            total_count = sum(out_d[k].values())
-            check_sanity(line_count, total_count, k, out_d)
-
-def get_all_keys(fname):
-    k_set = set()
-    with open(fname, "r") as f:
-        for line in f:
-            d = ujson.loads(line)
-            k_set.update(d.keys())
-        return k_set
-
-
-
-def check_sanity(lc, tc, key, out_d):
+
+# values printed for a header with more distinct values than -k, the rest of the -k are kept to make these accurate
+REPORTED_TOP = 20
+# normal quantile of the confidence intervals of --sample, 95%
+CONFIDENCE_Z = 1.96
+# two sided 95% Student t quantiles for 1 .. 20 degrees of freedom, the CONFIDENCE_Z of a few sampled blocks
+T_QUANTILES = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+               2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086)
+
+
+class KeyProfile:
+    """
+    Summary of the values of one header. Lists are counted by length (list_length_4) and dicts by size (dict_size_2).
+    Reasoning: most headers of a feature file have a handful of values, and the top values hold all of them. The
+    HyperLogLog is only filled once a header has more distinct values than the top values can hold (and then with
+    every value held so far), until then the distinct count is exact and no value is hashed.
+    """
+    def __init__(self, k = 200):
+        self.present = 0
+        self.top = SpaceSaving(k)
+        self.distinct = None
+        self.numbers = None
+
+    def add(self, value):
+        self.present += 1
+        value = profile_value(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if self.numbers is None:
+                self.numbers = Histogram()
+            self.numbers.add(value)
+        top = self.top
+        if value in top.counts or len(top.counts) < top.k:
+            top.add(value)
+            return
+        if self.distinct is None:
+            self.fill_distinct()
+        top.add(value)
+        self.distinct.add(value_bytes(value))
+
+    def fill_distinct(self):
+        # while no value was evicted the top values are every distinct value seen
+        self.distinct = HyperLogLog()
+        for value in self.top.counts:
+            self.distinct.add(value_bytes(value))
+
+    def merge(self, other):
+        self.present += other.present
+        if self.distinct is not None or other.distinct is not None or len(self.top.counts.keys() | other.top.counts.keys()) > self.top.k:
+            for profile in (self, other):
+                if profile.distinct is None:
+                    profile.fill_distinct()
+            self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+        if other.numbers is not None:
+            if self.numbers is None:
+                self.numbers = Histogram()
+            self.numbers.merge(other.numbers)
+
+    def distinct_count(self):
+        return len(self.top.counts) if self.distinct is None else self.distinct.count()
+
+
+def profile_value(value):
+    # the value a profile counts: lists by length and dicts by size
+    if isinstance(value, list):
+        return f"list_length_{len(value)}"
+    if isinstance(value, dict):
+        return f"dict_size_{len(value)}"
+    return value
+
+
+def value_bytes(value):
+    return value.encode("utf-8", "surrogatepass") if isinstance(value, str) else repr(value).encode("utf-8")
+
+
+def profile_range(job, fname, headers = None, disregard = False, k = 200):
+    # profile_lines of the lines of one byte range of fname
+    start, end = job
+    return profile_lines(iter_range_lines(fname, start, end), headers, disregard, k)
+
+
+def profile_lines(lines, headers = None, disregard = False, k = 200):
+    """
+    (line count, {header: KeyProfile}) of JSON lines, headers in the order first seen.
+    headers None profiles every header, with disregard every header but the given ones.
+    """
+    skip = set(headers) if disregard and headers else set()
+    wanted = None if disregard or not headers else set(headers)
+    profiles = {}
+    line_count = 0
+    for line in lines:
+        line_count += 1
+        for key, value in ujson.loads(line).items():
+            profile = profiles.get(key)
+            if profile is None:
+                if key in skip or (wanted is not None and key not in wanted):
+                    continue
+                profile = profiles[key] = KeyProfile(k)
+            profile.add(value)
+    return line_count, profiles
+
+
+def get_counter(fname, headers, disregard = False, workers = 1, chunk_bytes = 64 * 1024 * 1024, k = 200):
+    """
+    Profiles fname in one pass and prints check_sanity for every header. Byte ranges are profiled by workers
+    processes and their summaries merged in file order. Returns (line count, {header: KeyProfile}).
+    """
+    jobs = get_byte_ranges(fname, chunk_bytes)
+    worker = partial(profile_range, fname=fname, headers=headers, disregard=disregard, k=k)
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.imap(worker, jobs)
+            line_count, out_d = merge_profiles(results)
+    else:
+        line_count, out_d = merge_profiles(map(worker, jobs))
+    if headers and not disregard:
+        # the requested order, headers never seen included
+        out_d = {h: out_d.get(h, KeyProfile(k)) for h in headers}
+    print(f"Checking Keys: \n{list(out_d)}\n\n")
+    for key in out_d:
+        check_sanity(line_count, key, out_d[key])
+    return line_count, out_d
+
+
+def get_sample_counter(fname, headers, disregard = False, samp_size = 10000, method = "offsets", k = 200):
+    """
+    Profiles a random sample of samp_size lines of fname and prints check_sanity and check_sample for every header.
+    Returns (sampled line count, {header: KeyProfile}).
+    """
+    if method == "offsets" and is_compressed(fname):
+        print(f"{fname} is compressed and can not be read at random offsets, sampling with reservoir instead")
+        method = "reservoir"
+    if method == "offsets":
+        blocks, total, block_count = offset_sample_lines(fname, samp_size)
+        sampled = f"~{total} lines ({method}, {len(blocks)} of {block_count} blocks)"
+    else:
+        total = 0
+        def counted(f):
+            nonlocal total
+            for total, line in enumerate(f, 1):
+                yield line
+        with open_stream(fname, "rb") as f:
+            lines = reservoir_sample(counted(f), samp_size)
+        # a uniform sample of lines, every line is a block of its own
+        blocks = [[line] for line in lines]
+        block_count = total
+        sampled = f"{total} lines ({method})"
+    line_count, out_d = profile_lines((line for block in blocks for line in block), headers, disregard, k)
+    if headers and not disregard:
+        out_d = {h: out_d.get(h, KeyProfile(k)) for h in headers}
+    sizes, block_counts = count_blocks(blocks, out_d)
+    print(f"Sampled {line_count} of {sampled}")
+    print(f"Checking Keys: \n{list(out_d)}\n\n")
+    for key in out_d:
+        check_sanity(line_count, key, out_d[key])
+        check_sample(key, out_d[key], sizes, block_counts[key], block_count)
+    return line_count, out_d
+
+
+def count_blocks(blocks, profiles):
+    """
+    (lines per block, {header: (lines without it per block, {value: count per block})}) of the sampled blocks, for
+    the REPORTED_TOP values of every profile.
+    """
+    sizes = []
+    counts = {key: ([], {value: [] for value, _, _ in profile.top.top(REPORTED_TOP)}) for key, profile in profiles.items()}
+    for block in blocks:
+        sizes.append(len(block))
+        for missing, values in counts.values():
+            missing.append(0)
+            for value_counts in values.values():
+                value_counts.append(0)
+        for line in block:
+            record = ujson.loads(line)
+            for key, (missing, values) in counts.items():
+                if key not in record:
+                    missing[-1] += 1
+                    continue
+                value_counts = values.get(profile_value(record[key]))
+                if value_counts is not None:
+                    value_counts[-1] += 1
+    return sizes, counts
+
+
+def merge_profiles(results):
+    line_count = 0
+    out_d = {}
+    for count, profiles in results:
+        line_count += count
+        for key, profile in profiles.items():
+            if key in out_d:
+                out_d[key].merge(profile)
+            else:
+                out_d[key] = profile
+    return line_count, out_d
+
+
+def wilson_interval(successes, n, z = CONFIDENCE_Z):
+    """
+    (low, high) confidence interval of the proportion successes / n of a population, from a sample of n.
+    Reasoning: the normal approximation p +- z * sqrt(p(1-p)/n) collapses to [0, 0] for a value never seen in the
+    sample and can leave [0, 1], while most interesting proportions here (a missing key, a rare label) are near 0 or 1.
+    """
+    if not n:
+        return 0.0, 1.0
+    p = successes / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def cluster_interval(counts, sizes, population, z = CONFIDENCE_Z):
+    """
+    (share, low, high) of the share of lines with a value, from a random sample of the population blocks of a file:
+    counts[i] of the sizes[i] lines of sampled block i had the value.
+    Reasoning: the lines of one block are neighbours, so n lines from m blocks carry somewhere between m and n draws
+    worth of information. The share is the ratio sum(counts) / sum(sizes) and its variance is taken across the blocks
+    (with the finite population correction), which gives the effective sample size p(1-p) / variance the Wilson
+    interval is computed on: about n when the blocks agree, about m for a file sorted by the value. A share of 0 or 1
+    has no variance to go by, it gets m. With single line blocks (a reservoir sample) this is the plain Wilson interval.
+    """
+    m = len(sizes)
+    n = sum(sizes)
+    if not n:
+        return 0.0, 0.0, 1.0
+    p = sum(counts) / n
+    if m >= population:
+        # every block was read
+        return p, p, p
+    fpc = 1 - m / population
+    variance = 0.0
+    if m > 1:
+        mean_size = n / m
+        variance = sum((c - p * size) ** 2 for c, size in zip(counts, sizes)) / (m - 1) / (m * mean_size * mean_size) * fpc
+    if variance and 0 < p < 1:
+        # blocks that happen to agree can not make the n lines worth more than n independent draws
+        effective = min(p * (1 - p) / variance, n / fpc)
+        # the variance of a few blocks is itself uncertain
+        z = t_quantile(z, m - 1)
+    elif m > 1 and 0 < p < 1:
+        # every block had the same share
+        effective = n / fpc
+    else:
+        effective = m / fpc
+    low, high = wilson_interval(p * effective, effective, z)
+    return p, low, high
+
+
+def t_quantile(z, df):
+    """
+    The Student t quantile with df degrees of freedom of the normal quantile z: exact for CONFIDENCE_Z up to
+    len(T_QUANTILES) degrees of freedom, else the Cornish-Fisher expansion.
+    Reasoning: the expansion is good to a few parts in a thousand from about 10 degrees of freedom, but far too
+    small for a handful of blocks (about 7.2 instead of 12.7 at df 1).
+    """
+    if z == CONFIDENCE_Z and df <= len(T_QUANTILES):
+        return T_QUANTILES[df - 1]
+    return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df * df)
+
+
+def percent_interval(counts, sizes, population):
+    p, low, high = cluster_interval(counts, sizes, population)
+    return f"{round(p * 100, 2)}% [{round(low * 100, 2)}%, {round(high * 100, 2)}%]"
+
+
+def short(value, limit = 80):
+    return value[:limit] + "..." if isinstance(value, str) and len(value) > limit else value
+
+
+def check_sanity(lc, key, profile):
+    tc = profile.present
     dif = lc - tc
     print(f"Total Line Count: {lc}\nTotal lines with key '{key}':{tc}")
     if dif > 0:
         print(f"% of Lines without data in '{key}': {round(float((dif / lc)*100), 2)}%")
+        return
+    if profile.top.exact():
+        print(f"Values Count for key '{key}':{Counter({short(value): count for value, count, _ in profile.top.top()})}")
     else:
-        print(f"Values Count for key '{key}':{out_d[key]}\n")
+        print(f"Distinct values for key '{key}': ~{profile.distinct_count()} (estimated)")
+        print(f"Top {REPORTED_TOP} values for key '{key}' (count, overcounted by at most): {[(short(value), count, error) for value, count, error in profile.top.top(REPORTED_TOP)]}")
+    numbers = profile.numbers
+    if numbers is not None and numbers.count:
+        print(f"Numbers in '{key}': min {numbers.min}, max {numbers.max}, mean {round(numbers.mean(), 4)}" + (f", {numbers.non_finite} inf/nan" if numbers.non_finite else ""))
+        for low, high, count in numbers.bins():
+            print(f"    {'0' if low == high == 0 else f'[{low:g}, {high:g})':>24} {count}")
+    print()
+
+
+def check_sample(key, profile, sizes, block_counts, population):
+    # the check_sanity counts of the sampled blocks (count_blocks) of a file of population blocks as estimated shares
+    if not sum(sizes):
+        return
+    missing, values = block_counts
+    print(f"Estimated shares of '{key}' in the whole file (95% confidence interval):")
+    print(f"    lines without '{key}': {percent_interval(missing, sizes, population)}")
+    for value, _, _ in profile.top.top(REPORTED_TOP):
+        print(f"    {short(value)!r}: {percent_interval(values[value], sizes, population)}")
+    print()
 
 
 
@@ -77,5 +359,11 @@ if __name__ == "__main__":
     disregard= args.disregard
     all_heads = args.all_headers
     if all_heads:
-        headers = get_all_keys(fname)
-    get_counter(fname, headers, disregard)
\ No newline at end of file
+        # every header, found while the file is read instead of in a first pass
+        headers = None
+        disregard = False
+    if args.sample:
+        random.seed(args.seed)
+        get_sample_counter(fname, headers, disregard, args.sample, args.sample_method, args.top_k)
+    else:
+        get_counter(fname, headers, disregard, args.workers, args.chunk_mb * 1024 * 1024, args.top_k)
@@ -0,0 +1,74 @@
+import argparse
+import os
+import time
+from email.parser import BytesParser
+from email import policy
+from parse_emails import html_to_text, html_to_text_bs4, safe_decode_payload
+from io_helpers import iter_email_sources, iter_files_from_dir
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", "-i", nargs="+", help="EML files, containers, or directories of EML/.html files to check", required=True)
+parser.add_argument("--show", "-n", type=int, default=5, help="how many mismatching sources to print (default 5)", required=False)
+
+
+
+
+'''
+check_html_parity.py Usage:
+
+python check_html_parity.py -i {Input File(s) or Directory}
+    -i accepts the same inputs as parse_emails.py, plus standalone .html/.htm files. Every text/html part is run
+       through both the streaming html_to_text and the BeautifulSoup html_to_text_bs4 and the outputs compared.
+    -n is optional, the number of mismatches to print in full (default 5)
+
+No output file is created by this script, it is only for sanity checking html_to_text against BeautifulSoup
+'''
+
+def iter_html_parts(fnames):
+    for og_fname, src in iter_email_sources(fnames):
+        if isinstance(src, str) and src.lower().endswith((".html", ".htm")):
+            with open(src, "r", encoding="utf-8", errors="replace") as f:
+                yield og_fname, f.read()
+            continue
+        if isinstance(src, str):
+            with open(src, "rb") as f:
+                src = f.read()
+        msg = BytesParser(policy=policy.default).parsebytes(src)
+        for part in msg.walk():
+            if part.get_content_type() == "text/html":
+                yield og_fname, safe_decode_payload(part)
+
+
+def check_parity(fnames, show = 5):
+    checked = 0
+    mismatches = 0
+    fast_time = 0
+    bs4_time = 0
+    for og_fname, html in iter_html_parts(fnames):
+        t1 = time.time()
+        fast = html_to_text(html)
+        t2 = time.time()
+        slow = html_to_text_bs4(html)
+        t3 = time.time()
+        fast_time += t2 - t1
+        bs4_time += t3 - t2
+        checked += 1
+        if fast != slow:
+            mismatches += 1
+            if mismatches <= show:
+                print(f"MISMATCH {og_fname}\n  html_to_text: {fast[:300]!r}\n  bs4:          {slow[:300]!r}\n")
+    print(f"{checked} html parts checked, {mismatches} mismatches")
+    if checked:
+        print(f"html_to_text {fast_time:.3f}s, bs4 {bs4_time:.3f}s ({bs4_time / max(fast_time, 1e-9):.1f}x)")
+    return mismatches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    fnames = []
+    for fname in args.input:
+        if os.path.isdir(fname):
+            fnames.extend(iter_files_from_dir(fname, (".eml", ".html", ".htm")))
+        else:
+            fnames.append(fname)
+    check_parity(fnames, args.show)
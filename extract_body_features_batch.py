@@ -0,0 +1,295 @@
+import argparse
+import re
+import time
+from body_view import BodyView
+from extract_body_features import get_all_features, get_url_features
+from feature_registry import BODY_FEATURES
+from keyword_engine import SECOND_PERSON
+from io_helpers import iter_records, open_writer
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", "-i", help="JSON lines or parquet file containing parsed emails (from parse_emails.py output)", required=True)
+parser.add_argument("--output", "-o", help="parquet file to write the feature table to (needs pyarrow)", required=False)
+parser.add_argument("--batch-size", "-b", type=int, default=10000, help="bodies per batch (default 10000)", required=False)
+parser.add_argument("--check", "-c", action="store_true", help="compare every row with extract_body_features.get_all_features", required=False)
+
+
+
+
+'''
+extract_body_features_batch.py Usage:
+
+python extract_body_features_batch.py -i {Parsed File} [-o {Parquet File}] [-b {Batch Size}] [-c]
+    Computes the extract_body_features.py features for a whole column of bodies at a time and prints the rows per second.
+    The parsed file can be JSON lines (also .gz/.xz/.zst) or parquet.
+    -o is optional, writes the feature table to a parquet file
+    -b is optional, how many bodies go in one batch
+    -c is optional, checks every row against get_all_features and prints the mismatches
+
+As a library, get_feature_table(bodies) takes a pyarrow string array, a pandas Series or a list of bodies and returns
+a pyarrow.Table with one column per feature, in get_all_features order and identical to it row for row.
+'''
+
+# Feature names in get_all_features order and their types, empty bodies get the defaults
+DEFAULT_FEATURES = BODY_FEATURES.defaults()
+FEATURE_NAMES = list(DEFAULT_FEATURES)
+# columns of the -o parquet file
+OUTPUT_FIELDS = [("email_id", str)] + BODY_FEATURES.schema() + [("URLs", [str])]
+FEATURE_TYPES = dict(BODY_FEATURES.schema())
+# (BODY_MATCHER group, feature) for the keyword counts and the any keyword flags
+KEYWORD_COUNTS = [('urgency', 'urgency_keyword_count'), ('authority', 'authority_keyword_count'), ('threat', 'threat_keyword_count'),
+                  ('request', 'request_keyword_count'), ('imperative', 'imperative_verb_count'), ('money', 'money_keyword_count')]
+KEYWORD_FLAGS = [('urgency', 'has_urgency'), ('authority', 'has_authority_language'), ('trusted_domains', 'claims_trusted_domain'),
+                 ('threat', 'has_threat'), ('request', 'has_request'), ('password', 'requests_password'),
+                 ('financial', 'requests_financial'), ('personal', 'requests_personal'), ('form', 'mentions_form'),
+                 ('first_person', 'uses_first_person'), ('prize', 'has_prize_language')]
+
+# RE2 (the arrow regex engine) only treats ascii as \s and \d, python treats all of unicode, so the patterns below
+# spell out python's classes. Every whitespace character is below U+3001
+WHITESPACE = ''.join(ch for ch in map(chr, range(0x3001)) if ch.isspace())
+WS_CHARS = ''.join(f'\\x{{{ord(ch):x}}}' for ch in WHITESPACE)
+WS = f'[{WS_CHARS}]'
+# what python's re.IGNORECASE matches for these letters, besides the ascii upper and lower case
+IGNORECASE_EXTRA = {'i': 'İı', 'k': 'K', 's': 'ſ'}
+
+
+def re2(pattern):
+    # a python pattern written with \s and \d, for RE2
+    return pattern.replace(r'\s', WS).replace(r'\d', r'\p{Nd}')
+
+
+def re2_ignorecase(word):
+    # word as RE2 character classes that match what re.IGNORECASE matches
+    return ''.join(f'[{ch}{ch.upper()}{IGNORECASE_EXTRA.get(ch, "")}]' for ch in word)
+
+
+# The patterns of the get_*_features functions, each list joined into one alternation, searched on the lowered body
+TIME_PRESSURE = re2('|'.join([
+    r'within\s+\d+\s+(hour|day|minute)s?',
+    r'in\s+the\s+next\s+\d+\s+(hour|day)s?',
+    r'\d+\s+(hour|day)s?\s+to\s+',
+    r'before\s+\d+[:/]\d+'
+]))
+IMPERSONATION = re2('|'.join([
+    r'(we are|this is|i am)\s+(from|with|representing)\s+',
+    r'official\s+(notice|notification|communication|email)',
+    r'on\s+behalf\s+of',
+    r'authorized\s+(representative|agent|personnel)'
+]))
+CONSEQUENCE = re2('|'.join([
+    r'(will|may|could)\s+be\s+(suspended|terminated|closed|deleted|removed)',
+    r'(lose|loss of)\s+(access|account|data|information)',
+    r'unable\s+to\s+(access|use|log in|sign in)'
+]))
+NAME_IN_GREETING = 'dear [a-z]+|hi [a-z]+|hello [a-z]+'
+# searched on the body itself
+MONEY = re2(r'[\$£€¥]\s*\d+(?:,\d{3})*(?:\.\d{2})?|\d+(?:,\d{3})*(?:\.\d{2})?\s*(?:dollars|USD|EUR|GBP)')
+LARGE_SUM = re2(r'[\$£€¥]\s*\d{1,3}(?:,\d{3})+|\d+\s*(?:' + '|'.join(map(re2_ignorecase, ['million', 'billion', 'thousand'])) + ')')
+HTML_TAG = '<[^>]+>'
+EXCESSIVE_SPACING = WS + '{4,}'
+# one match per non blank line
+NON_BLANK_LINE = f'[^{WS_CHARS}][^\\n]*'
+NON_ASCII = r'[^\x00-\x{7f}]'
+NON_WHITESPACE = f'[^{WS_CHARS}]'
+PARAGRAPH_SPLIT = re.compile(r'\n\s*\n')
+
+
+def to_texts(bodies):
+    # bodies as a list of str, nulls (None, NaN) as empty bodies
+    if pa is not None and isinstance(bodies, (pa.Array, pa.ChunkedArray)):
+        bodies = bodies.to_pylist()
+    elif hasattr(bodies, "tolist"):
+        bodies = bodies.tolist()
+    return [body if isinstance(body, str) else "" for body in bodies]
+
+
+def feature_type(name):
+    return {int: pa.int64(), float: pa.float64(), bool: pa.bool_()}[FEATURE_TYPES[name]]
+
+
+def get_feature_columns(bodies):
+    """
+    Row by row version of get_feature_table, used when pyarrow is not installed: returns a dict of feature name to a
+    list of values and the list of URL lists, from get_all_features per body.
+    """
+    columns = {name: [] for name in FEATURE_NAMES}
+    urls = []
+    for body in to_texts(bodies):
+        features, body_urls = get_all_features(body, "")
+        for name in FEATURE_NAMES:
+            columns[name].append(features[name])
+        urls.append(body_urls)
+    return columns, urls
+
+
+def get_feature_table(bodies, with_urls = False):
+    """
+    The get_all_features features of a whole column of bodies, as a pyarrow.Table with one column per feature (and a
+    list column of the extract_urls URLs with with_urls=True). Rows are identical to get_all_features.
+    Reasoning: the regex flags and counts, lengths and character ratios run as arrow compute kernels over the whole
+    column instead of a python re call per body and pattern, and the values go straight into columns, with no dict
+    per body. The lowering stays python's str.lower (arrow lowercases some characters differently). The keyword,
+    word, sentence and URL features still loop over the bodies, one keyword automaton scan per body is much faster
+    than one arrow count_substring pass per keyword. Without pyarrow this returns get_feature_columns(bodies).
+    """
+    if pa is None:
+        columns, urls = get_feature_columns(bodies)
+        if with_urls:
+            columns["URLs"] = urls
+        return columns
+    texts = to_texts(bodies)
+    try:
+        text = pa.array(texts, pa.large_string())
+    except (UnicodeEncodeError, pa.ArrowException):
+        # lone surrogates, which arrow strings cannot hold, so this batch is done row by row
+        columns, urls = get_feature_columns(texts)
+        table = pa.table([pa.array(columns[name], feature_type(name)) for name in FEATURE_NAMES], names=FEATURE_NAMES)
+        return table.append_column("URLs", pa.array(urls, pa.list_(pa.string()))) if with_urls else table
+    lower = pa.array([t.lower() for t in texts], pa.large_string())
+    lower_start = pc.utf8_slice_codeunits(lower, 0, 200)
+    # the bodies get_all_features treats as empty, python's str.strip() leaves nothing
+    empty = pc.invert(pc.match_substring_regex(text, NON_WHITESPACE))
+    columns = {}
+
+    def regex_count(array, pattern):
+        return pc.cast(pc.count_substring_regex(array, pattern), pa.int64())
+
+    # the regex flags, counts and character ratios, as kernels over the whole column
+    columns['has_time_pressure'] = pc.match_substring_regex(lower, TIME_PRESSURE)
+    exclamations = regex_count(text, "!")
+    columns['exclamation_count'] = exclamations
+    columns['excessive_exclamation'] = pc.greater_equal(exclamations, 3)
+    columns['has_impersonation_pattern'] = pc.match_substring_regex(lower, IMPERSONATION)
+    columns['has_consequence_language'] = pc.match_substring_regex(lower, CONSEQUENCE)
+    columns['has_excessive_spacing'] = pc.match_substring_regex(text, EXCESSIVE_SPACING)
+    body_length = pc.cast(pc.utf8_length(text), pa.int64())
+    columns['body_length'] = body_length
+    columns['line_count'] = regex_count(text, NON_BLANK_LINE)
+    html_tags = regex_count(text, HTML_TAG)
+    columns['has_html_tags'] = pc.greater(html_tags, 0)
+    columns['html_tag_count'] = html_tags
+    columns['has_name_in_greeting'] = pc.match_substring_regex(lower_start, NAME_IN_GREETING)
+    money_mentions = regex_count(text, MONEY)
+    columns['money_mention_count'] = money_mentions
+    columns['mentions_money'] = pc.greater(money_mentions, 0)
+    columns['mentions_large_sum'] = pc.match_substring_regex(text, LARGE_SUM)
+    # python's round, arrow rounds some halves (like 0.005) differently
+    columns['special_char_ratio'] = [round(n / max(length, 1), 3) for n, length in zip(regex_count(text, NON_ASCII).to_pylist(), body_length.to_pylist())]
+
+    # The keyword matches (one Aho-Corasick / trie regex scan beats a kernel per keyword), the word and sentence
+    # splits and the URLs are per body, through the same BodyView the row by row features use
+    rows = {name: [] for name in FEATURE_NAMES if name not in columns}
+    urls = []
+    for t in texts:
+        if not t.strip():
+            for name, values in rows.items():
+                values.append(DEFAULT_FEATURES[name])
+            urls.append([])
+            continue
+        body = BodyView(t)
+        matches = body.matches
+        words = body.words
+        word_count = len(words)
+        sentences = body.sentences
+        word_lower = body.words_lower
+        for group, name in KEYWORD_COUNTS:
+            rows[name].append(matches.count(group))
+        for group, name in KEYWORD_FLAGS:
+            rows[name].append(matches.has(group))
+        for name, value in get_url_features(body).items():
+            rows[name].append(value)
+        rows['has_generic_greeting'].append(matches.has_within("greeting", 200))
+        rows['word_count'].append(word_count)
+        rows['avg_word_length'].append(round(sum(map(len, words)) / max(word_count, 1), 2))
+        rows['sentence_count'].append(len(sentences))
+        rows['avg_sentence_length'].append(round(word_count / max(len(sentences), 1), 2))
+        # BodyView's bytes.translate counts, RE2 is slower counting one match per letter
+        rows['capitalization_ratio'].append(round(body.uppercase_count / max(body.letter_count, 1), 3))
+        rows['repeated_word_count'].append(sum(a == b for a, b in zip(word_lower, word_lower[1:])))
+        rows['has_irregular_sentences'].append(any(length < 3 or length > 50 for length in map(len, map(str.split, sentences))))
+        second_person_count = matches.count("second_person") + sum(body.lower.startswith(pronoun + ' ') for pronoun in SECOND_PERSON)
+        rows['second_person_pronoun_ratio'].append(round(second_person_count / max(word_count, 1), 3))
+        rows['first_person_plural_ratio'].append(round(matches.count("first_person_plural") / max(word_count, 1), 3))
+        rows['paragraph_count'].append(len([p for p in PARAGRAPH_SPLIT.split(t) if p.strip()]))
+        urls.append(body.urls)
+    columns.update(rows)
+
+    table_columns = []
+    for name in FEATURE_NAMES:
+        column = columns[name]
+        column = pc.cast(column, feature_type(name)) if isinstance(column, pa.Array) else pa.array(column, feature_type(name))
+        if name not in rows:
+            # empty and whitespace only bodies get get_all_features' defaults
+            column = pc.if_else(empty, pa.scalar(DEFAULT_FEATURES[name], column.type), column)
+        table_columns.append(column)
+    table = pa.table(table_columns, names=FEATURE_NAMES)
+    if with_urls:
+        table = table.append_column("URLs", pa.array(urls, pa.list_(pa.string())))
+    return table
+
+
+def get_feature_frame(bodies, with_urls = False):
+    # get_feature_table as a pandas DataFrame
+    table = get_feature_table(bodies, with_urls)
+    if isinstance(table, dict):
+        import pandas as pd
+        return pd.DataFrame(table)
+    return table.to_pandas()
+
+
+def iter_body_batches(fname, batch_size):
+    # (email_ids, bodies) of batch_size records at a time, of a JSON lines or parquet file
+    email_ids = []
+    batch = []
+    for record in iter_records(fname, ["email_id", "body"]):
+        email_ids.append(record.get("email_id"))
+        batch.append(record.get("body", ""))
+        if len(batch) == batch_size:
+            yield email_ids, batch
+            email_ids = []
+            batch = []
+    if batch:
+        yield email_ids, batch
+
+
+def check_rows(table, bodies):
+    # rows of table that differ from get_all_features, printed, returns how many
+    mismatches = 0
+    columns = table if isinstance(table, dict) else table.to_pydict()
+    for i, body in enumerate(bodies):
+        features, urls = get_all_features(body, "")
+        row = {name: columns[name][i] for name in FEATURE_NAMES}
+        if row != features or ("URLs" in columns and columns["URLs"][i] != urls):
+            mismatches += 1
+            diff = {name: (row[name], features[name]) for name in FEATURE_NAMES if row[name] != features[name]}
+            print(f"MISMATCH body {i}: {diff}")
+    return mismatches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    writer = open_writer(args.output, "parquet", OUTPUT_FIELDS) if args.output else None
+    rows = mismatches = 0
+    batch_time = 0
+    try:
+        for email_ids, bodies in iter_body_batches(args.input, args.batch_size):
+            t1 = time.time()
+            table = get_feature_table(bodies, with_urls = True)
+            batch_time += time.time() - t1
+            rows += len(bodies)
+            if args.check:
+                mismatches += check_rows(table, bodies)
+            if writer is not None:
+                # keyed like the extract_body_features.py lines, for join_features.py
+                writer.write_table(table.add_column(0, "email_id", pa.array(email_ids, pa.string())))
+    finally:
+        if writer is not None:
+            writer.close()
+    print(f"{rows} bodies in {batch_time:.2f}s ({rows / max(batch_time, 1e-9):.0f} per second)")
+    if args.check:
+        print(f"{mismatches} mismatches")
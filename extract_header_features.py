@@ -1,17 +1,21 @@
 
 import argparse
 import os
-import ujson
-from email import message_from_string
-from io_helpers import change_filename
-from email.utils import parseaddr, parsedate_tz, getaddresses
-import re
+from io_helpers import change_filename, count_lines, truncate_partial_line, open_writer, iter_records, OUTPUT_FORMATS, INDEX_KEYS
+from feature_registry import HEADER_FEATURES, COSTS, parse_feature_list
+from header_map import HeaderMap, parse_headers
+from header_analysis import parse_address, address_domain, is_private_ip, find_relay_ips, DIGIT, cache_stats
+from email.utils import parsedate_tz
 from datetime import datetime
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", help="The name of the file to get features from", required=True)
 parser.add_argument("--output", "-o", help="The name of the file to output to", required=False)
 parser.add_argument("--debug", "-d", help="debug mode", action="store_true", required=False)
+parser.add_argument("--features", type=parse_feature_list, help=f"comma separated feature groups to compute, default all: {','.join(group.name for group in HEADER_FEATURES.groups)}", required=False)
+parser.add_argument("--max-cost", choices=COSTS, help="skip the feature groups more expensive than this (see feature_registry.py)", required=False)
+parser.add_argument("--format", choices=OUTPUT_FORMATS, default="jsonl", help="feature file format, jsonl (default) or parquet (needs pyarrow). The input can be either, by its extension", required=False)
+parser.add_argument("--index", action="store_true", help="also write an {output}.idx index from the email_id and og_fname of the parsed line of every feature line to its byte offset, for lookup_email.py (jsonl only)", required=False)
 
 
 
@@ -44,11 +48,11 @@ def get_authenticity_features(msg): # adds 4 features
     
     # Domain mismatch: Compare From and Return-Path domains
     # Reasoning: This is a classic phishing indicator
-    from_addr = parseaddr(safe_header_get(msg, 'From'))[1]
+    from_addr = parse_address(safe_header_get(msg, 'From'))[1]
     return_path = safe_header_get(msg, 'Return-Path', '').strip('<>')
     
-    from_domain = from_addr.split('@')[-1].lower() if '@' in from_addr else ''
-    return_domain = return_path.split('@')[-1].lower() if '@' in return_path else ''
+    from_domain = address_domain(from_addr)
+    return_domain = address_domain(return_path)
     
     features['from_return_mismatch'] = (from_domain != return_domain) and bool(from_domain and return_domain)
     
@@ -66,14 +70,14 @@ def get_sender_features(msg): # adds 4 fatures
     
     # Parse From header: "Display Name <email@domain.com>"
     from_header = safe_header_get(msg, 'From')
-    display_name, from_email = parseaddr(from_header)
+    display_name, from_email = parse_address(from_header)
     
-    from_domain = from_email.split('@')[-1].lower() if '@' in from_email else ''
+    from_domain = address_domain(from_email)
     features['from_free_provider'] = from_domain in FREE_EMAIL_PROVIDERS
     
     # Numbers in email address (excluding domain)
     email_local = from_email.split('@')[0] if '@' in from_email else from_email
-    features['from_has_numbers'] = bool(re.search(r'\d', email_local))
+    features['from_has_numbers'] = bool(DIGIT.search(email_local))
     # NEW: Check if display name is missing/empty (suspicious for legitimate senders)
     # Reasoning: Phishing emails often have bare addresses with no display name
     features['display_name_empty'] = not bool(display_name and display_name.strip())
@@ -85,7 +89,7 @@ def get_sender_features(msg): # adds 4 fatures
     ) if display_name else False
     
     # Reply-To different from From
-    reply_to = parseaddr(safe_header_get(msg, 'Reply-To'))[1]
+    reply_to = parse_address(safe_header_get(msg, 'Reply-To'))[1]
     features['reply_to_differs'] = bool(reply_to) and (reply_to.lower() != from_email.lower())
     
     return features
@@ -219,29 +223,24 @@ def get_received_path_features(msg): # adds 4 features
     received_headers = msg.get_all('Received', [])
     features['received_count'] = len(received_headers)  # Keep the original
     
-    # Extract IPs from Received headers
+    # Extract IPs (v4 and v6) from Received headers
     # Reasoning: Each legitimate relay adds its IP; we count unique IPs
-    ip_pattern = r'\[?(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]?'
     all_ips = []
     
     for header in received_headers:
         # Convert to string in case it's a Header object
         header_str = str(header)
-        ips = re.findall(ip_pattern, header_str)
-        all_ips.extend(ips)
+        all_ips.extend(find_relay_ips(header_str))
     
     unique_ips = set(all_ips)
     features['unique_relay_ips'] = len(unique_ips)
     
     # Check if all received headers have localhost/private IPs
     # Reasoning: 127.0.0.1, 10.x.x.x, 192.168.x.x suggest internal/test systems
-    private_ip_pattern = r'^(127\.|10\.|192\.168\.|172\.(1[6-9]|2[0-9]|3[01])\.)'
+    # Classified by network (see header_analysis.PRIVATE_NETWORKS), cached per IP
     
     if all_ips:
-        private_count = sum(
-            1 for ip in all_ips if re.match(private_ip_pattern, ip)
-        )
-        features['all_private_ips'] = (private_count == len(all_ips))
+        features['all_private_ips'] = all(map(is_private_ip, all_ips))
     else:
         features['all_private_ips'] = False
     
@@ -254,47 +253,82 @@ def get_received_path_features(msg): # adds 4 features
     
     return features
 
-def get_all_features(raw_heads_string, og_fname):
+def headers_from_message(parsed_msg):
+    """
+    Builds the same HeaderMap that parse_headers(raw_headers) gives,
+    from an EmailMessage that parse_emails already parsed.
+    Reasoning: raw_items() holds the unparsed header values, so we skip a second parse of the headers.
+    BytesParser keeps non-ASCII header bytes as surrogate escapes, while raw_headers is decoded
+    as UTF-8 with replacement, so values are re-decoded the same way to keep features identical.
+    """
+    msg = HeaderMap()
+    for name, value in parsed_msg.raw_items():
+        if not value.isascii():
+            value = value.encode('ascii', 'surrogateescape').decode('utf-8', errors='replace')
+        msg.add(name, value)
+    return msg
 
+def get_all_features(raw_heads_string, og_fname, groups = None):
     try:
-        msg = message_from_string(raw_heads_string)
-
-        features = {}
-        features.update(get_authenticity_features(msg))
-        features.update(get_sender_features(msg))
-        features.update(get_structural_features(msg))
-        features.update(get_temporal_features(msg))
-        features.update(get_encoding_features(msg))
-        features.update(get_received_path_features(msg))
+        # the headers as message_from_string would parse them, without building a Message (see header_map.py)
+        msg = parse_headers(raw_heads_string)
+    except Exception as e:
+        print(f"failed data from original file: {og_fname}")
+        raise e
+    return get_features_from_msg(msg, og_fname, groups)
 
-        features.update(get_data_quality_features(msg, features))  # 4 features (NEW)
+def get_features_from_msg(msg, og_fname, groups = None):
+    # groups: the HEADER_FEATURES groups to compute (HEADER_FEATURES.select), all of them by default
 
-        return features
+    try:
+        # data_quality is passed the features computed before it, see feature_registry.py
+        return HEADER_FEATURES.run(msg, FEATURE_FUNCTIONS, groups)
 
     except Exception as e:
         print(f"failed data from original file: {og_fname}")
         raise e
     
 
+# the get_{group}_features function of every HEADER_FEATURES group
+FEATURE_FUNCTIONS = HEADER_FEATURES.functions(globals())
+
+
+def process_jlines(input, output, resume = False, groups = None, format = "jsonl", index = False):
+    # Reasoning: feature lines are 1:1 with input lines, so on resume the lines already in the
+    # output tell us how many input lines to skip
+    done = 0
+    if resume and os.path.exists(output):
+        truncate_partial_line(output)
+        done = count_lines(output)
+    with open_writer(output, format, [("email_id", str)] + HEADER_FEATURES.schema(groups), 'a' if resume else 'w', index_keys=INDEX_KEYS if index else None) as wf:
 
-def process_jlines(input, output):
-    with open(input, "r",encoding='utf-8') as f, open(output, 'w', encoding='utf-8') as wf:
+        for i, in_dict in enumerate(iter_records(input, ["raw_headers", "og_fname", "email_id"]), 1):
+            if i <= done:
+                continue
+            features = get_all_features(in_dict.get('raw_headers', ''), in_dict.get('og_fname', ''), groups)
 
-        for i, line in enumerate(f, 1):
-            in_dict = ujson.loads(line)
-            features = get_all_features(in_dict.get('raw_headers', ''), in_dict.get('og_fname', ''))
+            # keyed by the email_id of the parsed line, like the lambda's features (see extract_body_features.py)
+            row = {"email_id": in_dict.get("email_id")}
+            row.update(features)
+            wf.write(row, in_dict)
 
-            wf.write(ujson.dumps(features,ensure_ascii=False) + "\n")
 
+def print_cache_stats():
+    # hit rates of the address, domain and IP caches (see header_analysis.py), for sizing them
+    for name, stats in cache_stats().items():
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), {stats['size']}/{stats['maxsize']} entries")
 
-def header_wrapper(infile, outfile = "", debug = False):
+
+def header_wrapper(infile, outfile = "", debug = False, resume = False, groups = None, format = "jsonl", index = False):
     if not outfile:
-        outfile = change_filename(infile, "json", "features")
-    elif os.path.exists(outfile):
+        outfile = change_filename(infile, OUTPUT_FORMATS[format], "features", format == "jsonl")
+    elif os.path.exists(outfile) and not resume:
         if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
             os.remove(outfile)
     
-    process_jlines(infile, outfile)
+    process_jlines(infile, outfile, resume, groups, format, index)
+    if debug:
+        print_cache_stats()
 
     return outfile
 
@@ -303,10 +337,18 @@ if __name__ == "__main__":
     infile = args.input
     outfile = args.output
     debug = args.debug
+    if args.index and args.format == "parquet":
+        parser.error("--index needs --format jsonl, a parquet row has no byte offset")
+    try:
+        groups = HEADER_FEATURES.select(args.features, args.max_cost)
+    except ValueError as e:
+        parser.error(str(e))
     if not outfile:
-        outfile = change_filename(infile, "json", "features")
+        outfile = change_filename(infile, OUTPUT_FORMATS[args.format], "features", args.format == "jsonl")
     elif os.path.exists(outfile):
         if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
             os.remove(outfile)
     
-    process_jlines(infile, outfile)
\ No newline at end of file
+    process_jlines(infile, outfile, groups = groups, format = args.format, index = args.index)
+    if debug:
+        print_cache_stats()
\ No newline at end of file
@@ -2,8 +2,10 @@
 import argparse
 import os
 import ujson
-from email import message_from_string
 from io_helpers import change_filename
+from feature_registry import HEADER_FEATURES
+from header_map import parse_headers
+from header_analysis import parse_address, address_domain, is_private_ip, find_relay_ips, DIGIT
 from email.utils import parseaddr, parsedate_tz, getaddresses
 import re
 from datetime import datetime
@@ -37,11 +39,11 @@ def get_authenticity_features(msg): # adds 4 features
     
     # Domain mismatch: Compare From and Return-Path domains
     # Reasoning: This is a classic phishing indicator
-    from_addr = parseaddr(safe_header_get(msg, 'From'))[1]
+    from_addr = parse_address(safe_header_get(msg, 'From'))[1]
     return_path = safe_header_get(msg, 'Return-Path', '').strip('<>')
     
-    from_domain = from_addr.split('@')[-1].lower() if '@' in from_addr else ''
-    return_domain = return_path.split('@')[-1].lower() if '@' in return_path else ''
+    from_domain = address_domain(from_addr)
+    return_domain = address_domain(return_path)
     
     features['from_return_mismatch'] = (from_domain != return_domain) and bool(from_domain and return_domain)
     
@@ -59,14 +61,14 @@ def get_sender_features(msg): # adds 4 fatures
     
     # Parse From header: "Display Name <email@domain.com>"
     from_header = safe_header_get(msg, 'From')
-    display_name, from_email = parseaddr(from_header)
+    display_name, from_email = parse_address(from_header)
     
-    from_domain = from_email.split('@')[-1].lower() if '@' in from_email else ''
+    from_domain = address_domain(from_email)
     features['from_free_provider'] = from_domain in FREE_EMAIL_PROVIDERS
     
     # Numbers in email address (excluding domain)
     email_local = from_email.split('@')[0] if '@' in from_email else from_email
-    features['from_has_numbers'] = bool(re.search(r'\d', email_local))
+    features['from_has_numbers'] = bool(DIGIT.search(email_local))
     # NEW: Check if display name is missing/empty (suspicious for legitimate senders)
     # Reasoning: Phishing emails often have bare addresses with no display name
     features['display_name_empty'] = not bool(display_name and display_name.strip())
@@ -78,7 +80,7 @@ def get_sender_features(msg): # adds 4 fatures
     ) if display_name else False
     
     # Reply-To different from From
-    reply_to = parseaddr(safe_header_get(msg, 'Reply-To'))[1]
+    reply_to = parse_address(safe_header_get(msg, 'Reply-To'))[1]
     features['reply_to_differs'] = bool(reply_to) and (reply_to.lower() != from_email.lower())
     
     return features
@@ -212,29 +214,24 @@ def get_received_path_features(msg): # adds 4 features
     received_headers = msg.get_all('Received', [])
     features['received_count'] = len(received_headers)  # Keep the original
     
-    # Extract IPs from Received headers
+    # Extract IPs (v4 and v6) from Received headers
     # Reasoning: Each legitimate relay adds its IP; we count unique IPs
-    ip_pattern = r'\[?(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]?'
     all_ips = []
     
     for header in received_headers:
         # Convert to string in case it's a Header object
         header_str = str(header)
-        ips = re.findall(ip_pattern, header_str)
-        all_ips.extend(ips)
+        all_ips.extend(find_relay_ips(header_str))
     
     unique_ips = set(all_ips)
     features['unique_relay_ips'] = len(unique_ips)
     
     # Check if all received headers have localhost/private IPs
     # Reasoning: 127.0.0.1, 10.x.x.x, 192.168.x.x suggest internal/test systems
-    private_ip_pattern = r'^(127\.|10\.|192\.168\.|172\.(1[6-9]|2[0-9]|3[01])\.)'
+    # Classified by network (see header_analysis.PRIVATE_NETWORKS), cached per IP
     
     if all_ips:
-        private_count = sum(
-            1 for ip in all_ips if re.match(private_ip_pattern, ip)
-        )
-        features['all_private_ips'] = (private_count == len(all_ips))
+        features['all_private_ips'] = all(map(is_private_ip, all_ips))
     else:
         features['all_private_ips'] = False
     
@@ -247,22 +244,20 @@ def get_received_path_features(msg): # adds 4 features
     
     return features
 
-def get_header_features(parsed_eml):
+# the get_{group}_features function of every HEADER_FEATURES group
+FEATURE_FUNCTIONS = HEADER_FEATURES.functions(globals())
+
+def get_header_features(parsed_eml, groups = None):
+    # groups: the HEADER_FEATURES groups to compute (HEADER_FEATURES.select), all of them by default
     raw_heads_string = parsed_eml.get('raw_headers', '')
     og_fname = parsed_eml.get('og_fname', '')
 
     try:
-        msg = message_from_string(raw_heads_string)
+        # the headers as message_from_string would parse them, without building a Message (see header_map.py)
+        msg = parse_headers(raw_heads_string)
 
         features = {"email_id":parsed_eml["email_id"]}
-        features.update(get_authenticity_features(msg))
-        features.update(get_sender_features(msg))
-        features.update(get_structural_features(msg))
-        features.update(get_temporal_features(msg))
-        features.update(get_encoding_features(msg))
-        features.update(get_received_path_features(msg))
-
-        features.update(get_data_quality_features(msg, features))  # 4 features (NEW)
+        features.update(HEADER_FEATURES.run(msg, FEATURE_FUNCTIONS, groups))
 
         return features
 
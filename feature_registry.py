@@ -0,0 +1,165 @@
+from collections import namedtuple
+
+'''
+Declarative registry of the feature groups of the body and header feature extractors (extract_body_features.py,
+extract_header_features.py and their lambda versions).
+
+Every group declares its output columns (name, type and the default written for an empty body) and a relative cost,
+the columns are in output order. Which groups run, the empty body defaults and the output schema all come from here,
+so a subset of groups can be selected (--features urgency,money,received_path) and the expensive ones skipped
+(--max-cost). Each extractor computes group "x" with its own get_x_features function.
+'''
+
+# relative cost of a group per email, cheapest first
+COSTS = ["low", "medium", "high"]
+
+Column = namedtuple("Column", ["name", "type", "default"])
+# requires: groups whose features the function needs, they are run first (and only output if selected themselves)
+FeatureGroup = namedtuple("FeatureGroup", ["name", "columns", "cost", "requires"], defaults=[()])
+
+
+def count(name, default = 0):
+    return Column(name, int, default)
+
+
+def flag(name):
+    return Column(name, bool, False)
+
+
+def ratio(name, default = 0):
+    # the empty body default stays the int 0 get_all_features always wrote
+    return Column(name, float, default)
+
+
+class FeatureRegistry:
+    """
+    The feature groups of one extractor ("body" or "header"), in output order.
+    """
+    def __init__(self, kind, groups):
+        self.kind = kind
+        self.groups = list(groups)
+        self.by_name = {group.name: group for group in self.groups}
+
+    def find(self, name):
+        # the group called name ("urgency") or kind.name ("body.urgency"), or None
+        kind, _, group_name = name.rpartition(".")
+        if kind and kind != self.kind:
+            return None
+        return self.by_name.get(group_name)
+
+    def select(self, names = None, max_cost = None, strict = True):
+        """
+        The groups to run, in registry order: the named ones (all if names is None) no more expensive than max_cost.
+        With strict, a name that is not one of this registry's groups raises ValueError.
+        """
+        if names is None:
+            selected = set(self.by_name)
+        else:
+            selected = set()
+            for name in names:
+                group = self.find(name)
+                if group is not None:
+                    selected.add(group.name)
+                elif strict:
+                    raise ValueError(f"unknown {self.kind} feature group {name!r}, choose from: {', '.join(self.by_name)}")
+        if max_cost is not None:
+            selected = {name for name in selected if COSTS.index(self.by_name[name].cost) <= COSTS.index(max_cost)}
+        return [group for group in self.groups if group.name in selected]
+
+    def columns(self, groups = None):
+        return [column for group in (self.groups if groups is None else groups) for column in group.columns]
+
+    def defaults(self, groups = None):
+        # the features of an empty body, generated from the column defaults
+        return {column.name: column.default for column in self.columns(groups)}
+
+    def schema(self, groups = None):
+        # [(feature name, python type)] in output order
+        return [(column.name, column.type) for column in self.columns(groups)]
+
+    def functions(self, namespace):
+        """
+        {group name: get_{group name}_features} from an extractor module's namespace (its globals()).
+        A group without a function is a KeyError at import, rather than a missing column later.
+        """
+        return {group.name: namespace[f"get_{group.name}_features"] for group in self.groups}
+
+    def run(self, source, functions, groups = None):
+        """
+        Computes the groups (all by default) on source, the BodyView or HeaderMap the group functions take, and returns
+        one dict of their features in output order. Groups with requirements are also passed the features so far.
+        """
+        groups = self.groups if groups is None else groups
+        needed = {group.name for group in groups}
+        for group in groups:
+            needed.update(group.requires)
+        features = {}
+        for group in self.groups:
+            if group.name not in needed:
+                continue
+            if group.requires:
+                features.update(functions[group.name](source, features))
+            else:
+                features.update(functions[group.name](source))
+        if len(needed) > len(groups):
+            # requirements that were not selected themselves are dropped from the output
+            features = {name: features[name] for name, _ in self.schema(groups)}
+        return features
+
+
+def parse_feature_list(value):
+    # --features argument: comma separated group names
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def select_groups(registries, names = None, max_cost = None):
+    """
+    The selected groups of each registry, for a --features list that can mix body and header groups (a name like
+    "structural" selects it in both, "body.structural" only in one). Raises ValueError for a name no registry has.
+    """
+    for name in names or []:
+        if all(registry.find(name) is None for registry in registries):
+            known = [f"{registry.kind}.{group.name}" for registry in registries for group in registry.groups]
+            raise ValueError(f"unknown feature group {name!r}, choose from: {', '.join(known)}")
+    return [registry.select(names, max_cost, strict = False) for registry in registries]
+
+
+BODY_FEATURES = FeatureRegistry("body", [
+    FeatureGroup("urgency", [count('urgency_keyword_count'), flag('has_urgency'), flag('has_time_pressure'),
+                             count('exclamation_count'), flag('excessive_exclamation')], "medium"),
+    FeatureGroup("authority", [count('authority_keyword_count'), flag('has_authority_language'),
+                               flag('has_impersonation_pattern'), flag('claims_trusted_domain')], "medium"),
+    FeatureGroup("threat", [count('threat_keyword_count'), flag('has_threat'), flag('has_consequence_language')], "medium"),
+    FeatureGroup("url", [count('url_count'), flag('has_links'), ratio('link_density'), flag('has_ip_url'),
+                         flag('has_shortened_url'), flag('has_suspicious_tld'), flag('has_at_in_url'),
+                         flag('has_excessive_subdomains'), flag('has_misleading_link_text')], "high"),
+    FeatureGroup("request", [count('request_keyword_count'), flag('has_request'), flag('requests_password'),
+                             flag('requests_financial'), flag('requests_personal'), flag('mentions_form')], "low"),
+    FeatureGroup("linguistic", [count('word_count'), ratio('avg_word_length'), count('sentence_count'),
+                                ratio('avg_sentence_length'), ratio('capitalization_ratio'), count('repeated_word_count'),
+                                flag('has_excessive_spacing'), flag('has_irregular_sentences'),
+                                count('imperative_verb_count'), ratio('second_person_pronoun_ratio'),
+                                ratio('first_person_plural_ratio')], "high"),
+    FeatureGroup("structural", [count('body_length'), count('line_count'), count('paragraph_count'),
+                                flag('has_html_tags'), count('html_tag_count'), ratio('special_char_ratio')], "medium"),
+    FeatureGroup("personalization", [flag('has_generic_greeting'), flag('has_name_in_greeting'),
+                                     flag('uses_first_person')], "low"),
+    FeatureGroup("money", [count('money_mention_count'), flag('mentions_money'), flag('mentions_large_sum'),
+                           count('money_keyword_count'), flag('has_prize_language')], "medium"),
+])
+
+HEADER_FEATURES = FeatureRegistry("header", [
+    FeatureGroup("authenticity", [flag('has_dkim'), flag('has_spf'), flag('from_return_mismatch'),
+                                  flag('has_auth_results')], "low"),
+    FeatureGroup("sender", [flag('from_free_provider'), flag('from_has_numbers'), flag('display_name_empty'),
+                            flag('display_name_is_email'), flag('reply_to_differs')], "low"),
+    FeatureGroup("structural", [flag('missing_message_id'), flag('has_x_mailer'), count('content_type_complexity')], "low"),
+    FeatureGroup("temporal", [flag('sent_business_hours'), count('timezone_offset'), count('day_of_week', -1)], "low"),
+    FeatureGroup("encoding", [flag('uses_base64'), flag('uses_quoted_printable'), flag('unicode_in_from'),
+                              flag('unicode_in_subject')], "low"),
+    FeatureGroup("received_path", [count('received_count'), count('unique_relay_ips'), flag('all_private_ips'),
+                                   ratio('ip_diversity_ratio', 0.0)], "medium"),
+    # scores the structural and temporal features, so those always run before it
+    FeatureGroup("data_quality", [flag('has_valid_date'), flag('has_extreme_complexity'), flag('has_unusual_timezone'),
+                                  count('data_quality_score')], "low", requires=("structural", "temporal")),
+])
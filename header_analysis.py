@@ -0,0 +1,91 @@
+import ipaddress
+import re
+from email.utils import parseaddr
+from functools import lru_cache
+
+'''
+Address, domain and relay IP analysis for the header features (extract_header_features.py and
+extract_headers_lambda.py).
+
+Sender addresses and relay IPs repeat across millions of emails (the same mailing lists, the same relays), so every
+lookup here is cached in a bounded LRU cache. cache_stats() reports the hits and misses of each cache, to size them.
+'''
+
+# entries per cache, a cache that is full drops its least recently used entry
+ADDRESS_CACHE_SIZE = 65536
+DOMAIN_CACHE_SIZE = 65536
+IP_CACHE_SIZE = 65536
+
+# IPv4 addresses in Received headers, with or without brackets
+RELAY_IPV4 = re.compile(r'\[?(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]?')
+# IPv6 address candidates: hex groups and colons, bare or as an address literal ([IPv6:2001:db8::1]). Times like
+# 09:15:02 also match, only what ipaddress accepts is used. Addresses with an embedded IPv4 part are not matched,
+# RELAY_IPV4 already finds that part
+RELAY_IPV6 = re.compile(r'(?:(?<![\w:.])|(?<=IPv6:))[0-9a-f]*+(?::[0-9a-f]*+){2,7}+(?![\w:.])', re.IGNORECASE)
+DIGIT = re.compile(r'\d')
+
+# Networks relays inside an organization or test setup use: loopback, RFC 1918 private, RFC 6598 shared (carrier
+# grade NAT) and link local addresses, and their IPv6 counterparts (loopback, unique local and link local)
+PRIVATE_NETWORKS = {
+    4: [ipaddress.ip_network(network) for network in ['127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '100.64.0.0/10', '169.254.0.0/16']],
+    6: [ipaddress.ip_network(network) for network in ['::1/128', 'fc00::/7', 'fe80::/10']],
+}
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def parse_address(header_value):
+    # email.utils.parseaddr of a From / Reply-To value, (display name, address)
+    return parseaddr(header_value)
+
+
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def address_domain(address):
+    # the lowercased domain of an email address, '' if it has no @
+    return address.split('@')[-1].lower() if '@' in address else ''
+
+
+@lru_cache(maxsize=IP_CACHE_SIZE)
+def is_private_ip(ip):
+    """
+    True if ip (an IPv4 or IPv6 address string) is in one of the PRIVATE_NETWORKS. An IPv4 mapped IPv6 address is
+    classified by its IPv4 address. Strings ipaddress does not accept (999.1.1.1, leading zeros) are not private.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return any(address in network for network in PRIVATE_NETWORKS[address.version])
+
+
+@lru_cache(maxsize=IP_CACHE_SIZE)
+def ipv6_address(candidate):
+    # the compressed form of a RELAY_IPV6 match, or None if it is not an IPv6 address
+    try:
+        return ipaddress.IPv6Address(candidate).compressed
+    except ValueError:
+        return None
+
+
+def find_relay_ips(header):
+    # the IPv4 addresses (as written) and then the IPv6 addresses (compressed) in a Received header
+    ips = RELAY_IPV4.findall(header)
+    for candidate in RELAY_IPV6.findall(header):
+        address = ipv6_address(candidate)
+        if address is not None:
+            ips.append(address)
+    return ips
+
+
+def cache_stats():
+    """
+    {cache name: {"hits", "misses", "hit_rate", "size", "maxsize"}} for every cache of this module, since import.
+    """
+    stats = {}
+    for function in [parse_address, address_domain, is_private_ip, ipv6_address]:
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        stats[function.__name__] = {"hits": info.hits, "misses": info.misses, "hit_rate": round(info.hits / lookups, 3) if lookups else 0.0,
+                                    "size": info.currsize, "maxsize": info.maxsize}
+    return stats
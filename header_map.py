@@ -0,0 +1,90 @@
+import re
+from email.policy import compat32
+
+'''
+Fast header only parsing for the header feature extractors (extract_header_features.py and extract_headers_lambda.py).
+
+parse_headers reads a raw header block the way email.message_from_string does with the compat32 policy (same line
+splitting, end of headers, unfolding and defect handling) but only builds a HeaderMap, a multimap of lowercased
+header name to values. The feature functions read it through the same in / get / get_all calls they used on the
+Message, and get the same values.
+'''
+
+# Lines end in \r\n, \r or \n, like the feedparser splits them (str.splitlines also splits on \v, \x1c, \x85, ...),
+# so a line starts at the start of the text, after a \n, or after a \r that is not the start of a \r\n
+LINE_START = r'(?:\A|(?<=\n)|(?<=\r)(?!\n))'
+# the feedparser's headerRE: the headers end at the first line that is not a header, continuation or unix-from
+NOT_HEADER_LINE = r'(?!From |[\041-\071\073-\176]*:|[\t ])'
+FIRST_LINE_NOT_HEADER = re.compile(NOT_HEADER_LINE)
+# searched from the line ending before the line, a pattern starting at a line start is tried at every character
+HEADERS_END = re.compile(r'(?:\n|\r(?!\n))' + NOT_HEADER_LINE)
+# A header line and its continuation lines, as (name, unfolded value). Lines the feedparser skips (a unix-from or
+# misplaced "From " line, a line starting with ':', continuations with no header before them) never match, the
+# name can not contain a space or start at a ':'. The value is compat32's header_source_parse: the first line
+# without its leading spaces and tabs, the continuation lines with their line endings, no final line ending.
+HEADER = re.compile(LINE_START + r'([\041-\071\073-\176]+):[ \t]*([^\r\n]*(?:(?:\r\n|\r|\n)[ \t][^\r\n]*)*)')
+
+
+class HeaderMap:
+    """
+    Header name (lowercased) to the list of its (name, value) pairs, in message order.
+    Reasoning: a Message looks every header up with a linear scan that lowercases every name, once per msg.get.
+    Here names are lowercased once when the headers are read and each lookup is one dict get.
+    """
+    def __init__(self, items = ()):
+        self.headers = {}
+        for name, value in items:
+            self.add(name, value)
+
+    def add(self, name, value):
+        key = name.lower()
+        values = self.headers.get(key)
+        if values is None:
+            self.headers[key] = [(name, value)]
+        else:
+            values.append((name, value))
+
+    def __contains__(self, name):
+        return name.lower() in self.headers
+
+    def get(self, name, failobj = None):
+        # the first value, like Message.get
+        values = self.headers.get(name.lower())
+        if values is None:
+            return failobj
+        return fetch_value(*values[0])
+
+    def get_all(self, name, failobj = None):
+        values = self.headers.get(name.lower())
+        if values is None:
+            return failobj
+        return [fetch_value(*item) for item in values]
+
+
+def fetch_value(name, value):
+    # compat32 returns values with surrogateescaped bytes as a Header, everything else as is
+    return value if value.isascii() else compat32.header_fetch_parse(name, value)
+
+
+def parse_headers(text):
+    """
+    The headers of a raw header block (or whole message) as a HeaderMap, identical to the headers of
+    email.message_from_string(text): continuation lines are unfolded into their header, a unix-from first line, a
+    continuation before any header and a line starting with ':' are ignored, and the headers end at the first line
+    that is neither a header nor a continuation.
+    """
+    if FIRST_LINE_NOT_HEADER.match(text):
+        return HeaderMap()
+    end = HEADERS_END.search(text)
+    # the headers run to the end of the text if every line is a header or continuation
+    end = end.start() if end is not None else len(text)
+    headers = HeaderMap()
+    # HeaderMap.add inlined, a method call per header was most of the time left
+    index = headers.headers
+    for item in HEADER.findall(text, 0, end):
+        key = item[0].lower()
+        if key in index:
+            index[key].append(item)
+        else:
+            index[key] = [item]
+    return headers
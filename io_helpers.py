@@ -1,12 +1,59 @@
 import os
-from random import randint
-def change_filename(fname, ext: str, suffix = ""):
+import io
+import time
+import atexit
+import ujson
+import tarfile
+import zipfile
+import hashlib
+import gzip
+import lzma
+import mmap
+import struct
+from array import array
+from contextlib import contextmanager
+from random import randint, random, randrange, sample
+from math import exp, log, floor
+from itertools import islice
+from sketches import hash64
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# --format choices and the extension their output files get
+OUTPUT_FORMATS = {"jsonl": "json", "parquet": "parquet"}
+# rows per parquet row group, a row group is held in memory until it is written
+ROW_GROUP_SIZE = 65536
+# extensions of the compressed files open_stream reads and writes
+COMPRESSED_EXTS = (".gz", ".xz", ".zst")
+# buffer of a stream, compressed data is read and written in blocks of this size
+STREAM_BUFFER = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# the keys a JSON lines output is indexed by (--index), see OffsetIndexWriter
+INDEX_KEYS = ("email_id", "og_fname")
+# sidecar index layout: the header, the index keys as JSON padded to 8 bytes, then the entries sorted by key hash
+INDEX_MAGIC = b"JLIDX001"
+# magic, entry count, bytes of the data file indexed, byte offset of the first entry
+INDEX_HEADER = struct.Struct("<8sQQQ")
+# hash64 of the key value, byte offset of the line, its length, position of the key in the index keys
+INDEX_ENTRY = struct.Struct("<QQII")
+
+def change_filename(fname, ext: str, suffix = "", keep_compression = False):
+    # keep_compression keeps a .gz/.xz/.zst of fname, so the files made from a compressed output are compressed too
     if suffix:
         suffix = "_" + suffix
     b_name = os.path.basename(fname)
     p_path = os.path.dirname(fname)
     split_name = b_name.split(".")
     n_name = split_name[0] + suffix + "." + ext
+    if keep_compression and is_compressed(fname):
+        n_name += os.path.splitext(fname)[1]
     return os.path.join(p_path, n_name)
 
 def get_sample(big_list, samp_size):
@@ -15,11 +62,822 @@ def get_sample(big_list, samp_size):
 
     return small_list
 
+def reservoir_sample(iterable, samp_size):
+    """
+    Uniform random sample of samp_size items from an iterable of unknown length, in one pass
+    holding only the sample (Li's Algorithm L). Items come back in the order they were streamed.
+    Reasoning: get_sample needs the whole list in memory to slice from, this works directly on
+    iter_files_from_dir. It also jumps over runs of items instead of drawing a random number
+    for every one, so most of a huge stream only costs iterating past it.
+    """
+    items = enumerate(iterable)
+    reservoir = list(islice(items, samp_size))
+    if samp_size > 0 and len(reservoir) == samp_size:
+        w = exp(log(random()) / samp_size)
+        while True:
+            skip = floor(log(random()) / log(1 - w))
+            item = next(islice(items, skip, skip + 1), None)
+            if item is None:
+                break
+            reservoir[randrange(samp_size)] = item
+            w *= exp(log(random()) / samp_size)
+    reservoir.sort(key=lambda item: item[0])
+    return [value for _, value in reservoir]
+
+def iter_files_from_dir(dirname, exts = None):
+    """
+    Lazily yields the absolute path of every file under dirname, in the same order as get_all_files_from_dir.
+    exts is an optional tuple of lowercase extensions (ex. (".eml", ".msg")) to filter on.
+    Reasoning: listing tens of millions of files up front, with an extra isfile stat per entry, took
+    minutes before the first email was parsed. scandir already knows each entry's type, and paths are
+    handed out as each directory is read, so parsing starts on the first one.
+    Like os.walk, symlinked directories are not followed and unreadable directories are skipped.
+    """
+    stack = [os.path.abspath(dirname)]
+    while stack:
+        subdirs = []
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                            continue
+                        is_file = entry.is_file()
+                    except OSError:
+                        continue
+                    if is_file and (exts is None or entry.name.lower().endswith(exts)):
+                        yield entry.path
+        except OSError:
+            continue
+        # depth first, in directory order, same as os.walk
+        stack.extend(reversed(subdirs))
+
 def get_all_files_from_dir(dirname):
-    all_fnames = []
-    for root, _, files in os.walk(dirname):
-        for file in files:
-            full_path = os.path.abspath(os.path.join(root, file))
-            if os.path.isfile(full_path):
-                all_fnames.append(full_path)
-    return all_fnames
\ No newline at end of file
+    return list(iter_files_from_dir(dirname))
+
+
+MBOX_EXTS = (".mbox", ".mbx")
+TAR_EXTS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_EXTS = (".zip",)
+
+def get_container_type(fname):
+    lower_name = fname.lower()
+    if lower_name.endswith(MBOX_EXTS):
+        return "mbox"
+    if lower_name.endswith(TAR_EXTS):
+        return "tar"
+    if lower_name.endswith(ZIP_EXTS):
+        return "zip"
+    return None
+
+def is_maildir(dirname):
+    return all(os.path.isdir(os.path.join(dirname, sub)) for sub in ("cur", "new", "tmp"))
+
+def iter_maildir_files(dirname):
+    # tmp/ holds messages that are still being delivered, so only cur/ and new/ are read
+    for sub in ("cur", "new"):
+        yield from iter_files_from_dir(os.path.join(dirname, sub))
+
+def get_maildir_files(dirname):
+    return list(iter_maildir_files(dirname))
+
+def iter_mbox_messages(fname):
+    """
+    Streams an mbox file one message at a time, yielding (byte offset of the From_ line, message bytes).
+    Follows the same splitting rule as mailbox.mbox: every line starting with "From " opens a new
+    message, and the blank separator line before it is dropped. Only one message is held in memory.
+    """
+    with open(fname, "rb") as f:
+        lines = []
+        start = None
+        pos = 0
+        last_was_newline = False
+        for line in f:
+            if line.startswith(b"From "):
+                if start is not None:
+                    if last_was_newline:
+                        lines.pop()
+                    yield start, b"".join(lines)
+                lines = []
+                start = pos
+                last_was_newline = False
+            elif start is not None:
+                lines.append(line)
+                last_was_newline = line in (b"\n", b"\r\n")
+            pos += len(line)
+        if start is not None:
+            if last_was_newline:
+                lines.pop()
+            yield start, b"".join(lines)
+
+def iter_tar_members(fname):
+    # "r|*" reads the archive as a forward-only stream, so compressed tarballs never need to be seekable
+    with tarfile.open(fname, mode="r|*") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            yield member.name, tf.extractfile(member).read()
+
+def iter_zip_members(fname):
+    with zipfile.ZipFile(fname) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            yield info.filename, zf.read(info)
+
+def iter_email_sources(fnames):
+    """
+    Turns a list of input paths into (og_fname, source) pairs, where source is either a path to a
+    loose .eml file or the bytes of a message read out of an mbox/tar/zip container.
+    Reasoning: containers are streamed member by member instead of being exploded onto disk first.
+    og_fname is "{container name}:{member name}" for tar/zip and "{container name}:{byte offset}" for mbox.
+    """
+    for og_fname, source, _ in iter_source_members(fnames):
+        yield og_fname, source
+
+def iter_source_members(fnames):
+    """
+    iter_email_sources as (og_fname, source, container) triples, container being None for a loose file and
+    (absolute container path, member name or byte offset, container size, container mtime) for a message read out
+    of a container, for its manifest entry (get_source_entry). The container is stat'ed once, not per message.
+    """
+    for fname in fnames:
+        container = get_container_type(fname)
+        base_name = os.path.basename(fname)
+        if container is None:
+            yield base_name, fname, None
+            continue
+        path = os.path.abspath(fname)
+        st = os.stat(path)
+        if container == "mbox":
+            members = iter_mbox_messages(fname)
+        elif container == "tar":
+            members = iter_tar_members(fname)
+        else:
+            members = iter_zip_members(fname)
+        for member, raw in members:
+            yield f"{base_name}:{member}", raw, (path, member, st.st_size, st.st_mtime)
+
+
+def get_blob_path(store_dir, content_hash):
+    # Sharded by hash prefix (ab/cd/abcd...) so no single directory ends up with millions of entries
+    return os.path.join(store_dir, content_hash[:2], content_hash[2:4], content_hash)
+
+def store_blob(store_dir, content_hash, data):
+    """
+    Writes data into the content addressed store under its sha256 hash and returns the blob path.
+    Reasoning: the same attachment shows up across thousands of emails in a campaign, so a blob that
+    already exists is not written again. New blobs go to a temp file first and are renamed into place,
+    which keeps concurrent parser processes from ever seeing a partially written blob.
+    """
+    blob_path = get_blob_path(store_dir, content_hash)
+    if os.path.exists(blob_path):
+        return blob_path
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, blob_path)
+    return blob_path
+
+def read_blob(store_dir, content_hash):
+    with open(get_blob_path(store_dir, content_hash), "rb") as f:
+        return f.read()
+
+
+def is_compressed(fname):
+    return fname.endswith(COMPRESSED_EXTS)
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError(".zst files need zstandard (pip install zstandard)")
+
+def open_stream(fname, mode = "r", encoding = "utf-8", newline = None):
+    """
+    open() for the files the stages read and write: a .gz, .xz or .zst file is decompressed or compressed as it is
+    streamed, any other file is opened as is. mode is "r", "w" or "a", with "b" for bytes. Every file is read and
+    written through a STREAM_BUFFER buffer.
+    Reasoning: parsed files (bodies, base64 attachments) compress 5-10x and storage bandwidth is the bottleneck.
+    zstd compresses with a thread per core (threads=-1), so a stage writing a .zst file does not wait on compression.
+    Appending adds a gzip member, xz stream or zstd frame, and reading goes across all of them.
+    """
+    binary = "b" in mode
+    base = mode.replace("b", "").replace("t", "")
+    if not is_compressed(fname):
+        if binary:
+            return open(fname, mode, buffering=STREAM_BUFFER)
+        return open(fname, mode, buffering=STREAM_BUFFER, encoding=encoding, newline=newline)
+    if fname.endswith(".gz"):
+        stream = gzip.open(fname, base + "b", compresslevel=GZIP_LEVEL)
+    elif fname.endswith(".xz"):
+        stream = lzma.open(fname, base + "b")
+    else:
+        require_zstandard()
+        raw = open(fname, base + "b")
+        if base == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).stream_writer(raw, write_return_read=True, closefd=True)
+    stream = io.BufferedReader(stream, STREAM_BUFFER) if base == "r" else io.BufferedWriter(stream, STREAM_BUFFER)
+    return stream if binary else io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+
+class JsonlWriter:
+    """
+    Holds a single handle on a JSON lines file and batches encoded lines into large writes.
+    Reasoning: opening, appending and closing the file per record is a syscall storm on
+    network storage. Pending lines are flushed once buffer_size characters are queued or
+    flush_interval seconds have passed since the last flush, and always on close(); either
+    threshold can be set to None to disable it. on_flush is called after every flush, which
+    lets a companion file (like a Manifest) be flushed strictly after this one.
+    Use it as a context manager so the buffer is flushed on errors as well; anything still
+    pending when the interpreter exits is flushed by an atexit hook.
+    A .gz, .xz or .zst file is written compressed (open_stream), it can not be indexed.
+    """
+    def __init__(self, fname, mode = "a", buffer_size = 4 * 1024 * 1024, flush_interval = 5.0, on_flush = None, index_keys = None):
+        self.fname = fname
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        if index_keys and is_compressed(fname):
+            raise ValueError(f"{fname} is compressed, only uncompressed files can be indexed")
+        self._f = open_stream(fname, mode)
+        # with index_keys, the lines written through write() are indexed in a sidecar written on close()
+        self.index = OffsetIndexWriter(fname, index_keys, os.path.getsize(fname)) if index_keys else None
+        self._buf = []
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def write(self, out_d, index_record = None):
+        # index_record holds the index keys of a line that does not carry them itself (a feature line and its email)
+        line = ujson.dumps(out_d, ensure_ascii=False)
+        if self.index is not None:
+            self.index.add(out_d if index_record is None else index_record, (len(line) if line.isascii() else len(line.encode("utf-8"))) + 1)
+        self.write_line(line)
+
+    def write_line(self, line):
+        self._buf.append(line + "\n")
+        self._pending += len(line) + 1
+        if self.buffer_size is not None and self._pending >= self.buffer_size:
+            self.flush()
+        elif self.flush_interval is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self._f.write("".join(self._buf))
+            self._buf = []
+            self._pending = 0
+        self._f.flush()
+        self._last_flush = time.monotonic()
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        try:
+            self.flush()
+            if self.index is not None:
+                self.index.write()
+        finally:
+            self._f.close()
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("parquet files need pyarrow (pip install pyarrow)")
+
+
+def arrow_type(spec):
+    """
+    Arrow type of a field spec: a python type (str, int, float, bool), "category" for a dictionary encoded string,
+    [spec] for a list of spec and {name: spec} for a struct.
+    """
+    if isinstance(spec, list):
+        return pa.list_(arrow_type(spec[0]))
+    if isinstance(spec, dict):
+        return pa.struct([(name, arrow_type(field_spec)) for name, field_spec in spec.items()])
+    if spec == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    return {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}[spec]
+
+
+def arrow_schema(fields):
+    # pyarrow schema of [(name, spec)] fields, like the schema() of a feature registry
+    require_pyarrow()
+    return pa.schema([(name, arrow_type(spec)) for name, spec in fields])
+
+
+class ParquetWriter:
+    """
+    JsonlWriter counterpart for --format parquet: write takes the same dicts, which go into a parquet file with a
+    fixed schema ([(name, spec)] fields, see arrow_type) in row groups of row_group_size rows.
+    Reasoning: typed, compressed columns that load a column at a time, instead of a JSON parse per row and
+    booleans that become strings in a CSV. "category" fields (header_list, label) are dictionary encoded, every
+    value is stored once per row group. A key missing from a row is null, keys that are not in the schema are
+    dropped. on_flush is called after every row group. write_table takes a pyarrow Table of a columnar batch instead
+    (extract_body_features_batch.py), small batches are gathered into row groups of the same size.
+    A parquet file can not be appended to, and can only be read once close() has written its footer.
+    """
+    def __init__(self, fname, fields, row_group_size = ROW_GROUP_SIZE, on_flush = None):
+        self.fname = fname
+        self.schema = arrow_schema(fields)
+        self.row_group_size = row_group_size
+        self.on_flush = on_flush
+        dictionary_columns = [name for name, spec in fields if spec == "category"]
+        self._writer = pq.ParquetWriter(fname, self.schema, compression="zstd", use_dictionary=dictionary_columns or False)
+        self._rows = []
+        self._tables = []
+        self._table_rows = 0
+        atexit.register(self.close)
+
+    def write(self, out_d, index_record = None):
+        # index_record is only there for the same write calls as JsonlWriter, a parquet file is not indexed
+        self._rows.append(out_d)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def write_table(self, table):
+        # a whole pyarrow Table (a columnar batch) at once, cast to the schema, batches are gathered into row groups
+        if self._rows:
+            self.flush()
+        self._tables.append(table.select(self.schema.names).cast(self.schema))
+        self._table_rows += table.num_rows
+        if self._table_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._writer.write_table(pa.Table.from_pylist(self._rows, schema=self.schema), row_group_size=self.row_group_size)
+            self._rows = []
+        if self._tables:
+            self._writer.write_table(pa.concat_tables(self._tables), row_group_size=self.row_group_size)
+            self._tables = []
+            self._table_rows = 0
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._writer.close()
+            self._writer = None
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_writer(fname, format = "jsonl", fields = None, mode = "w", on_flush = None, row_group_size = ROW_GROUP_SIZE, index_keys = None, buffer_size = 4 * 1024 * 1024, flush_interval = 5.0):
+    # the writer of an output file in --format format, fields is the schema of a parquet file
+    # buffer_size and flush_interval are the JsonlWriter ones, None for both only flushes on flush()
+    if format == "parquet":
+        if index_keys:
+            raise ValueError("only JSON lines files can be indexed, a parquet row has no byte offset")
+        return ParquetWriter(fname, fields, row_group_size, on_flush)
+    return JsonlWriter(fname, mode, buffer_size, flush_interval, on_flush, index_keys)
+
+
+def is_parquet(fname):
+    return fname.endswith(".parquet")
+
+
+def iter_records(fname, columns = None):
+    """
+    Yields the records of a JSON lines or parquet (.parquet) file as dicts.
+    With parquet only the given columns are read (all by default), and null values are left out of the dicts (also
+    the nested ones, like attachments), as the keys parse_emails.py only writes to some lines are.
+    """
+    if not is_parquet(fname):
+        with open_stream(fname) as f:
+            for line in f:
+                yield ujson.loads(line)
+        return
+    require_pyarrow()
+    for batch in pq.ParquetFile(fname).iter_batches(columns=columns):
+        for row in batch.to_pylist():
+            yield drop_nulls(row)
+
+
+def drop_nulls(value):
+    if isinstance(value, dict):
+        return {key: drop_nulls(item) for key, item in value.items() if item is not None}
+    if isinstance(value, list):
+        return [drop_nulls(item) for item in value]
+    return value
+
+
+def count_lines(fname):
+    count = 0
+    with open_stream(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            count += chunk.count(b"\n")
+    return count
+
+def truncate_partial_line(fname):
+    """
+    Cuts a JSON lines file back to its last complete line.
+    Reasoning: a run that was killed mid-write can leave half a record at the end of the file,
+    which would corrupt the next line appended when the run is resumed.
+    """
+    if not os.path.exists(fname):
+        return
+    if is_compressed(fname):
+        raise ValueError(f"{fname} is compressed, a compressed output can not be resumed")
+    with open(fname, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(64 * 1024, pos)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                pos = pos - step + newline + 1
+                break
+            pos -= step
+        if pos != end:
+            f.truncate(pos)
+
+def positive_int(value):
+    # argparse type of sizes like --chunk-mb, 0 would cut a file into empty ranges forever
+    number = int(value)
+    if number <= 0:
+        raise ValueError(f"{value} is not a positive integer")
+    return number
+
+def get_byte_ranges(fname, chunk_bytes):
+    # (start, end) byte ranges of about chunk_bytes covering fname, at least one
+    size = os.path.getsize(fname)
+    if is_compressed(fname):
+        # a compressed stream can only be read from its start, so it is a single range
+        return [(0, size)]
+    starts = list(range(0, size, chunk_bytes)) or [0]
+    return [(start, min(start + chunk_bytes, size)) for start in starts]
+
+def iter_range_lines(fname, start, end):
+    """
+    Yields the lines (as bytes) of fname that start at a byte offset in [start, end).
+    Reasoning: a file is cut into byte ranges without looking at its content, so a line that crosses a range start
+    belongs to the range before it. Every line is read by exactly one of the get_byte_ranges ranges.
+    A compressed file is its only range, all of its lines are yielded.
+    """
+    if is_compressed(fname):
+        with open_stream(fname, "rb") as f:
+            yield from f
+        return
+    # a large buffer, with the 8k default readline copies a long line (an inlined attachment) chunk by chunk
+    with open(fname, "rb", buffering=1024 * 1024) as f:
+        if start:
+            # the rest of the line that crosses start, or an empty read if a line starts exactly at start
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+# blocks a --sample is spread over at least, blocks of offset_sample_lines are sized for it within these bounds
+SAMPLE_BLOCKS = 100
+SAMPLE_BLOCK_BYTES = (1024, 64 * 1024)
+# blocks read to estimate the mean line length the blocks are sized from
+PILOT_BLOCKS = 10
+
+def read_block_lines(f, start, end):
+    # the lines of an open binary file that start in [start, end), as in iter_range_lines
+    if start:
+        f.seek(start - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    pos = f.tell()
+    lines = []
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        lines.append(line)
+    return lines
+
+def random_order(n):
+    # 0 .. n-1 in random order, drawn lazily: a sample usually needs a few hundred of millions of blocks
+    if n <= 65536:
+        yield from sample(range(n), n)
+        return
+    seen = set()
+    while len(seen) < n:
+        i = randrange(n)
+        if i not in seen:
+            seen.add(i)
+            yield i
+
+def offset_sample_lines(fname, samp_size, block_bytes = None, min_blocks = SAMPLE_BLOCKS):
+    """
+    At least samp_size lines (as bytes, every line if the file has fewer) of fname read at random byte offsets.
+    Returns ([lines of each picked block] in file order, estimated line count of fname, number of blocks in fname).
+    The file is cut into get_byte_ranges blocks of block_bytes, blocks are picked at random and all lines that start
+    in a picked block are read (as in iter_range_lines), until samp_size lines and min_blocks blocks were read.
+    By default block_bytes is sized so that samp_size lines take min_blocks blocks, from the mean line length of a
+    few random pilot blocks (within SAMPLE_BLOCK_BYTES).
+    Reasoning: reservoir_sample still reads every line, here only the picked blocks are read. Every line starts in
+    exactly one block, so every line has the same chance of being sampled whatever its length, which is not true of
+    taking the line at (or after) a random offset: long lines, or the lines after them, would be picked more often.
+    The lines of a block are neighbours, not independent draws (a file sorted by label has blocks of one label), so
+    an estimate from them has to take its variance across the blocks, which is why they are returned per block, and
+    why the sample is spread over many small blocks rather than a couple of big ones.
+    """
+    if is_compressed(fname):
+        raise ValueError(f"{fname} is compressed and can not be read at an offset, use reservoir_sample")
+    with open(fname, "rb") as f:
+        if block_bytes is None:
+            pilot = get_byte_ranges(fname, SAMPLE_BLOCK_BYTES[1])
+            read_bytes = read_lines = 0
+            for index in sample(range(len(pilot)), min(PILOT_BLOCKS, len(pilot))):
+                lines = read_block_lines(f, *pilot[index])
+                read_bytes += sum(map(len, lines))
+                read_lines += len(lines)
+            mean_line = read_bytes / read_lines if read_lines else SAMPLE_BLOCK_BYTES[1]
+            block_bytes = int(min(max(samp_size * mean_line / min_blocks, SAMPLE_BLOCK_BYTES[0]), SAMPLE_BLOCK_BYTES[1]))
+        blocks = get_byte_ranges(fname, block_bytes)
+        picked = []
+        count = 0
+        for index in random_order(len(blocks)):
+            start, end = blocks[index]
+            lines = read_block_lines(f, start, end)
+            picked.append((start, lines))
+            count += len(lines)
+            if count >= samp_size and len(picked) >= min_blocks:
+                break
+    estimate = round(count * len(blocks) / len(picked))
+    picked.sort(key=lambda block: block[0])
+    return [lines for _, lines in picked], estimate, len(blocks)
+
+def index_fname(fname):
+    return fname + ".idx"
+
+class OffsetIndexWriter:
+    """
+    Collects the byte offset and length of every line of a JSON lines file under the hash64 of its keys values
+    (INDEX_KEYS by default, a line missing a key is not indexed by it) and writes them sorted to the fname.idx
+    sidecar read by OffsetIndex.
+    start is the size of the file when it is appended to: the entries the existing sidecar has for those lines are
+    kept, and lines it does not have (written by a run killed before its index was written) are read back, which
+    only recovers the lines that carry their keys.
+    Reasoning: the entries are held in arrays, 24 bytes per key instead of a tuple of python ints.
+    """
+    def __init__(self, fname, keys = INDEX_KEYS, start = 0):
+        self.fname = fname
+        self.keys = tuple(keys)
+        self.hashes = array("Q")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.fields = array("I")
+        self.offset = 0
+        if start:
+            self.catch_up(start)
+        elif os.path.exists(index_fname(fname)):
+            os.remove(index_fname(fname))
+
+    def catch_up(self, start):
+        covered = 0
+        if os.path.exists(index_fname(self.fname)):
+            with OffsetIndex(self.fname) as old:
+                if old.keys == self.keys:
+                    for key_hash, offset, length, field in old.entries():
+                        if offset + length <= start:
+                            self.append(key_hash, offset, length, field)
+                    covered = min(old.covered, start)
+        self.offset = covered
+        for line in iter_range_lines(self.fname, covered, start):
+            self.add(ujson.loads(line), len(line))
+
+    def append(self, key_hash, offset, length, field):
+        self.hashes.append(key_hash)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.fields.append(field)
+
+    def add(self, record, length):
+        # indexes the next line of the file, record decoded and length in bytes with its newline
+        for field, key in enumerate(self.keys):
+            value = record.get(key)
+            if value is not None:
+                self.append(hash64(str(value).encode("utf-8", "surrogatepass")), self.offset, length, field)
+        self.offset += length
+
+    def write(self):
+        # sorted by hash, lines with the same hash stay in file order
+        order = sorted(range(len(self.hashes)), key=self.hashes.__getitem__)
+        keys = ujson.dumps(self.keys).encode("utf-8")
+        first = (INDEX_HEADER.size + len(keys) + 7) // 8 * 8
+        tmp_fname = index_fname(self.fname) + ".tmp"
+        with open(tmp_fname, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(order), self.offset, first))
+            f.write(keys.ljust(first - INDEX_HEADER.size))
+            for i in range(0, len(order), 65536):
+                f.write(b"".join(INDEX_ENTRY.pack(self.hashes[j], self.offsets[j], self.lengths[j], self.fields[j]) for j in order[i:i + 65536]))
+        # a reader never sees half an index
+        os.replace(tmp_fname, index_fname(self.fname))
+
+class OffsetIndex:
+    """
+    Looks records of a JSON lines file up by the value of one of its index keys (an email_id or og_fname), through
+    the fname.idx sidecar written by OffsetIndexWriter or build_index.
+    Reasoning: the sidecar is memory mapped and binary searched, so opening it reads nothing and a lookup touches
+    O(log n) entries and then only the matching lines of the data file, however many GB the file is.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(index_fname(fname), "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.covered, self._first = INDEX_HEADER.unpack_from(self._map)
+        if magic != INDEX_MAGIC:
+            self._map.close()
+            raise ValueError(f"{index_fname(fname)} is not an index")
+        self.keys = tuple(ujson.loads(self._map[INDEX_HEADER.size:self._first]))
+        self._data = None
+
+    def entry(self, i):
+        # (key hash, offset, length, key position) of the i-th entry in hash order
+        return INDEX_ENTRY.unpack_from(self._map, self._first + i * INDEX_ENTRY.size)
+
+    def entries(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def find(self, value):
+        # (offset, length, key position) of the entries under the hash of value, in file order
+        key_hash = hash64(str(value).encode("utf-8", "surrogatepass"))
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < self.count:
+            entry = self.entry(low)
+            if entry[0] != key_hash:
+                break
+            found.append(entry[1:])
+            low += 1
+        return found
+
+    def lookup(self, value, key = None):
+        """
+        The records whose key (any of the index keys by default) is value, in file order. Entries of another value
+        with the same hash are dropped once their line is read, a line indexed under keys it does not carry itself
+        (a feature line, indexed by its email) is trusted to the 64 bit hash.
+        """
+        if self._data is None:
+            self._data = open(self.fname, "rb")
+        records = []
+        seen = set()
+        for offset, length, field in self.find(value):
+            name = self.keys[field]
+            if (key is not None and name != key) or offset in seen:
+                continue
+            self._data.seek(offset)
+            record = ujson.loads(self._data.read(length))
+            if name not in record or str(record[name]) == str(value):
+                records.append(record)
+                seen.add(offset)
+        return records
+
+    def close(self):
+        self._map.close()
+        if self._data is not None:
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def build_index(fname, keys = INDEX_KEYS):
+    # writes the sidecar index of an existing JSON lines file in one pass, and returns its name
+    if is_compressed(fname):
+        raise ValueError(f"{fname} is compressed, only uncompressed files can be indexed")
+    index = OffsetIndexWriter(fname, keys)
+    with open(fname, "rb", buffering=1024 * 1024) as f:
+        for line in f:
+            index.add(ujson.loads(line), len(line))
+    index.write()
+    return index_fname(fname)
+
+def get_source_entry(og_fname, src, container = None):
+    """
+    Manifest entry for a parse_emails source: a loose file path, or message bytes read out of a container.
+    A message is keyed by the absolute path of its container and its member name or offset (og_fname only has the
+    container's file name, so box.mbox of two directories would collide), and records the container's size and
+    mtime, so a container edited in place is parsed again.
+    """
+    if isinstance(src, bytes):
+        if container is None:
+            return {"source": og_fname, "size": len(src)}
+        path, member, container_size, container_mtime = container
+        return {"source": f"{path}:{member}", "size": len(src), "container_size": container_size, "container_mtime": container_mtime}
+    st = os.stat(src)
+    return {"source": os.path.abspath(src), "size": st.st_size, "mtime": st.st_mtime}
+
+@contextmanager
+def map_source(src):
+    """
+    Yields the bytes of a parse source: bytes are passed through, and a file path is memory mapped
+    read-only instead of read.
+    Reasoning: f.read() on a 200MB message puts all of it on the heap before parsing even starts.
+    A mapping is paged in by the OS as it is touched, and slicing the headers out of it copies nothing.
+    Any memoryview taken of the mapping must be released before the block exits.
+    """
+    if isinstance(src, bytes):
+        yield src
+        return
+    with open(src, "rb") as f:
+        # empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+def get_source_hash(src):
+    if isinstance(src, bytes):
+        return hashlib.sha256(src).hexdigest()
+    with open(src, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class Manifest:
+    """
+    Sidecar JSON lines file recording every source that has been parsed into an output file,
+    as {"source", "size", "mtime"} plus an optional sha256 "hash" of the source bytes (a message of
+    a container has "container_size" and "container_mtime" instead of "mtime", see get_source_entry).
+    Reasoning: lets a killed run resume where it stopped, and lets a rerun on a directory that
+    has grown only parse the new files. A source is considered done when its size and mtime
+    (and its container's) match the manifest; with use_hash a file whose mtime changed is still skipped if its
+    content hash is unchanged.
+    Entries are only written when flush() is called, so hook flush() up as the on_flush of the
+    output writer: a source is never marked done before its parsed line is on disk.
+    """
+    def __init__(self, fname, use_hash = False):
+        self.fname = fname
+        self.use_hash = use_hash
+        self.done = {}
+        if os.path.exists(fname):
+            with open(fname, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = ujson.loads(line)
+                    except ValueError:
+                        # partial last line from an interrupted run
+                        continue
+                    self.done[entry["source"]] = entry
+        self._writer = JsonlWriter(fname, "a", buffer_size=None, flush_interval=None)
+
+    def is_done(self, entry, src):
+        prev = self.done.get(entry["source"])
+        if prev is None:
+            return False
+        if prev.get("size") == entry["size"] and all(prev.get(key) == entry.get(key) for key in ("mtime", "container_size", "container_mtime")):
+            return True
+        if self.use_hash and "hash" in prev and prev["size"] == entry["size"]:
+            return prev["hash"] == get_source_hash(src)
+        return False
+
+    def record(self, entry):
+        self.done[entry["source"]] = entry
+        self._writer.write(entry)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
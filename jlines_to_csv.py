@@ -1,23 +1,212 @@
-from csv import DictWriter
+from csv import DictWriter, reader, writer, field_size_limit
 import ujson
 import os
+import re
+import shutil
 import argparse
-from io_helpers import get_sample, change_filename
+from itertools import islice
+from functools import partial
+from multiprocessing import Pool
+from io_helpers import get_sample, change_filename, get_byte_ranges, iter_range_lines, open_stream, positive_int
+from parse_emails import PARSED_FIELDS
+from feature_registry import BODY_FEATURES, HEADER_FEATURES
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", help="The name of the file to fix", required=True)
 parser.add_argument("--output", "-o", help="The name of the file to output to", required=False)
 parser.add_argument("--debug", "-d", help="debug mode", action="store_true", required=False)
+parser.add_argument("--workers", "-w", type=int, default=1, help="number of worker processes converting byte ranges of the input (default 1, no pool)", required=False)
+parser.add_argument("--schema", choices=["parsed", "body", "header", "joined"], help="take the columns from the schema of this pipeline output instead of scanning the first lines", required=False)
+parser.add_argument("--scan-lines", type=int, default=1000, help="without --schema, the columns are the keys of this many first lines (default 1000)", required=False)
+parser.add_argument("--chunk-mb", type=positive_int, default=64, help="size of the byte ranges the input is cut into, in MB (default 64)", required=False)
+parser.add_argument("--drop", nargs="*", default=["data_base64"], help="string fields cut out of every line before it is decoded, at any depth (default data_base64, the inlined attachment bytes). --drop with no names keeps everything", required=False)
 
-def get_all_headers(infile):
-    with open(infile, 'r') as f:
-        k_set = set()
-        for line in f:
-            tempd = ujson.loads(line)
-            k_set.update(list(tempd.keys()))
-        return list(k_set)
 
-    
+
+
+'''
+jlines_to_csv.py Usage:
+
+python jlines_to_csv.py -i {JSON Lines File} -o {CSV File} [-w {Workers}] [--schema {parsed,body,header,joined}] [--drop {Field} ...]
+    Converts a JSON lines file to CSV, one column per key.
+    The columns come from --schema (the fields of a parse_emails.py, feature or joined file) or from the keys of the
+    first --scan-lines lines. A key first seen later widens the schema, it is added as a column at the end.
+    The input is cut into --chunk-mb byte ranges that -w worker processes convert in parallel, each to its own part
+    file, and the parts are joined in input order, so rows keep the order of the input lines.
+    --drop fields (data_base64 by default) are cut out of the raw line before it is decoded, so the base64 attachment
+    data in a parsed file is never decoded or written.
+'''
+
+# Columns of the files this pipeline writes, for --schema. Keys a schema does not have still get a column
+SCHEMAS = {
+    "parsed": [name for name, _ in PARSED_FIELDS],
+    "body": ["email_id"] + [name for name, _ in BODY_FEATURES.schema()],
+    "header": ["email_id"] + [name for name, _ in HEADER_FEATURES.schema()],
+    "joined": ["email_id", "og_fname"] + [name for name, _ in BODY_FEATURES.schema() + HEADER_FEATURES.schema()] + ["URLs"],
+}
+
+
+# part files are read back with csv to widen them, and a body can be longer than its 128k default field limit
+field_size_limit(2 ** 31 - 1)
+# between a dropped field's name and the opening quote of its string value
+VALUE_START = re.compile(rb'\s*:\s*"')
+SPACES = b" \t\r\n"
+
+
+def drop_keys(fields):
+    # the quoted names drop_fields looks for
+    return [b'"' + field.encode("utf-8") + b'"' for field in fields]
+
+
+def string_end(line, start):
+    # index of the quote that closes the JSON string whose content starts at start, -1 if there is none
+    end = line.find(b'"', start)
+    while end != -1:
+        i = end - 1
+        while line[i] == 92:  # backslash
+            i -= 1
+        if (end - 1 - i) % 2 == 0:
+            return end
+        end = line.find(b'"', end + 1)
+    return end
+
+
+def drop_fields(line, keys):
+    """
+    line with every "key": "string" pair of keys cut out, with the comma that separated it from its neighbour.
+    Reasoning: an inlined attachment is one long string with no quote in it, so its end is a single find. Decoding
+    it with ujson only to throw it away, or stepping over it with a regex, costs more than the rest of the line.
+    A key written inside a string is escaped (\\"data_base64\\") and a value equal to a key is not followed by a ':',
+    neither is cut.
+    """
+    for key in keys:
+        pos = line.find(key)
+        while pos != -1:
+            value = VALUE_START.match(line, pos + len(key))
+            end = string_end(line, value.end()) if value is not None else -1
+            if end == -1:
+                pos = line.find(key, pos + 1)
+                continue
+            start, end = pos, end + 1
+            before = start
+            while before and line[before - 1] in SPACES:
+                before -= 1
+            after = end
+            while after < len(line) and line[after] in SPACES:
+                after += 1
+            if line[before - 1:before] == b",":
+                start = before - 1
+            elif line[after:after + 1] == b",":
+                end = after + 1
+            line = line[:start] + line[end:]
+            pos = line.find(key, start)
+    return line
+
+
+def load_line(line, drop = None):
+    # decodes a JSON line, after cutting the drop_keys fields out of the raw bytes
+    if drop:
+        line = drop_fields(line, drop)
+    return ujson.loads(line)
+
+
+def get_prefix_columns(infile, scan_lines, drop = None):
+    # the keys of the first scan_lines lines, in the order they are first seen
+    columns = {}
+    with open_stream(infile, "rb") as f:
+        for line in islice(f, scan_lines):
+            columns.update(dict.fromkeys(load_line(line, drop)))
+    return list(columns)
+
+
+def convert_chunk(job, infile, columns, drop = None):
+    """
+    Writes the CSV rows (no header) of one byte range of infile to its part file.
+    Returns (part file, its columns, widened): widened is True if a line had a key that columns did not, that key is
+    added as a column at the end and the rows before it in this part are short.
+    """
+    start, end, part_fname = job
+    columns = list(columns)
+    known = set(columns)
+    widened = False
+    with open(part_fname, "w", encoding="utf-8", newline="") as wf:
+        # the writer reads the same columns list, so a column added below is written from the next row on
+        dw = DictWriter(wf, fieldnames=columns, extrasaction="ignore")
+        for line in iter_range_lines(infile, start, end):
+            try:
+                row = load_line(line, drop)
+            except ValueError as e:
+                print(line)
+                raise e
+            if not known.issuperset(row):
+                widened = True
+                for key in row:
+                    if key not in known:
+                        known.add(key)
+                        columns.append(key)
+            dw.writerow(row)
+    return part_fname, columns, widened
+
+
+def widen_part(part, columns):
+    """
+    Rewrites a part file to the final columns. Its own columns are the schema columns and then the keys it found
+    itself, so every column it has is in columns, and rows written before a key was found are filled with empty cells.
+    """
+    part_fname, part_columns, _ = part
+    positions = [columns.index(column) for column in part_columns]
+    with open(part_fname, "r", encoding="utf-8", newline="") as pf, open(part_fname + ".wide", "w", encoding="utf-8", newline="") as wf:
+        w = writer(wf)
+        for values in reader(pf):
+            row = [""] * len(columns)
+            for position, value in zip(positions, values):
+                row[position] = value
+            w.writerow(row)
+    os.replace(part_fname + ".wide", part_fname)
+
+
+def convert(infile, outfile, workers = 1, schema = None, scan_lines = 1000, chunk_bytes = 64 * 1024 * 1024, drop = ("data_base64",), debug = False):
+    """
+    Converts infile to the CSV outfile and returns its columns: the schema (or prefix) columns, then the keys first
+    seen later, in input order.
+    Reasoning: the original read the whole file twice on one core, once only to collect the keys. Here the file is
+    read once, byte ranges are decoded in parallel, and only the parts that are missing a late key are re-read.
+    The parts are then joined with plain byte copies.
+    """
+    drop = drop_keys(drop) if drop else None
+    if schema:
+        columns = SCHEMAS[schema]
+    else:
+        columns = get_prefix_columns(infile, scan_lines, drop)
+    jobs = [(start, end, f"{outfile}.part{i}") for i, (start, end) in enumerate(get_byte_ranges(infile, chunk_bytes))]
+    pool = Pool(workers) if workers > 1 else None
+    run = pool.map if pool else lambda function, items: list(map(function, items))
+    try:
+        parts = run(partial(convert_chunk, infile=infile, columns=columns, drop=drop), jobs)
+        final = dict.fromkeys(columns)
+        for _, part_columns, _ in parts:
+            final.update(dict.fromkeys(part_columns))
+        final = list(final)
+        narrow = [part for part in parts if part[1] != final or part[2]]
+        run(partial(widen_part, columns=final), narrow)
+        with open_stream(outfile, "w", newline="") as wf:
+            DictWriter(wf, fieldnames=final).writeheader()
+            wf.flush()
+            for part_fname, _, _ in parts:
+                with open(part_fname, "rb") as pf:
+                    shutil.copyfileobj(pf, wf.buffer, 1024 * 1024)
+                os.remove(part_fname)
+    finally:
+        if pool:
+            pool.terminate()
+        for _, _, part_fname in jobs:
+            for fname in [part_fname, part_fname + ".wide"]:
+                if os.path.exists(fname):
+                    os.remove(fname)
+    if debug:
+        print(f"{len(jobs)} byte ranges, {len(final)} columns ({len(final) - len(columns)} found after the schema), {len(narrow)} parts widened")
+    return final
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -29,13 +218,4 @@ if __name__ == '__main__':
     elif os.path.exists(outfile):
         if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
             os.remove(outfile)
-    heads = get_all_headers(infile)
-    with open(infile, 'r') as f, open(outfile, "w") as wf:
-        dw = DictWriter(wf, fieldnames=heads)
-        dw.writeheader()
-        for line in f:
-            try:
-                dw.writerow(ujson.loads(line))
-            except ValueError as e:
-                print(line)
-                raise e
\ No newline at end of file
+    convert(infile, outfile, args.workers, args.schema, args.scan_lines, args.chunk_mb * 1024 * 1024, args.drop, debug)
@@ -0,0 +1,238 @@
+import argparse
+import os
+import shutil
+import tempfile
+import ujson
+from collections import Counter
+from io_helpers import iter_records, open_writer, open_stream, is_compressed, is_parquet, OUTPUT_FORMATS, ROW_GROUP_SIZE, STREAM_BUFFER
+from parse_emails import PARSED_FIELDS
+from feature_registry import BODY_FEATURES, HEADER_FEATURES
+from sketches import hash64
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--parsed", "-p", help="parsed file (from parse_emails.py) the labels and other --columns are taken from", required=True)
+parser.add_argument("--body-features", "-b", help="body feature file (extract_body_features.py)", required=False)
+parser.add_argument("--header-features", "-f", help="header feature file (extract_header_features.py)", required=False)
+parser.add_argument("--output", "-o", help="the joined training table to write", required=True)
+parser.add_argument("--columns", "-c", nargs="*", default=["og_fname", "label"], help="columns of the parsed file to keep (default og_fname label)", required=False)
+parser.add_argument("--how", choices=["inner", "left"], default="inner", help="inner (default) only writes emails that have every feature file, left writes every parsed email", required=False)
+parser.add_argument("--method", choices=["hash", "merge"], default="hash", help="hash (default) joins files in any order, merge streams files that are all sorted by email_id", required=False)
+parser.add_argument("--memory-mb", type=int, default=1024, help="memory the hash join may hold feature records in, beyond it they are spilled to disk in partitions (default 1024)", required=False)
+parser.add_argument("--partitions", type=int, help="number of hash join partitions, instead of deriving it from --memory-mb", required=False)
+parser.add_argument("--tmp-dir", help="directory for the spilled partitions (default the output directory)", required=False)
+parser.add_argument("--format", choices=OUTPUT_FORMATS, default="jsonl", help="output format, jsonl (default) or parquet (needs pyarrow)", required=False)
+
+
+
+
+'''
+join_features.py Usage:
+
+python join_features.py -p {Parsed File} -b {Body Features File} -f {Header Features File} -o {Output File}
+    Joins the parsed labels and the body and header features into one training table, one line per email_id:
+        {email_id, og_fname, label, (body features), (header features)}
+    Lines are matched by email_id (the feature stages write it on every line), never by position, so the files can be
+    filtered, resumed or written in parallel in any order.
+    --method hash (default) partitions every file by a hash of the email_id when the feature files do not fit in
+    --memory-mb, spilling the partitions to --tmp-dir, then joins one partition at a time. Output is in parsed
+    file order within a partition.
+    --method merge streams files that are already sorted by email_id in one pass and constant memory, an unsorted
+    file is an error.
+    --how left keeps parsed emails missing a feature line, their feature columns are left out (null in parquet).
+    Every input can be JSON lines (also .gz/.xz/.zst) or parquet, --format parquet writes a typed parquet table.
+    Prints how many emails were joined and how many lines of each file had no match.
+'''
+
+# the in memory size of a feature record over its size as a JSON line, to size the hash join partitions
+RECORD_OVERHEAD = 6
+# assumed size of a compressed or parquet input over its size on disk
+COMPRESSION_RATIO = 8
+
+
+def keyed_records(fname, columns = None):
+    """
+    (email_id, record) of every line of fname, the record without its email_id and only with columns (all by
+    default). A line without an email_id is an error: it was written before the feature stages carried it.
+    """
+    for record in iter_records(fname, None if columns is None else ["email_id"] + list(columns)):
+        key = record.pop("email_id", None)
+        if key is None:
+            raise ValueError(f"{fname} has a line without an email_id, rerun the stage that wrote it")
+        if columns is not None:
+            record = {column: record[column] for column in columns if column in record}
+        yield key, record
+
+
+def sorted_records(fname, records):
+    # records, checking that their email_ids are ascending
+    last = None
+    for i, (key, record) in enumerate(records, 1):
+        if last is not None and key < last:
+            raise ValueError(f"{fname} is not sorted by email_id at line {i}, use --method hash")
+        last = key
+        yield key, record
+
+
+def get_fields(columns, feature_fnames):
+    """
+    The parquet schema of the joined table: email_id, the parsed columns, then the columns of the first line of
+    each feature file, typed from PARSED_FIELDS and the feature registries (str if unknown).
+    """
+    types = dict(PARSED_FIELDS + BODY_FEATURES.schema() + HEADER_FEATURES.schema())
+    names = ["email_id"] + list(columns)
+    for fname in feature_fnames:
+        for _, record in keyed_records(fname):
+            names.extend(record)
+            break
+    return [(name, types.get(name, str)) for name in dict.fromkeys(names)]
+
+
+def count_partitions(feature_fnames, memory_bytes):
+    # enough partitions for the feature records of one to fit in memory_bytes
+    size = sum(os.path.getsize(fname) * (COMPRESSION_RATIO if is_compressed(fname) or is_parquet(fname) else 1) for fname in feature_fnames)
+    return max(1, -(-size * RECORD_OVERHEAD // memory_bytes))
+
+
+def load_table(records, stats, name):
+    # email_id -> record, a repeated email_id keeps its first line
+    table = {}
+    for key, record in records:
+        if key in table:
+            stats[f"{name} lines with a repeated email_id"] += 1
+            continue
+        table[key] = record
+    return table
+
+
+def probe(parsed, tables, names, writer, how, stats):
+    """
+    Writes the joined record of every parsed record. Matched feature records are popped from their table, so what
+    is left in a table afterwards had no parsed line.
+    """
+    for key, record in parsed:
+        out = {"email_id": key}
+        out.update(record)
+        complete = True
+        for table, name in zip(tables, names):
+            features = table.pop(key, None)
+            if features is None:
+                stats[f"parsed lines without {name}"] += 1
+                complete = False
+            else:
+                out.update(features)
+        if complete or how == "left":
+            writer.write(out)
+            stats["joined"] += 1
+    for table, name in zip(tables, names):
+        stats[f"{name} lines without a parsed line"] += len(table)
+
+
+def partition(records, fnames):
+    # spills records to the partition files fnames by the hash of their email_id
+    files = [open(fname, "w", encoding="utf-8", buffering=STREAM_BUFFER) for fname in fnames]
+    try:
+        for key, record in records:
+            files[hash64(key.encode("utf-8", "surrogatepass")) % len(files)].write(ujson.dumps([key, record], ensure_ascii=False) + "\n")
+    finally:
+        for f in files:
+            f.close()
+
+
+def read_partition(fname):
+    with open_stream(fname) as f:
+        for line in f:
+            key, record = ujson.loads(line)
+            yield key, record
+
+
+def hash_join(parsed_fname, feature_fnames, names, writer, columns, how, partitions, tmp_dir = None):
+    """
+    Joins by email_id in any line order. With one partition the feature files are loaded into dicts and the parsed
+    file streamed past them. With more, every file is first spilled to partition files by the hash of the email_id,
+    so an email's lines all land in the same partition, and the partitions are joined one at a time.
+    Reasoning: memory is bounded by the feature records of one partition, whatever the size of the files.
+    """
+    stats = Counter()
+    if partitions == 1:
+        tables = [load_table(keyed_records(fname), stats, name) for fname, name in zip(feature_fnames, names)]
+        probe(keyed_records(parsed_fname, columns), tables, names, writer, how, stats)
+        return stats
+    tmp = tempfile.mkdtemp(prefix="join_", dir=tmp_dir)
+    try:
+        parts = []
+        for i, (fname, file_columns) in enumerate([(parsed_fname, columns)] + [(fname, None) for fname in feature_fnames]):
+            part_fnames = [os.path.join(tmp, f"{i}_{p}.json") for p in range(partitions)]
+            partition(keyed_records(fname, file_columns), part_fnames)
+            parts.append(part_fnames)
+        for p in range(partitions):
+            tables = [load_table(read_partition(part_fnames[p]), stats, name) for part_fnames, name in zip(parts[1:], names)]
+            probe(read_partition(parts[0][p]), tables, names, writer, how, stats)
+    finally:
+        shutil.rmtree(tmp)
+    return stats
+
+
+def merge_join(parsed_fname, feature_fnames, names, writer, columns, how):
+    """
+    Joins files that are all sorted by email_id in a single streaming pass: every feature file is advanced to the
+    email_id of the parsed line. Raises ValueError at the first line out of order.
+    """
+    stats = Counter()
+    streams = [sorted_records(fname, keyed_records(fname)) for fname in feature_fnames]
+    heads = [next(stream, None) for stream in streams]
+    for key, record in sorted_records(parsed_fname, keyed_records(parsed_fname, columns)):
+        out = {"email_id": key}
+        out.update(record)
+        complete = True
+        for i, (stream, name) in enumerate(zip(streams, names)):
+            while heads[i] is not None and heads[i][0] < key:
+                stats[f"{name} lines without a parsed line"] += 1
+                heads[i] = next(stream, None)
+            if heads[i] is not None and heads[i][0] == key:
+                out.update(heads[i][1])
+                heads[i] = next(stream, None)
+            else:
+                stats[f"parsed lines without {name}"] += 1
+                complete = False
+        if complete or how == "left":
+            writer.write(out)
+            stats["joined"] += 1
+    for i, (stream, name) in enumerate(zip(streams, names)):
+        while heads[i] is not None:
+            stats[f"{name} lines without a parsed line"] += 1
+            heads[i] = next(stream, None)
+    return stats
+
+
+def join_features(parsed_fname, output, body_fname = None, header_fname = None, columns = ("og_fname", "label"), how = "inner", method = "hash", memory_mb = 1024, partitions = None, tmp_dir = None, format = "jsonl"):
+    """
+    Writes the joined table of the parsed columns and the body and header features to output, returns the match
+    counts (Counter: "joined", "parsed lines without body features", "body features lines without a parsed line", ...).
+    """
+    inputs = [(fname, name) for fname, name in [(body_fname, "body features"), (header_fname, "header features")] if fname]
+    feature_fnames = [fname for fname, _ in inputs]
+    names = [name for _, name in inputs]
+    fields = get_fields(columns, feature_fnames) if format == "parquet" else None
+    with open_writer(output, format, fields, "w", row_group_size=ROW_GROUP_SIZE) as writer:
+        if method == "merge":
+            return merge_join(parsed_fname, feature_fnames, names, writer, columns, how)
+        if partitions is None:
+            partitions = count_partitions(feature_fnames, memory_mb * 1024 * 1024)
+        return hash_join(parsed_fname, feature_fnames, names, writer, columns, how, partitions, tmp_dir or os.path.dirname(os.path.abspath(output)))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not args.body_features and not args.header_features:
+        parser.error("give at least one of --body-features and --header-features")
+    if os.path.exists(args.output):
+        if not input(f"please enter anything if you want to overwrite the existing output file {args.output}: \n"):
+            parser.error(f"{args.output} exists")
+        os.remove(args.output)
+    try:
+        stats = join_features(args.parsed, args.output, args.body_features, args.header_features, args.columns, args.how, args.method, args.memory_mb, args.partitions, args.tmp_dir, args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    for name in ["joined"] + sorted(name for name in stats if name != "joined"):
+        print(f"{name}: {stats[name]}")
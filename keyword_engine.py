@@ -0,0 +1,195 @@
+import re
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+'''
+Single pass keyword matching for the body feature extractors (extract_body_features.py and extract_body_features_lambda.py).
+
+Every keyword list used by the body features is defined here once, and BODY_MATCHER finds all of them in one pass over the
+lowered body instead of one body_lower.count(keyword) / keyword in body_lower scan per keyword (~200 per email).
+Uses the pyahocorasick automaton when it is installed (pip install pyahocorasick), otherwise a compiled trie regex.
+'''
+
+
+URGENCY_KEYWORDS = {
+    'urgent', 'immediately', 'asap', 'right now', 'expire', 'expires', 'expiring',
+    'limited time', 'act now', 'don\'t wait', 'hurry', 'quick', 'fast',
+    'deadline', 'today only', 'last chance', 'final notice', 'time sensitive',
+    'respond now', 'immediate action', 'within 24 hours', 'within 48 hours'
+}
+
+AUTHORITY_KEYWORDS = {
+    'verify', 'confirm', 'validate', 'authenticate', 'security alert',
+    'account', 'suspended', 'locked', 'unauthorized', 'unusual activity',
+    'fraud', 'fraudulent', 'verify your identity', 'confirm your identity',
+    'security team', 'security department', 'customer service', 'support team',
+    'administrator', 'system administrator', 'it department'
+}
+
+TRUSTED_DOMAINS = {
+    'google.com', 'microsoft.com', 'apple.com', 'amazon.com', 'facebook.com',
+    'paypal.com', 'ebay.com', 'netflix.com', 'linkedin.com', 'twitter.com',
+    'instagram.com', 'yahoo.com', 'outlook.com', 'gmail.com'
+}
+
+THREAT_KEYWORDS = {
+    'suspend', 'terminated', 'cancelled', 'closed', 'blocked', 'restricted',
+    'legal action', 'lawsuit', 'court', 'penalty', 'fine', 'police',
+    'arrest', 'criminal', 'prosecution', 'consequences', 'lose access',
+    'permanently deleted', 'violation', 'breach', 'compromised'
+}
+
+REQUEST_KEYWORDS = {
+    'click here', 'click the link', 'click below', 'log in', 'login',
+    'sign in', 'update', 'confirm', 'verify', 'provide', 'enter',
+    'submit', 'reset password', 'change password', 'update payment',
+    'billing information', 'credit card', 'social security', 'ssn',
+    'account number', 'routing number', 'date of birth', 'mother\'s maiden name'
+}
+
+GENERIC_GREETINGS = {
+    'dear customer', 'dear user', 'dear member', 'dear sir/madam',
+    'dear sir or madam', 'hello user', 'valued customer', 'dear valued customer',
+    'dear account holder', 'dear client', 'greetings'
+}
+
+PASSWORD_PHRASES = ['password', 'passphrase', 'pin', 'security code']
+FINANCIAL_PHRASES = ['credit card', 'bank account', 'routing number', 'card number', 'cvv', 'billing']
+PERSONAL_PHRASES = ['social security', 'ssn', 'date of birth', 'driver\'s license', 'passport']
+FORM_PHRASES = ['fill out', 'complete the form', 'enter your', 'input your', 'provide your']
+
+IMPERATIVE_VERBS = ['click', 'verify', 'confirm', 'update', 'download', 'open', 'call',
+                    'contact', 'respond', 'reply', 'send', 'provide', 'enter', 'submit',
+                    'reset', 'change', 'renew', 'activate', 'complete', 'review']
+SECOND_PERSON = ['you', 'your', 'yours', "you're", "you've", "you'll"]
+# second person pronouns are counted as " you ", " you," and " you."
+SECOND_PERSON_PATTERNS = [f' {pronoun}{end}' for pronoun in SECOND_PERSON for end in (' ', ',', '.')]
+FIRST_PERSON_PLURAL = [' we ', ' our ', ' us ', "we're", "we've", "we'll"]
+
+FIRST_PERSON = ['i am', 'i have', 'i will', 'i need', 'i want', 'my name']
+MONEY_KEYWORDS = ['refund', 'prize', 'lottery', 'inheritance', 'compensation', 'owed', 'transfer', 'wire', 'payment', 'invoice']
+PRIZE_PHRASES = ['you have won', 'you\'ve won', 'congratulations', 'claim your', 'you are selected', 'you have been chosen']
+
+
+class KeywordMatches:
+    """
+    Result of KeywordMatcher.scan.
+    counts[keyword] is text.count(keyword) (non-overlapping, same as str.count), and first_end[keyword] is the end
+    offset of its first occurrence, for keywords that occur at all.
+    """
+    def __init__(self, groups, counts, first_end):
+        self.groups = groups
+        self.counts = counts
+        self.first_end = first_end
+
+    def count(self, group):
+        # same as sum(text.count(keyword) for keyword in group)
+        return sum(self.counts.get(keyword, 0) for keyword in self.groups[group])
+
+    def has(self, group):
+        # same as any(keyword in text for keyword in group)
+        return any(keyword in self.first_end for keyword in self.groups[group])
+
+    def has_within(self, group, end):
+        # same as any(keyword in text[:end] for keyword in group)
+        return any(self.first_end.get(keyword, end + 1) <= end for keyword in self.groups[group])
+
+
+class KeywordMatcher:
+    """
+    Finds every keyword of every group in one pass over a text.
+    Reasoning: all occurrences (including overlapping ones, and keywords inside other keywords) are found at once, and
+    a keyword's occurrence is only counted if it starts after the end of its previous counted one. That is exactly
+    str.count's non-overlapping left to right semantics, so counts are identical to scanning once per keyword.
+    groups maps a group name to an iterable of keywords, a keyword may be in several groups.
+    """
+    def __init__(self, groups):
+        self.groups = {name: list(keywords) for name, keywords in groups.items()}
+        self.keywords = sorted({keyword for keywords in self.groups.values() for keyword in keywords})
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for keyword in self.keywords:
+                self.automaton.add_word(keyword, (keyword, len(keyword)))
+            self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            # The trie regex matches the longest keyword starting at a position, every other keyword starting
+            # there is a prefix of it
+            self.pattern = re.compile(trie_regex(self.keywords))
+            self.prefixes = {keyword: [(k, len(k)) for k in self.keywords if keyword.startswith(k)] for keyword in self.keywords}
+
+    def scan(self, text):
+        counts = {}
+        first_end = {}
+        last_end = {}
+        # Occurrences of any one keyword come out left to right, and one only counts if it starts at or after
+        # the end of the previous counted one. Kept inline in both loops, a function call per occurrence cost
+        # more than the scan itself
+        if self.automaton is not None:
+            # the automaton reports every occurrence with its inclusive end offset
+            for end, (keyword, length) in self.automaton.iter(text):
+                start = end - length + 1
+                prev_end = last_end.get(keyword)
+                if prev_end is None:
+                    counts[keyword] = 1
+                    first_end[keyword] = last_end[keyword] = end + 1
+                elif start >= prev_end:
+                    counts[keyword] += 1
+                    last_end[keyword] = end + 1
+        else:
+            search = self.pattern.search
+            prefixes = self.prefixes
+            m = search(text)
+            while m is not None:
+                start = m.start()
+                for keyword, length in prefixes[m.group()]:
+                    prev_end = last_end.get(keyword)
+                    if prev_end is None:
+                        counts[keyword] = 1
+                        first_end[keyword] = last_end[keyword] = start + length
+                    elif start >= prev_end:
+                        counts[keyword] += 1
+                        last_end[keyword] = start + length
+                m = search(text, start + 1)
+        return KeywordMatches(self.groups, counts, first_end)
+
+
+def trie_regex(keywords):
+    # Builds an alternation that is factored on common prefixes and always prefers the longest keyword
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return "(?:" + body + ")?" if "" in node else body
+
+    return build(trie)
+
+
+BODY_MATCHER = KeywordMatcher({
+    "urgency": URGENCY_KEYWORDS,
+    "authority": AUTHORITY_KEYWORDS,
+    "trusted_domains": TRUSTED_DOMAINS,
+    "threat": THREAT_KEYWORDS,
+    "request": REQUEST_KEYWORDS,
+    "password": PASSWORD_PHRASES,
+    "financial": FINANCIAL_PHRASES,
+    "personal": PERSONAL_PHRASES,
+    "form": FORM_PHRASES,
+    "imperative": IMPERATIVE_VERBS,
+    "second_person": SECOND_PERSON_PATTERNS,
+    "first_person_plural": FIRST_PERSON_PLURAL,
+    "greeting": GENERIC_GREETINGS,
+    "first_person": FIRST_PERSON,
+    "money": MONEY_KEYWORDS,
+    "prize": PRIZE_PHRASES,
+})
@@ -0,0 +1,95 @@
+import argparse
+import os
+import ujson
+from io_helpers import OffsetIndex, build_index, index_fname, INDEX_KEYS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", "-i", nargs="+", help="JSON lines files to look in (parsed, body feature, header feature or joined files), each indexed with --index", required=True)
+parser.add_argument("--key", "-k", nargs="+", help="email_id or og_fname values to look up", required=True)
+parser.add_argument("--by", choices=INDEX_KEYS, help="only match the values against this key (default either)", required=False)
+parser.add_argument("--build", "-b", action="store_true", help="first write the index of every input that has none, in one pass over the file", required=False)
+parser.add_argument("--merge", "-m", action="store_true", help="print one record per key with the fields of every input merged, instead of one line per record found", required=False)
+
+
+
+
+'''
+lookup_email.py Usage:
+
+python lookup_email.py -i {Parsed File} {Body Features File} {Header Features File} -k {email_id or og_fname} ...
+    Prints every line of the inputs with that email_id or og_fname, as {"lookup": key, "file": input, "record": line}.
+    The lookup goes through the .idx index of each input (written by parse_emails.py, the feature stages and
+    wrapper_for_parsing.py with --index): the index is memory mapped and binary searched, so a lookup only reads the
+    matching lines, not the multi GB file.
+    An input with no line for the key is searched again with the other keys of the lines already found, so the
+    email_id of a parsed line also finds the feature lines of its og_fname.
+    --by is optional, only match email_id or only og_fname
+    -b is optional, indexes inputs that were written without --index first (reads them once)
+    -m is optional, prints a single {"lookup": key, ...} record per key with the fields of every line found, like the
+       body, headers and features of one email together
+'''
+
+def open_indexes(fnames, build = False):
+    indexes = {}
+    for fname in fnames:
+        if not os.path.exists(index_fname(fname)):
+            if not build:
+                raise FileNotFoundError(f"{fname} has no index {index_fname(fname)}, write it with --index or use --build")
+            build_index(fname)
+        indexes[fname] = OffsetIndex(fname)
+    return indexes
+
+
+def lookup_email(indexes, value, key = None):
+    """
+    {file: [records]} of the lines with value in every indexed file, in file order.
+    A file with no line for value is searched with the index keys of the records found in the others, so a parsed
+    line found by email_id links to the feature lines of its og_fname.
+    """
+    found = {fname: index.lookup(value, key) for fname, index in indexes.items()}
+    linked = {}
+    for records in found.values():
+        for record in records:
+            for name in INDEX_KEYS:
+                if record.get(name) is not None:
+                    linked[(name, str(record[name]))] = None
+    for fname, index in indexes.items():
+        if found[fname]:
+            continue
+        for name, linked_value in linked:
+            for record in index.lookup(linked_value, name):
+                if record not in found[fname]:
+                    found[fname].append(record)
+    return found
+
+
+def print_lookups(indexes, values, key = None, merge = False):
+    for value in values:
+        found = lookup_email(indexes, value, key)
+        if not any(found.values()):
+            print(f"{value}: not found")
+            continue
+        if merge:
+            merged = {"lookup": value}
+            for records in found.values():
+                for record in records:
+                    merged.update(record)
+            print(ujson.dumps(merged, ensure_ascii=False, escape_forward_slashes=False))
+            continue
+        for fname, records in found.items():
+            for record in records:
+                print(ujson.dumps({"lookup": value, "file": fname, "record": record}, ensure_ascii=False, escape_forward_slashes=False))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    try:
+        indexes = open_indexes(args.input, args.build)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    try:
+        print_lookups(indexes, args.key, args.by, args.merge)
+    finally:
+        for index in indexes.values():
+            index.close()
@@ -1,16 +1,21 @@
-from email.parser import BytesParser
+from email.feedparser import BytesFeedParser
 import argparse
 from email import policy
 import ujson
 import re
 import os
 from bs4 import BeautifulSoup
-from io_helpers import get_sample, get_all_files_from_dir, change_filename
+from lxml import etree
+from io_helpers import reservoir_sample, iter_files_from_dir, change_filename, open_writer, OUTPUT_FORMATS, INDEX_KEYS, index_fname, open_stream, is_compressed, iter_source_members, is_maildir, iter_maildir_files, store_blob, Manifest, get_source_entry, truncate_partial_line, map_source
 import time
 import mimetypes
 import hashlib
 import base64
+import binascii
 import uuid
+from multiprocessing import Pool
+from functools import partial
+from contextlib import contextmanager
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", nargs="+", help="The name of the file to fix", required=True)
@@ -18,6 +23,17 @@ parser.add_argument("--output", "-o", help="The name of the file to output to",
 parser.add_argument("--debug", "-d", help="debug mode", action="store_true", required=False)
 parser.add_argument("--sample", "-s", help="use a sample of files instead of all files from dir, specify number of samples desired", required=False)
 parser.add_argument("--label", "-l", help="a static key/value pair that you want to add to each line. useful for labeling", required=False)
+parser.add_argument("--workers", "-w", type=int, default=1, help="number of worker processes to parse with (default 1, no pool)", required=False)
+parser.add_argument("--ordered", action="store_true", help="with --workers > 1, keep output lines in input order instead of completion order", required=False)
+parser.add_argument("--attachment-store", "-a", help="directory to write attachment bytes to, keyed by sha256. output lines then only carry the hash and size", required=False)
+parser.add_argument("--resume", "-r", action="store_true", help="append to the existing output, skipping files already recorded in its manifest", required=False)
+parser.add_argument("--manifest-hash", action="store_true", help="also record a sha256 of every source in the manifest, so touched but unchanged files are still skipped on resume", required=False)
+parser.add_argument("--part-timing", "-t", action="store_true", help="add a mime_timing entry with the part count and per-part parse time to every line", required=False)
+parser.add_argument("--max-message-bytes", type=int, help="messages bigger than this only have their headers parsed, and are marked truncated", required=False)
+parser.add_argument("--max-attachment-bytes", type=int, help="attachments bigger than this are only recorded by hash and size, without their data", required=False)
+parser.add_argument("--format", choices=OUTPUT_FORMATS, default="jsonl", help="output file format, jsonl (default) or parquet (needs pyarrow)", required=False)
+parser.add_argument("--index", action="store_true", help="also write an {output}.idx index of the email_id and og_fname of every line to its byte offset, for lookup_email.py (jsonl only)", required=False)
+parser.add_argument("--extensions", "-e", nargs="+", help="with a directory input, only parse the files with these extensions (ex. -e eml mbox), checked before --sample. Not applied to Maildir messages", required=False)
 
 
 
@@ -30,8 +46,19 @@ parse_emailsy.py Usage:
 
 python parse_emails.py -i {Input File(s) or Directory} -o {Output file name}
     -i accepts a file, multiple files, or a directory. If a directory, it finds all .eml files in that directory that are one level deep (doesnt dig into all directories inside).
+       mbox files (.mbox/.mbx), tar bundles (.tar/.tar.gz/.tgz/.tar.bz2/.tar.xz) and .zip files are read in place, one message per member.
+       A Maildir directory (cur/new/tmp) only has its cur/ and new/ messages read.
     -o is optional, otherwise saves output to a default output filename
     -l is optional, allows you to add a label to each line as it processes
+    -w is optional, parses with a pool of N worker processes. Add --ordered to keep input order
+    -a is optional, writes attachments once into a content addressed directory instead of inlining them as base64
+    -r is optional, resumes into an existing output file, only parsing files not yet in its {output}_manifest.json sidecar.
+       The manifest is written on every run, so a run started without -r can still be resumed
+    -e is optional, with a directory input only the files with these extensions are parsed (ex. -e eml mbox zip)
+    -t is optional, adds per-part MIME timing to each line to find pathological messages
+    --max-message-bytes / --max-attachment-bytes are optional size caps, so a single huge message can't exhaust a worker's memory
+    --format is optional, parquet writes a typed, compressed parquet file (PARSED_FIELDS schema) instead of json lines, it can not be resumed
+    --index is optional, also writes an {Output}.idx sidecar to look emails up by email_id or og_fname without reading the file (lookup_email.py)
 Output file is in the following format:
     {header_list:"header1,header2,header3", raw_headers:(raw headers in UTF-8 format), body: (body text in UTF-8 format)}
     {header_list:"header1,header2,header3", raw_headers:(raw headers in UTF-8 format), body: (body text in UTF-8 format)}
@@ -40,70 +67,211 @@ Output file is in the following format:
 '''
 
 
-def extract_attachments(msg):
-    
-    attachments = []
-    
-    for part in msg.walk():
-        # Skip multipart containers (they're just structure)
-        if part.get_content_maintype() == 'multipart':
+# Schema of the parsed file with --format parquet (see io_helpers.arrow_type). Keys only some lines have
+# (truncated, mime_timing, label, the attachment data_base64 / size / oversized) are null where missing
+PARSED_FIELDS = [("email_id", str), ("header_list", "category"), ("raw_headers", str), ("body", str), ("og_fname", str),
+                 ("attachments", [{"filename": str, "content_type": str, "hash": str, "data_base64": str, "size": int, "oversized": bool}]),
+                 ("truncated", bool),
+                 ("mime_timing", {"part_count": int, "walk_seconds": float, "parts": [{"content_type": str, "seconds": float}]}),
+                 ("label", "category")]
+# parsed rows carry whole bodies and attachments, so their parquet row groups are kept small
+PARSED_ROW_GROUP_SIZE = 1000
+
+# base64 payloads are decoded and hashed this many characters at a time when they are too big to keep
+B64_CHUNK_CHARS = 1 << 20
+B64_BODY = re.compile(rb"[A-Za-z0-9+/]*")
+B64_TAIL = re.compile(rb"[A-Za-z0-9+/]*={0,2}")
+
+def hash_base64_payload(payload):
+    """
+    Returns (sha256 hexdigest, decoded size) of a base64 payload string, decoding it a chunk at a time
+    so the decoded bytes are never held in memory at once.
+    Reasoning: gives the same hash as sha256(part.get_payload(decode=True)) for a huge attachment
+    without materializing it. Only clean base64 (what email.message's strict decode accepts) is
+    streamed; anything else returns None so the caller can fall back to get_payload(decode=True).
+    """
+    sha = hashlib.sha256()
+    size = 0
+    carry = b""
+    for i in range(0, len(payload), B64_CHUNK_CHARS):
+        chunk = payload[i:i + B64_CHUNK_CHARS]
+        if not chunk.isascii():
+            return None
+        carry += chunk.encode("ascii").translate(None, b"\r\n")
+        # decode whole quanta, but always keep the last one back since it may hold the padding
+        cut = len(carry) - len(carry) % 4
+        if cut == len(carry):
+            cut -= 4
+        if cut <= 0:
             continue
+        block = carry[:cut]
+        if not B64_BODY.fullmatch(block):
+            return None
+        data = binascii.a2b_base64(block)
+        sha.update(data)
+        size += len(data)
+        carry = carry[cut:]
+    # missing padding is added back, same as email.message does
+    pad_err = len(carry) % 4
+    if pad_err:
+        carry += b"==="[:4 - pad_err]
+    if not B64_TAIL.fullmatch(carry):
+        return None
+    try:
+        data = binascii.a2b_base64(carry)
+    except binascii.Error:
+        return None
+    sha.update(data)
+    return sha.hexdigest(), size + len(data)
+
+def extract_attachment_info(part, content_type, content_disposition, max_attachment_bytes = None):
+    # Get filename
+    filename = part.get_filename() or part.get_param("name", header="content-type")
+    if not filename:
+        # Last resort: check for any name-like parameter
+        for param_name in ["filename", "name"]:
+            filename = part.get_param(param_name)
+            if filename:
+                break
+    if not filename:
+        # Some attachments don't have filenames, generate one
+        ext = mimetypes.guess_extension(content_type)
+        filename = f"unnamed_attachment{ext or '.bin'}"
+    filename = re.sub(r"[/\\:*?\"<>|]", "_", filename)
+    
+    # Get the binary data
+    try:
+        if max_attachment_bytes is not None:
+            # Oversized base64 attachments are hashed as they are decoded and their bytes dropped,
+            # data is None for them
+            payload = part.get_payload()
+            cte = str(part.get('content-transfer-encoding', '')).lower()
+            if cte == 'base64' and isinstance(payload, str) and len(payload) > max_attachment_bytes:
+                streamed = hash_base64_payload(payload)
+                if streamed and streamed[1] > max_attachment_bytes:
+                    return {
+                        'filename': filename,
+                        'content_type': content_type,
+                        'data': None,
+                        'hash': streamed[0],
+                        'size': streamed[1],
+                        'content_disposition': content_disposition
+                    }
+
+        data = part.get_payload(decode=True)  # decode=True handles Base64/etc
         
-        # Check if this part is an attachment
-        content_disposition = part.get_content_disposition()
+        if data is None:
+            # Malformed attachment
+            return None
         
-        if content_disposition == 'attachment' or content_disposition == 'inline':
-            # Inline can be images embedded in HTML - often need analysis too
-            
-            # Get filename
-            filename = part.get_filename() or part.get_param("name", header="content-type")
-            if not filename:
-                # Last resort: check for any name-like parameter
-                for param_name in ["filename", "name"]:
-                    filename = part.get_param(param_name)
-                    if filename:
-                        break
-            if not filename:
-                # Some attachments don't have filenames, generate one
-                ext = mimetypes.guess_extension(part.get_content_type())
-                filename = f"unnamed_attachment{ext or '.bin'}"
-            filename = re.sub(r"[/\\:*?\"<>|]", "_", filename)
-            
-            # Get the binary data
-            try:
-                data = part.get_payload(decode=True)  # decode=True handles Base64/etc
-                
-                if data is None:
-                    # Malformed attachment
-                    continue
-                
-                # Calculate hash for identification/deduplication
-                content_hash = hashlib.sha256(data).hexdigest()
-                
-                attachment_info = {
-                    'filename': filename,
-                    'content_type': part.get_content_type(),
-                    'data': data,  # Raw bytes
-                    'hash': content_hash,
-                    'content_disposition': content_disposition
-                }
-                
-                attachments.append(attachment_info)
-                
-            except Exception as e:
-                # Log but don't fail entire parsing
-                print(f"Warning: Failed to extract attachment {filename}: {e}")
-                continue
-    
-    return attachments
+        # Calculate hash for identification/deduplication
+        content_hash = hashlib.sha256(data).hexdigest()
+        size = len(data)
+        if max_attachment_bytes is not None and size > max_attachment_bytes:
+            data = None
+        
+        return {
+            'filename': filename,
+            'content_type': content_type,
+            'data': data,  # Raw bytes
+            'hash': content_hash,
+            'size': size,
+            'content_disposition': content_disposition
+        }
+        
+    except Exception as e:
+        # Log but don't fail entire parsing
+        print(f"Warning: Failed to extract attachment {filename}: {e}")
+        return None
 
-def html_to_text(html):
+def extract_attachments(msg):
+    return extract_parts(msg)[2]
+
+# strings under these tags never reach get_text: script/style/noscript are decomposed, and bs4
+# gives script/style/template/rt/rp strings their own NavigableString subclasses, which get_text skips
+SKIP_TEXT_TAGS = frozenset(["script", "style", "noscript", "template", "rt", "rp"])
+PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+ASCII_SPACES = frozenset("\x20\x0a\x09\x0c\x0d")
+
+class HtmlTextTarget:
+    """
+    lxml parser target that collects the text BeautifulSoup(html, "lxml").get_text() would return.
+    Reasoning: bs4 builds a Tag/NavigableString tree from these exact parser events and then walks it
+    again for get_text. Here the strings are cut at the same points bs4 cuts them (every tag start
+    and end, comment, doctype and PI) and kept or dropped on the fly, so no tree is ever built.
+    """
+    def __init__(self):
+        self.strings = []
+        self.current = []
+        self.skip_depth = 0
+        self.preserve_depth = 0
+
+    def end_data(self):
+        # mirrors BeautifulSoup.endData
+        if not self.current:
+            return
+        data = "".join(self.current)
+        self.current = []
+        if self.skip_depth:
+            return
+        if not self.preserve_depth and all(c in ASCII_SPACES for c in data):
+            data = "\n" if "\n" in data else " "
+        self.strings.append(data)
+
+    def start(self, tag, attrib, nsmap = None):
+        self.end_data()
+        if tag in SKIP_TEXT_TAGS:
+            self.skip_depth += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth += 1
+
+    def end(self, tag):
+        self.end_data()
+        if tag in SKIP_TEXT_TAGS:
+            self.skip_depth -= 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth -= 1
+
+    def data(self, data):
+        self.current.append(data)
+
+    def comment(self, text):
+        # comments, doctypes and PIs end the pending string but are not text themselves
+        self.end_data()
+
+    def doctype(self, name, pubid, system):
+        self.end_data()
+
+    def pi(self, target, data):
+        self.end_data()
+
+    def close(self):
+        self.end_data()
+        return self.strings
+
+
+def html_to_text_bs4(html):
     soup = BeautifulSoup(html, "lxml")
     for tag in soup(["script", "style", "noscript"]):
         tag.decompose()
     text = soup.get_text(separator="\n")
     return text
 
+def html_to_text(html):
+    """
+    Same text as html_to_text_bs4, streamed through an lxml target parser instead of a soup.
+    Reasoning: for large marketing/phishing html bodies, building and walking the bs4 tree was the
+    most expensive part of parsing. Falls back to the bs4 path if lxml rejects the markup.
+    """
+    # bs4 strips a leading BOM before handing str markup to lxml (lxml bug 1948551)
+    markup = html[1:] if html[:1] == "\ufeff" else html
+    try:
+        html_parser = etree.HTMLParser(target=HtmlTextTarget(), recover=True)
+        html_parser.feed(markup)
+        return "\n".join(html_parser.close())
+    except Exception:
+        return html_to_text_bs4(html)
+
 
 def safe_decode_payload(part):
     """
@@ -150,62 +318,131 @@ def extract_body_content(msg):
     Extract body content from email message, handling both simple and multipart messages.
     Returns tuple of (plain_text, html_text).
     """
+    body_plain, body_html, _ = extract_parts(msg)
+    return body_plain, body_html
+
+def extract_parts(msg, part_timings = None, max_attachment_bytes = None):
+    """
+    Single walk over the MIME tree that produces the plain text body, the html body and the attachments together.
+    Reasoning: deeply nested multipart spam can have hundreds of parts, and walking the tree once for the body
+    and again for attachments classified every part twice. Each part's content type and disposition are now
+    looked up once and used for both.
+    Returns tuple of (plain_text, html_text, attachments).
+    If part_timings is a list, a (content_type, seconds) pair is appended to it for every non-multipart part.
+    Attachments bigger than max_attachment_bytes come back with data set to None (see extract_attachment_info).
+    """
     body_plain = ""
     body_html = ""
+    attachments = []
+    is_multipart = msg.is_multipart()
     
-    if msg.is_multipart():
-        # Walk through all parts for multipart messages
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            
-            # Skip multipart containers or attachments
-            if part.get_content_maintype() == 'multipart' or part.get_content_disposition() == 'attachment':
-                continue
-            
+    for part in msg.walk():
+        if part_timings is not None:
+            t1 = time.perf_counter()
+        # Skip multipart containers (they're just structure)
+        if part.get_content_maintype() == 'multipart':
+            continue
+        content_type = part.get_content_type()
+        content_disposition = part.get_content_disposition()
+
+        if is_multipart:
+            # Body text comes from every text part that isn't an attachment
+            if content_disposition != 'attachment':
+                try:
+                    if content_type == 'text/plain':
+                        body_plain += safe_decode_payload(part)
+                    elif content_type == 'text/html':
+                        body_html += safe_decode_payload(part)
+                except Exception:
+                    pass
+        else:
+            # Simple non-multipart message, walk() only yields the message itself
             try:
                 if content_type == 'text/plain':
-                    body_plain += safe_decode_payload(part)
+                    body_plain = safe_decode_payload(part)
                 elif content_type == 'text/html':
-                    body_html += safe_decode_payload(part)
+                    body_html = safe_decode_payload(part)
+                elif part.get_content_maintype() == 'text':
+                    # Fallback for other text types
+                    body_plain = safe_decode_payload(part)
             except Exception:
-                continue
-    else:
-        # Simple non-multipart message
-        content_type = msg.get_content_type()
-        try:
-            if content_type == 'text/plain':
-                body_plain = safe_decode_payload(msg)
-            elif content_type == 'text/html':
-                body_html = safe_decode_payload(msg)
-            elif msg.get_content_maintype() == 'text':
-                # Fallback for other text types
-                body_plain = safe_decode_payload(msg)
-        except Exception:
-            pass
+                pass
+
+        if content_disposition == 'attachment' or content_disposition == 'inline':
+            # Inline can be images embedded in HTML - often need analysis too
+            attachment_info = extract_attachment_info(part, content_type, content_disposition, max_attachment_bytes)
+            if attachment_info:
+                attachments.append(attachment_info)
+
+        if part_timings is not None:
+            part_timings.append((content_type, time.perf_counter() - t1))
     
-    return body_plain, body_html
+    return body_plain, body_html, attachments
 
-def parse_eml(path_to_eml):
-    with open(path_to_eml, "rb") as f:
-        raw = f.read()
+def parse_eml(path_to_eml, og_fname = None, attachment_store = None, part_timing = False, max_message_bytes = None, max_attachment_bytes = None):
+    # The file is memory mapped rather than read, see io_helpers.map_source
+    with map_source(path_to_eml) as raw:
+        return parse_eml_bytes(raw, og_fname or os.path.basename(path_to_eml), attachment_store, part_timing, max_message_bytes, max_attachment_bytes)
 
-    msg = BytesParser(policy=policy.SMTP).parsebytes(raw)
-    headers_list = list(msg.keys())
+def parse_eml_bytes(raw, og_fname, attachment_store = None, part_timing = False, max_message_bytes = None, max_attachment_bytes = None):
+    """
+    Same as parse_eml, but for message bytes that were already read,
+    e.g. a message streamed out of an mbox, tar or zip container.
+    If attachment_store is given, attachment bytes are written there (see io_helpers.store_blob)
+    and only their hash and size are kept in the output instead of data_base64.
+    With part_timing, a "mime_timing" entry records the part count, the total time spent in the
+    MIME walk and the time spent per part, to track down pathological messages.
+    Messages over max_message_bytes only get their headers parsed and are marked "truncated", and
+    attachments over max_attachment_bytes are recorded by hash and size only, marked "oversized".
+    """
+    return parse_eml_message(raw, og_fname, attachment_store, part_timing, max_message_bytes, max_attachment_bytes)[0]
 
-    split_marker = b"\r\n\r\n"
-    alt_split = b"\n\n"
-    if split_marker in raw:
-        raw_headers_bytes, _ = raw.split(split_marker, 1)
-    elif alt_split in raw:
-        raw_headers_bytes, _ = raw.split(alt_split, 1)
+# bytes handed to the feed parser at a time
+PARSER_CHUNK_SIZE = 1 << 16
+
+def find_header_end(raw):
+    # Same split as before: the first blank CRLF line, else the first blank LF line, else no body at all
+    header_end = raw.find(b"\r\n\r\n")
+    if header_end == -1:
+        header_end = raw.find(b"\n\n")
+    if header_end == -1:
+        header_end = len(raw)
+    return header_end
+
+def parse_message(raw, end = None):
+    """
+    Parses raw[:end] (bytes or an mmap) with a feed parser, a chunk at a time.
+    Reasoning: BytesParser.parsebytes decodes the whole message into one str before parsing, a second
+    full copy of it. Feeding chunks builds the identical message without that copy, and feeding
+    only the header bytes gives a headers only message.
+    """
+    feed_parser = BytesFeedParser(policy=policy.SMTP)
+    end = len(raw) if end is None else end
+    for i in range(0, end, PARSER_CHUNK_SIZE):
+        feed_parser.feed(raw[i:min(i + PARSER_CHUNK_SIZE, end)])
+    return feed_parser.close()
+
+def parse_eml_message(raw, og_fname, attachment_store = None, part_timing = False, max_message_bytes = None, max_attachment_bytes = None):
+    # Returns the parsed dict along with the EmailMessage it was built from, for callers
+    # (like the fused pipeline) that compute features from the message without re-parsing
+    header_end = find_header_end(raw)
+    truncated = max_message_bytes is not None and len(raw) > max_message_bytes
+    if truncated:
+        # Oversized message: the body and attachments are never handed to the parser
+        header_end = min(header_end, max_message_bytes)
+        msg = parse_message(raw, header_end)
     else:
-        raw_headers_bytes = raw
-    
-    # Decode raw headers safely
-    raw_headers_str = raw_headers_bytes.decode('utf-8', errors='replace')
-    # 2) Parse the message with a modern policy so decoding is handled for you
+        msg = parse_message(raw)
+    headers_list = list(msg.keys())
+
+    # Decode raw headers safely, straight out of the source buffer so the body is never copied
+    with memoryview(raw) as view, view[:header_end] as header_view:
+        raw_headers_str = str(header_view, 'utf-8', 'replace')
 
-    body_plain, body_html = extract_body_content(msg)
+    part_timings = [] if part_timing else None
+    t1 = time.perf_counter()
+    body_plain, body_html, attachments = extract_parts(msg, part_timings, max_attachment_bytes)
+    walk_seconds = time.perf_counter() - t1
 
     if body_plain:
         body_text = body_plain
@@ -216,24 +453,35 @@ def parse_eml(path_to_eml):
     
     body_text = body_text.strip()
 
-    attachments = extract_attachments(msg)
-
-    attachment_data = [
-        {
+    attachment_data = []
+    for att in attachments:
+        att_dict = {
             'filename': att['filename'],
             'content_type': att['content_type'],
-            'hash': att['hash'],
-            'data_base64': base64.b64encode(att['data']).decode('ascii')
+            'hash': att['hash']
         }
-        for att in attachments
-    ]
+        if att['data'] is None:
+            # over max_attachment_bytes, there are no bytes to inline or store
+            att_dict['size'] = att['size']
+            att_dict['oversized'] = True
+        elif attachment_store:
+            store_blob(attachment_store, att['hash'], att['data'])
+            att_dict['size'] = att['size']
+        else:
+            att_dict['data_base64'] = base64.b64encode(att['data']).decode('ascii')
+        attachment_data.append(att_dict)
 
 
     email_id = str(uuid.uuid4())
-    return {"email_id":email_id,"header_list":",".join(headers_list), "raw_headers":raw_headers_str, "body":body_text, "og_fname":os.path.basename(path_to_eml), "attachments":attachment_data}
+    out_dict = {"email_id":email_id,"header_list":",".join(headers_list), "raw_headers":raw_headers_str, "body":body_text, "og_fname":og_fname, "attachments":attachment_data}
+    if truncated:
+        out_dict["truncated"] = True
+    if part_timing:
+        out_dict["mime_timing"] = {"part_count": len(part_timings), "walk_seconds": walk_seconds, "parts": part_timings}
+    return out_dict, msg
 
 def write_out(outname, out_d):
-    with open(outname, "a", encoding="utf-8") as wf:
+    with open_stream(outname, "a") as wf:
         wf.write(ujson.dumps(out_d, ensure_ascii=False)+ "\n")
 
 
@@ -262,41 +510,138 @@ def get_flist_abspath(flist):
     return abspath_list
 
 
-def parsing_wrapper(infile, outfile = "", debug = False, sample = False):
-    if not outfile:
-        outfile = change_filename(infile, "json", "parsed")
-    elif os.path.exists(outfile):
-        if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
-            os.remove(outfile)
+@contextmanager
+def open_job(job, hash_sources = False):
+    # Yields the job's message bytes (memory mapped for files, see io_helpers.map_source)
+    og_fname, src, entry = job
+    with map_source(src) as raw:
+        if hash_sources:
+            entry["hash"] = hashlib.sha256(raw).hexdigest()
+        yield raw
+
+def _parse_worker(job, hash_sources = False, **parse_options):
+    og_fname, _, entry = job
+    try:
+        with open_job(job, hash_sources) as raw:
+            return entry, parse_eml_bytes(raw, og_fname, **parse_options)
+    except Exception as e:
+        print(f"Error processing {og_fname}: {e}")
+        raise e
+
+
+def get_manifest_fname(outfile):
+    # from the whole output path, change_filename only keeps the name up to its first dot (run.1.json, run.2.json)
+    return os.path.splitext(outfile)[0] + "_manifest.json"
+
+def remove_output(outfile):
+    # The manifest and index describe what is in the output file, so they go with it
+    os.remove(outfile)
+    for fname in [get_manifest_fname(outfile), index_fname(outfile)]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def iter_jobs(sources, manifest, resume, skipped):
+    # sources are get_sources (og_fname, path or bytes, container) triples
+    for og_fname, src, container in sources:
+        entry = get_source_entry(og_fname, src, container)
+        if resume and manifest.is_done(entry, src):
+            skipped[0] += 1
+            continue
+        yield og_fname, src, entry
+
+
+def iter_parsed(jobs, workers = 1, ordered = False, chunksize = 64, hash_sources = False, worker = _parse_worker, **parse_options):
+    """
+    Yields (manifest entry, parsed dict) for every (og_fname, path or bytes, entry) job,
+    or whatever else the given worker function returns per job.
+    Reasoning: parsing is CPU bound (MIME parsing, html to text, sha256, base64), so with
+    workers > 1 the files are spread across a process pool. Results stream back here so
+    a single writer still owns the output file. ordered=True keeps input order at the cost
+    of waiting on slow files; unordered yields whichever file finishes first.
+    parse_options are passed through to parse_eml_bytes.
+    """
+    worker = partial(worker, hash_sources=hash_sources, **parse_options)
+    if workers <= 1:
+        for job in jobs:
+            yield worker(job)
+        return
+    with Pool(workers) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        yield from imap(worker, jobs, chunksize)
+
+
+def get_sources(infile, sample = False, exts = None):
+    # exts only filters the files of a directory input, Maildir message names have no extension
+    if exts:
+        # "eml" and ".EML" both match file.eml
+        exts = tuple("." + ext.lower().lstrip(".") for ext in exts)
     if not all(os.path.isfile(fname) for fname in infile) and os.path.isdir(infile[0]):
         dirname = infile[0]
         print(f"Input directory detected: {dirname}")
 #        infile = find_all_of_filetype(dirname, ".eml")
 #        san_list = sanitize_flist(os.listdir(dirname), "eml")
 #        infile = get_flist_abspath(san_list)
-        infile = get_all_files_from_dir(dirname)
+        maildir = is_maildir(dirname)
+        # the directory is streamed, so parsing starts on the first path instead of after a full listing
+        if maildir:
+            print("Maildir layout detected, reading messages from cur/ and new/")
+            infile = iter_maildir_files(dirname)
+        else:
+            infile = iter_files_from_dir(dirname, exts)
         if sample:
-            infile = get_sample(infile, sample)
-        print(f"{len(infile)} Files detected in {dirname}")
+            infile = reservoir_sample(infile, int(sample))
+            print(f"{len(infile)} Files sampled from {dirname}")
+        else:
+            print(f"Streaming files from {dirname}")
+        if maildir:
+            maildir_name = os.path.basename(os.path.normpath(dirname))
+            sources = ((f"{maildir_name}:{os.path.relpath(fname, dirname)}", fname, None) for fname in infile)
+        else:
+            sources = iter_source_members(infile)
+    else:
+        sources = iter_source_members(infile)
+    return sources
+
+
+def parse_all(infile, outfile, debug = False, sample = False, label = None, workers = 1, ordered = False, attachment_store = None, resume = False, manifest_hash = False, part_timing = False, max_message_bytes = None, max_attachment_bytes = None, format = "jsonl", index = False, exts = None):
+    sources = get_sources(infile, sample, exts)
+    if workers > 1:
+        print(f"Parsing with {workers} worker processes ({'ordered' if ordered else 'unordered'} output)")
+    if resume:
+        truncate_partial_line(outfile)
+    skipped = [0]
     t1 = time.time()
-    for i, name in enumerate(infile):
-        try:
-            out_dict = parse_eml(name)
-        except Exception as e:
-            print(f"Error processing {os.path.basename(name)}: {e}")
-            raise e
-        write_out(outfile, out_dict)
-        if i % 1000 == 0 and i != 0:
-            t2 = time.time()
-            print(f"{i} EML files processed at {str(i / (t2-t1))[:8]} per second")
-        if debug:
-            print(f"Headers: {out_dict["header_list"]}")
-            print(f"Raw Headers: {out_dict["raw_headers"]}")
-            print(f"\nBody Text: \n{out_dict["body"][:500]}")
-    
+    with Manifest(get_manifest_fname(outfile), manifest_hash) as manifest, open_writer(outfile, format, PARSED_FIELDS, "a", manifest.flush, PARSED_ROW_GROUP_SIZE, INDEX_KEYS if index else None) as writer:
+        jobs = iter_jobs(sources, manifest, resume, skipped)
+        for i, (entry, out_dict) in enumerate(iter_parsed(jobs, workers, ordered, hash_sources=manifest_hash, attachment_store=attachment_store, part_timing=part_timing, max_message_bytes=max_message_bytes, max_attachment_bytes=max_attachment_bytes)):
+            if label:
+                out_dict["label"] = label
+            # recorded before the write, which can flush the output and the manifest with it
+            manifest.record(entry)
+            writer.write(out_dict)
+            if i % 1000 == 0 and i != 0:
+                t2 = time.time()
+                print(f"{i} EML files processed at {str(i / (t2-t1))[:8]} per second")
+            if debug:
+                print(f"Headers: {out_dict["header_list"]}")
+                print(f"Raw Headers: {out_dict["raw_headers"]}")
+                print(f"\nBody Text: \n{out_dict["body"][:500]}")
+    if resume:
+        print(f"{skipped[0]} already parsed files skipped")
+
     return outfile
 
 
+def parsing_wrapper(infile, outfile = "", debug = False, sample = False, workers = 1, ordered = False, attachment_store = None, resume = False, manifest_hash = False, part_timing = False, max_message_bytes = None, max_attachment_bytes = None, format = "jsonl", index = False, exts = None):
+    if not outfile:
+        outfile = change_filename(infile[0], OUTPUT_FORMATS[format], "parsed")
+    if os.path.exists(outfile) and not resume:
+        if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
+            remove_output(outfile)
+
+    return parse_all(infile, outfile, debug, sample, workers=workers, ordered=ordered, attachment_store=attachment_store, resume=resume, manifest_hash=manifest_hash, part_timing=part_timing, max_message_bytes=max_message_bytes, max_attachment_bytes=max_attachment_bytes, format=format, index=index, exts=exts)
+
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -305,36 +650,24 @@ if __name__ == '__main__':
     debug = args.debug
     sample = args.sample
     label = args.label
+    workers = args.workers
+    ordered = args.ordered
+    attachment_store = args.attachment_store
+    resume = args.resume
+    manifest_hash = args.manifest_hash
+    part_timing = args.part_timing
+    max_message_bytes = args.max_message_bytes
+    max_attachment_bytes = args.max_attachment_bytes
+    format = args.format
+    if resume and format == "parquet":
+        parser.error("--resume needs --format jsonl, a parquet file can not be appended to")
+    if args.index and format == "parquet":
+        parser.error("--index needs --format jsonl, a parquet row has no byte offset")
     if not outfile:
-        outfile = "default_out.json"
-    elif os.path.exists(outfile):
+        outfile = "default_out." + OUTPUT_FORMATS[format]
+    elif is_compressed(outfile) and (resume or args.index):
+        parser.error("--resume and --index need an uncompressed output, a compressed file can not be appended to in place or read at an offset")
+    elif os.path.exists(outfile) and not resume:
         if input(f"please enter anything if you want to first delete the existing output file {outfile}: \n"):
-            os.remove(outfile)
-    if not all(os.path.isfile(fname) for fname in infile) and os.path.isdir(infile[0]):
-        dirname = infile[0]
-        print(f"Input directory detected: {dirname}")
-#        infile = find_all_of_filetype(dirname, ".eml")
-#        san_list = sanitize_flist(os.listdir(dirname), "eml")
-#        infile = get_flist_abspath(san_list)
-        infile = get_all_files_from_dir(dirname)
-        if sample:
-            infile = get_sample(infile, sample)
-        print(f"{len(infile)} Files detected in {dirname}")
-    t1 = time.time()
-    for i, name in enumerate(infile):
-        try:
-            out_dict = parse_eml(name)
-            if label:
-                out_dict["label"] = label
-
-        except Exception as e:
-            print(f"Error processing {os.path.basename(name)}: {e}")
-            raise e
-        write_out(outfile, out_dict)
-        if i % 1000 == 0 and i != 0:
-            t2 = time.time()
-            print(f"{i} EML files processed at {str(i / (t2-t1))[:8]} per second")
-        if debug:
-            print(f"Headers: {out_dict["header_list"]}")
-            print(f"Raw Headers: {out_dict["raw_headers"]}")
-            print(f"\nBody Text: \n{out_dict["body"][:500]}")
\ No newline at end of file
+            remove_output(outfile)
+    parse_all(infile, outfile, debug, sample, label, workers, ordered, attachment_store, resume, manifest_hash, part_timing, max_message_bytes, max_attachment_bytes, format, args.index, args.extensions)
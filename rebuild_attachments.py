@@ -1,6 +1,6 @@
 import argparse
 import ujson
-from io_helpers import get_sample, get_all_files_from_dir, change_filename
+from io_helpers import get_sample, get_all_files_from_dir, change_filename, read_blob, open_stream
 import hashlib
 import base64
 import uuid
@@ -16,16 +16,30 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", help="The name of the file to fix", required=True)
 parser.add_argument("--bucket", "-b", help="bucket to upload to", required=False)
 parser.add_argument("--upload", "-u", help="upload file", action="store_true", required=False)
+parser.add_argument("--attachment-store", "-a", help="attachment store directory used by parse_emails.py -a, for lines without data_base64", required=False)
 
 
 
-def rebuild_attachments(infile, bucket, upload):
+def get_attachment_bytes(attachment, attachment_store = None):
+    # Lines parsed with an attachment store only carry the hash, the bytes live in the store
+    if "data_base64" in attachment:
+        return base64.b64decode(attachment["data_base64"])
+    if not attachment_store:
+        raise ValueError(f"attachment {attachment['hash']} has no inline data, specify the attachment store it was written to")
+    return read_blob(attachment_store, attachment["hash"])
+
+
+def rebuild_attachments(infile, bucket, upload, attachment_store = None):
     c = 0
-    with open(infile, "r") as f:
+    with open_stream(infile) as f:
         for line in f:
             temp_d = ujson.loads(line)
             if "attachments" in temp_d:
                 for attachment in temp_d["attachments"]:
+                    if attachment.get("oversized"):
+                        # over --max-attachment-bytes when parsed, only the hash and size were kept
+                        print(f"Skipping oversized attachment {attachment['filename']} ({attachment['hash']})")
+                        continue
                     if upload:
                         if c == 1:
                             exit()
@@ -35,7 +49,7 @@ def rebuild_attachments(infile, bucket, upload):
                             unique_filename = f"test_attachments/{temp_d["email_id"]}/{attachment['filename']}"
                             
                             # Upload the attachment data to S3
-                            s3.put_object(Bucket=bucket, Key=unique_filename, Body=base64.b64decode(attachment["data_base64"]))
+                            s3.put_object(Bucket=bucket, Key=unique_filename, Body=get_attachment_bytes(attachment, attachment_store))
                             c += 1
                             
                         except ClientError as e:
@@ -49,4 +63,5 @@ if __name__ == '__main__':
     infile = args.input
     bucket = args.bucket
     upload = args.upload
-    rebuild_attachments(infile, bucket, upload)
\ No newline at end of file
+    attachment_store = args.attachment_store
+    rebuild_attachments(infile, bucket, upload, attachment_store)
\ No newline at end of file
@@ -0,0 +1,190 @@
+import math
+import heapq
+from hashlib import blake2b
+
+'''
+Mergeable, fixed size summaries of a stream of values, for profiling datasets too big to hold (check_dataset.py).
+
+Every summary has add(value) and merge(other): a file can be cut into chunks, each chunk summarized in its own
+process, and the summaries merged into the summary of the whole file.
+    HyperLogLog: estimated number of distinct values, in 2 ** precision bytes
+    SpaceSaving: the k most frequent values and their counts, exact while there are at most k distinct values
+    Histogram: count, min, max, mean and a power of two histogram of numbers
+'''
+
+
+def hash64(data):
+    # a 64 bit hash that is the same in every process (python's hash() of a str is salted per process)
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little")
+
+
+class HyperLogLog:
+    """
+    Distinct count estimate with a standard error of about 1.04 / sqrt(2 ** precision) (0.8% at the default 14).
+    add takes bytes, hashed with hash64.
+    """
+    def __init__(self, precision = 14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, data):
+        h = hash64(data)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # position of the first 1 bit of the remaining bits
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities: linear counting on the empty registers is more accurate
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class SpaceSaving:
+    """
+    The (at most) k most frequent values, with counts that overestimate by at most their error. While no more than
+    k distinct values were added every count is exact (exact() is True).
+    Reasoning: a Counter of a field like body or email_id holds every distinct value. Here a new value that does not
+    fit replaces the least frequent one and inherits its count as its error (Metwally et al.), so memory stays at k
+    values whatever the cardinality. The least frequent value is found with a heap that is only updated lazily:
+    counts only grow, so an entry that is out of date is pushed back with its current count when it is popped.
+    """
+    def __init__(self, k = 20):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        self.evicted = False
+        # (count when pushed, tie breaker, value), built at the first eviction
+        self._heap = None
+        self._pushes = 0
+
+    def add(self, value, count = 1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+        elif len(counts) < self.k:
+            counts[value] = count
+            self.errors[value] = 0
+        else:
+            floor = self._pop_smallest()
+            counts[value] = floor + count
+            self.errors[value] = floor
+            self._push(floor + count, value)
+            self.evicted = True
+
+    def _pop_smallest(self):
+        # removes the value with the smallest count and returns that count
+        counts = self.counts
+        heap = self._heap
+        if heap is None:
+            heap = self._heap = [(c, i, value) for i, (value, c) in enumerate(counts.items())]
+            heapq.heapify(heap)
+            self._pushes = len(heap)
+        while True:
+            c, _, value = heapq.heappop(heap)
+            current = counts.get(value)
+            if current == c:
+                del counts[value]
+                del self.errors[value]
+                return c
+            if current is not None:
+                self._push(current, value)
+
+    def _push(self, c, value):
+        # the push number breaks ties, values of different types do not compare
+        self._pushes += 1
+        heapq.heappush(self._heap, (c, self._pushes, value))
+
+    def merge(self, other):
+        """
+        Mergeable summaries (Agarwal et al.): a value missing from a full summary may have had up to its smallest
+        count there, so that count is added to both its count and its error. The k largest are kept.
+        """
+        floors = [min(s.counts.values()) if s.evicted else 0 for s in (self, other)]
+        counts = {}
+        errors = {}
+        # in first seen order, so ties keep the order a single summary of both would have
+        for value in list(self.counts) + [value for value in other.counts if value not in self.counts]:
+            counts[value] = 0
+            errors[value] = 0
+            for s, floor in zip((self, other), floors):
+                if value in s.counts:
+                    counts[value] += s.counts[value]
+                    errors[value] += s.errors[value]
+                else:
+                    counts[value] += floor
+                    errors[value] += floor
+        kept = set(sorted(counts, key=counts.get, reverse=True)[:self.k])
+        self.evicted = self.evicted or other.evicted or len(counts) > self.k
+        # still in first seen order, for the next merge
+        self.counts = {value: counts[value] for value in counts if value in kept}
+        self.errors = {value: errors[value] for value in counts if value in kept}
+        self._heap = None
+
+    def exact(self):
+        return not self.evicted
+
+    def top(self, n = None):
+        # [(value, count, error)] most frequent first
+        ordered = sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+        return [(value, self.counts[value], self.errors[value]) for value in ordered]
+
+
+class Histogram:
+    """
+    Count, sum, min and max of numbers and how many fell in each power of two bucket: bucket e (-e for negative
+    numbers) holds 2 ** (e - 1) <= |x| < 2 ** e, bucket 0 holds the zeros. Infinities and NaN are only counted.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.non_finite = 0
+        self.buckets = {}
+
+    def add(self, x):
+        if not math.isfinite(x):
+            self.non_finite += 1
+            return
+        self.count += 1
+        self.total += x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        exponent = math.frexp(x)[1] if x else 0
+        bucket = exponent if x >= 0 else -exponent
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.non_finite += other.non_finite
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def bins(self):
+        # [(low, high, count)] in ascending order of value, which is the order of the bucket numbers
+        out = []
+        for bucket in sorted(self.buckets):
+            if bucket == 0:
+                out.append((0, 0, self.buckets[bucket]))
+            else:
+                low, high = 2.0 ** (abs(bucket) - 1), 2.0 ** abs(bucket)
+                out.append((low, high, self.buckets[bucket]) if bucket > 0 else (-high, -low, self.buckets[bucket]))
+        return out
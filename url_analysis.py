@@ -0,0 +1,194 @@
+import ipaddress
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from url_scanner import extract_urls
+
+'''
+Host and domain analysis for the URL features of the body feature extractors (extract_body_features.py and
+extract_body_features_lambda.py).
+
+Registered domains come from a local public suffix trie, built from a short list of multi label suffixes (any other
+host falls back to the PSL default rule, its last label is the suffix). To use the full Public Suffix List instead,
+download https://publicsuffix.org/list/public_suffix_list.dat next to this file, it is loaded at import when present.
+analyze_host is cached per host, so the hosts campaign mail repeats thousands of times are only analyzed once.
+'''
+
+URL_SHORTENERS = {
+    'bit.ly', 'bitly.com', 'tinyurl.com', 'goo.gl', 't.co', 'ow.ly', 'is.gd', 'buff.ly', 'adf.ly', 'bit.do',
+    'cutt.ly', 'rebrand.ly', 'shorturl.at', 'tiny.cc', 'rb.gy', 't.ly', 'lnkd.in', 'x.co', 'v.gd', 's.id',
+    'soo.gd', 'clck.ru', 'qr.ae', 'shorte.st', 'bl.ink', 'tr.im', 'cli.gs', 'short.io', 'mcaf.ee', 'db.tt'
+}
+
+# TLDs that are cheap or free to register and dominate phishing and spam domain reports
+SUSPICIOUS_TLDS = {
+    'tk', 'ml', 'ga', 'cf', 'gq', 'xyz', 'top', 'work', 'click', 'link', 'zip', 'mov', 'review', 'country',
+    'kim', 'loan', 'men', 'date', 'racing', 'win', 'download', 'stream', 'party', 'gdn', 'bid', 'trade',
+    'science', 'accountant', 'faith', 'cricket', 'rest', 'icu', 'cyou', 'buzz', 'monster', 'cam', 'quest', 'sbs',
+    'support', 'online', 'site', 'live', 'shop', 'fit', 'surf'
+}
+
+# hosts with more labels than this in front of their registered domain count as excessive subdomains
+MAX_SUBDOMAINS = 2
+
+# Multi label public suffixes (PSL format) for the country code registries and hosting platforms seen most in mail.
+# Single label TLDs do not need rules, the PSL default rule already treats the last label as the suffix.
+PUBLIC_SUFFIX_RULES = [
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'ltd.uk', 'plc.uk', 'me.uk', 'net.uk', 'nhs.uk', 'police.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'id.au', 'asn.au',
+    'co.nz', 'net.nz', 'org.nz', 'govt.nz', 'ac.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'ad.jp', 'ed.jp', 'gr.jp', 'lg.jp',
+    'com.br', 'net.br', 'org.br', 'gov.br', 'edu.br',
+    'com.cn', 'net.cn', 'org.cn', 'gov.cn', 'edu.cn',
+    'co.in', 'net.in', 'org.in', 'gov.in', 'ac.in', 'firm.in', 'gen.in', 'ind.in',
+    'co.za', 'org.za', 'gov.za', 'ac.za', 'web.za',
+    'com.mx', 'org.mx', 'gob.mx', 'edu.mx', 'net.mx',
+    'com.ar', 'org.ar', 'gob.ar', 'net.ar',
+    'com.tr', 'org.tr', 'gov.tr', 'net.tr', 'edu.tr',
+    'co.kr', 'or.kr', 'go.kr', 'ac.kr', 'ne.kr',
+    'com.tw', 'org.tw', 'gov.tw', 'net.tw', 'edu.tw',
+    'com.hk', 'org.hk', 'gov.hk', 'net.hk', 'edu.hk',
+    'com.sg', 'org.sg', 'gov.sg', 'net.sg', 'edu.sg',
+    'com.my', 'org.my', 'gov.my', 'net.my',
+    'com.ph', 'org.ph', 'gov.ph', 'net.ph',
+    'com.vn', 'org.vn', 'gov.vn', 'net.vn',
+    'co.il', 'org.il', 'ac.il', 'gov.il', 'net.il',
+    'co.th', 'in.th', 'ac.th', 'go.th', 'or.th',
+    'co.id', 'or.id', 'ac.id', 'go.id', 'web.id',
+    'com.ua', 'co.ua', 'org.ua', 'gov.ua', 'net.ua',
+    'com.pl', 'net.pl', 'org.pl', 'gov.pl',
+    'com.ru', 'org.ru', 'net.ru',
+    'com.es', 'org.es', 'gob.es', 'com.gr', 'com.pt', 'co.at', 'or.at', 'gv.at', 'com.ng', 'co.ke', 'com.pk',
+    'com.sa', 'com.eg', 'co.ae', 'com.co', 'com.pe', 'com.ve', 'com.ec', 'com.uy', 'co.ve', 'co.cr',
+    # hosting and free subdomain platforms, anyone can get a subdomain under these
+    'github.io', 'gitlab.io', 'blogspot.com', 'herokuapp.com', 'appspot.com', 'azurewebsites.net',
+    'cloudfront.net', 'netlify.app', 'vercel.app', 'pages.dev', 'workers.dev', 'firebaseapp.com', 'web.app',
+    'glitch.me', '000webhostapp.com', 'weebly.com', 'wixsite.com', 'duckdns.org', 'ngrok.io', 'ngrok-free.app',
+    's3.amazonaws.com', 'r2.dev', 'repl.co', 'onrender.com', 'fly.dev', 'myshopify.com', 'sharepoint.com',
+    # wildcard and exception rules, as in the PSL
+    '*.ck', '!www.ck', '*.bd', '*.np', '*.er', '*.fk', '*.jm', '*.kh', '*.mm', '*.pg',
+]
+PUBLIC_SUFFIX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat")
+
+HOST_PART = re.compile(r'(?:https?://)?([^/?#]*)', re.IGNORECASE)
+# extract_urls needs a TLD, so http(s) URLs with an IP address host are found separately
+IP_URL = re.compile(r'https?://(\d{1,3}(?:\.\d{1,3}){3}|\[[0-9a-f:.]+\])(?![\w-]|\.[\w-])(?:[:/?#][^\s<>"{}|\\^`\[\]]*)?', re.IGNORECASE)
+# a link in the "text <url>" form mail clients use for the plain text version of an html link
+ANGLE_LINK = re.compile(r'<(https?://[^\s<>"]+)>', re.IGNORECASE)
+# how far back from a link its text is looked for
+LINK_TEXT_WINDOW = 256
+TRAILING_PUNCTUATION = '.,;!?)]'
+
+HostInfo = namedtuple("HostInfo", ["is_ip", "public_suffix", "registered_domain", "subdomain_count", "is_shortener", "has_suspicious_tld"])
+
+
+def load_public_suffix_list(fname):
+    # the rules of a public_suffix_list.dat, one per line, without comments
+    rules = []
+    with open(fname, "r", encoding="utf-8") as f:
+        for line in f:
+            rule = line.strip()
+            if rule and not rule.startswith("//"):
+                rules.append(rule.lower())
+    return rules
+
+
+def build_suffix_trie(rules):
+    """
+    Trie of public suffix rules keyed by label, rightmost label first. A node has "$" set if a rule ends there and
+    "!" set if an exception rule ends there. A wildcard rule (*.ck) is a "*" child.
+    """
+    trie = {}
+    for rule in rules:
+        exception = rule.startswith("!")
+        node = trie
+        for label in reversed(rule.lstrip("!").split(".")):
+            node = node.setdefault(label, {})
+        node["!" if exception else "$"] = True
+    return trie
+
+
+SUFFIX_TRIE = build_suffix_trie(load_public_suffix_list(PUBLIC_SUFFIX_FILE) if os.path.exists(PUBLIC_SUFFIX_FILE) else PUBLIC_SUFFIX_RULES)
+
+
+def public_suffix_length(labels):
+    # How many of the host's labels (rightmost) are its public suffix, by the PSL algorithm: an exception rule wins,
+    # otherwise the longest matching rule, otherwise the default rule "*" (just the last label)
+    node = SUFFIX_TRIE
+    length = 1
+    for depth, label in enumerate(reversed(labels), 1):
+        if "*" in node:
+            length = depth
+        child = node.get(label)
+        if child is None:
+            break
+        if "!" in child:
+            return depth - 1
+        if "$" in child:
+            length = depth
+        node = child
+    return length
+
+
+@lru_cache(maxsize=65536)
+def analyze_host(host):
+    """
+    Returns the HostInfo of a lowercase host name or IP address.
+    Reasoning: the same few hosts are repeated across thousands of emails of a campaign, so the result is cached per
+    host and each one is only split and looked up in the suffix trie once.
+    """
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return HostInfo(True, None, host, 0, False, False)
+    except ValueError:
+        pass
+    labels = host.split(".")
+    suffix_length = public_suffix_length(labels)
+    public_suffix = ".".join(labels[-suffix_length:])
+    if len(labels) > suffix_length:
+        registered_domain = ".".join(labels[-suffix_length - 1:])
+        subdomain_count = len(labels) - suffix_length - 1
+    else:
+        # the host is itself a public suffix
+        registered_domain = None
+        subdomain_count = 0
+    is_shortener = host in URL_SHORTENERS or registered_domain in URL_SHORTENERS
+    return HostInfo(False, public_suffix, registered_domain, subdomain_count, is_shortener, labels[-1] in SUSPICIOUS_TLDS)
+
+
+def url_host(url):
+    # the lowercase host of a URL as extract_urls returns it, with or without a scheme
+    return HOST_PART.match(url).group(1).lower()
+
+
+def link_domain(url):
+    # what a link points at, for comparing links: the registered domain, or the host if it has none
+    host = url_host(url)
+    return analyze_host(host).registered_domain or host
+
+
+def find_ip_urls(text):
+    # the distinct http(s) URLs in text whose host is an IP address, trailing .,;!?)] removed like extract_urls
+    urls = []
+    for match in IP_URL.finditer(text):
+        url = match.group().rstrip(TRAILING_PUNCTUATION)
+        if url not in urls and analyze_host(match.group(1)).is_ip:
+            urls.append(url)
+    return urls
+
+
+def has_misleading_link_text(text):
+    """
+    True if a link written as "text <url>" has text that is itself a URL or domain, on a different domain than the
+    link. e.g. "www.paypal.com <http://paypal.account-check.xyz/login>"
+    """
+    for link in ANGLE_LINK.finditer(text):
+        shown = text[max(0, link.start() - LINK_TEXT_WINDOW):link.start()].split()
+        if not shown:
+            continue
+        shown_urls = extract_urls(shown[-1].strip("\"'()[]:"))
+        if shown_urls and link_domain(shown_urls[0]) != link_domain(link.group(1)):
+            return True
+    return False
+
@@ -0,0 +1,149 @@
+import re
+
+'''
+Linear time URL extraction for the body feature extractors (extract_body_features.py and extract_body_features_lambda.py).
+
+scan_urls finds the same URLs as the original three regex extract_urls (kept here as extract_urls_regex for
+benchmark_url_scanner.py) and returns every normalized URL with its character offsets, extract_urls returns just the
+URLs like before. http(s) URLs are found from the scheme, the protocol-less and www. URLs only at the start of the
+whitespace separated tokens that contain a '.', and no label is matched more than once, so the work is linear in the
+length of the body.
+'''
+
+COMMON_TLDS = ['com', 'org', 'net', 'edu', 'gov', 'mil', 'co', 'io', 'ai', 'app', 'dev', 'tech', 'info', 'biz', 'name',
+               'pro', 'xyz', 'online', 'site', 'website', 'store', 'shop', 'blog', 'news', 'media', 'tv', 'me', 'us', 'uk',
+               'ca', 'au', 'de', 'fr', 'jp', 'cn', 'in', 'br', 'ru', 'it', 'es', 'nl', 'se', 'no', 'dk', 'fi', 'pl', 'be',
+               'ch', 'at', 'cz', 'gr', 'pt', 'ie', 'nz', 'sg', 'hk', 'kr', 'tw', 'th', 'my', 'id', 'ph', 'vn', 'za', 'ae',
+               'il', 'tr', 'mx', 'ar', 'cl']
+LABEL = r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?'
+PATH = r'[/?#][^\s<>"{}|\\^`\[\]]*'
+URL_END = r'(?=\s|$|[,;!?)])'
+TRAILING_PUNCTUATION = '.,;!?)]'
+
+# A token (run of non whitespace) that contains a '.', every URL lies inside one
+DOTTED_TOKEN = re.compile(r'(?<!\S)[^\s.]*+\.\S*+')
+SCHEME = re.compile(r'https?://', re.IGNORECASE)
+# A label runs from where it starts to the next '.', so a chain of labels is fixed by where it starts, and the
+# possessive *+ finds the same labels the original greedy repeat did. What it drops is the original retrying with
+# fewer labels when what follows did not match.
+LABELS = re.compile(rf'(?:{LABEL}\.)*+', re.IGNORECASE)
+LETTERS = re.compile(r'[a-zA-Z]{2,}+', re.IGNORECASE)
+PATH_AFTER_TLD = re.compile(PATH + '+', re.IGNORECASE)
+# the greedy .* makes this find the last '.' in a label chain that is followed by two letters
+LAST_LETTER_LABEL = re.compile(r'.*\.(?=[a-zA-Z]{2})', re.IGNORECASE)
+# For the protocol-less and www. patterns those retries can never match: with fewer labels the TLD (or final label)
+# ends inside a label, where neither a path nor the whitespace or punctuation the pattern ends with can follow. So
+# these are the original patterns with possessive label chains, matched only at token starts (the original
+# lookbehinds), which leaves a fixed number of TLD alternatives and final label lengths to backtrack over per token.
+BARE_URL = re.compile(rf'(?![\w.-]*+@)(?:{LABEL}\.)++(?:{"|".join(COMMON_TLDS)})(?:{PATH})?{URL_END}', re.IGNORECASE | re.MULTILINE)
+WWW_URL = re.compile(rf'www\.(?:{LABEL}\.)*+{LABEL}(?:{PATH})?{URL_END}', re.IGNORECASE | re.MULTILINE)
+
+
+def scan_urls(text):
+    """
+    Finds every URL in text, returns a list of (url, start, end) with text[start:end] == url.
+    URLs are normalized like extract_urls always did (trailing .,;!?)] removed) and deduplicated, the offsets are
+    those of the first occurrence. Ordered like the original: http(s) URLs, then protocol-less URLs, then www. URLs.
+    Reasoning: the original ran three findall passes that tried the protocol-less and www. patterns at every
+    character, and retried every shorter label chain when a match failed. Every URL lies inside one whitespace
+    separated token with a '.', so those are the only places the patterns are tried, and no label is scanned twice.
+    """
+    http_urls = []
+    bare_urls = []
+    www_urls = []
+    pos = 0
+    for scheme in SCHEME.finditer(text):
+        # matches do not overlap, a scheme inside the previous URL's path is part of it
+        if scheme.start() < pos:
+            continue
+        url_end = match_http(text, scheme.end())
+        if url_end is not None:
+            http_urls.append((scheme.start(), url_end))
+            pos = url_end
+    for token in DOTTED_TOKEN.finditer(text):
+        start = token.start()
+        url = BARE_URL.match(text, start)
+        if url is not None:
+            bare_urls.append(url.span())
+        url = WWW_URL.match(text, start)
+        if url is not None:
+            www_urls.append(url.span())
+
+    seen = set()
+    urls = []
+    for start, end in http_urls + bare_urls + www_urls:
+        url = text[start:end].rstrip(TRAILING_PUNCTUATION)
+        if url and url not in seen:
+            seen.add(url)
+            urls.append((url, start, start + len(url)))
+    return urls
+
+
+def extract_urls(text):
+    return [url for url, _, _ in scan_urls(text)]
+
+
+def match_http(text, host_start):
+    # Labels, a 2+ letter TLD and an optional path after https?://, returns the end offset or None
+    labels_end = LABELS.match(text, host_start).end()
+    if labels_end == host_start:
+        return None
+    tld = LETTERS.match(text, labels_end)
+    if tld is not None:
+        path = PATH_AFTER_TLD.match(text, tld.end())
+        return path.end() if path is not None else tld.end()
+    # This pattern has nothing after the optional path, so the original's retries with one label fewer do match,
+    # taking the letters at the start of the dropped label as the TLD, and the first retry that matches is the last
+    # label (before the final one) starting with two letters. A label character or '.' always follows those letters,
+    # so there is never a path.
+    label = LAST_LETTER_LABEL.match(text, host_start, labels_end - 1)
+    if label is not None:
+        return LETTERS.match(text, label.end()).end()
+    return None
+
+
+def extract_urls_regex(text):
+    """
+    The original three regex extract_urls, kept as the reference scan_urls is checked and benchmarked against
+    (benchmark_url_scanner.py).
+    """
+    urls = []
+
+    # Pattern 1: Explicit http/https URLs (high confidence)
+    # Matches: http://example.com, https://example.com/path
+    http_pattern = r'https?://(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}(?:[/?#][^\s<>"{}|\\^`\[\]]*)?'
+    http_urls = re.findall(http_pattern, text, re.IGNORECASE)
+    urls.extend(http_urls)
+
+    # Pattern 2: Protocol-less URLs with common TLDs (medium confidence)
+    # matching things like "see example.com in the documentation."
+    # We explicitly check for common TLDs to reduce false positives
+    common_tlds = r'(?:com|org|net|edu|gov|mil|co|io|ai|app|dev|tech|info|biz|name|pro|xyz|online|site|website|store|shop|blog|news|media|tv|me|us|uk|ca|au|de|fr|jp|cn|in|br|ru|it|es|nl|se|no|dk|fi|pl|be|ch|at|cz|gr|pt|ie|nz|sg|hk|kr|tw|th|my|id|ph|vn|za|ae|il|tr|mx|ar|cl)'
+
+    # Matches: example.com/path or subdomain.example.com
+    # Must be preceded by whitespace/start or followed by whitespace/end
+    # Does NOT match if @ symbol present (email addresses)
+    protocol_less_pattern = rf'(?:(?<=\s)|(?<=^))(?![\w.-]*@)(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{{0,61}}[a-zA-Z0-9])?\.)+(?:{common_tlds})(?:[/?#][^\s<>"{{}}|\\^`\[\]]*)?(?=\s|$|[,;!?)])'
+
+    protocol_less_urls = re.findall(protocol_less_pattern, text, re.IGNORECASE | re.MULTILINE)
+    urls.extend(protocol_less_urls)
+
+    # Pattern 3: www. prefixed URLs (high confidence)
+    www_pattern = r'(?:(?<=\s)|(?<=^))www\.(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)*[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:[/?#][^\s<>"{}|\\^`\[\]]*)?(?=\s|$|[,;!?)])'
+    www_urls = re.findall(www_pattern, text, re.IGNORECASE | re.MULTILINE)
+    urls.extend(www_urls)
+
+    # Deduplicate while preserving order
+    seen = set()
+    unique_urls = []
+    for url in urls:
+        url_clean = url.strip()
+        # Remove trailing punctuation that might have been captured
+        # Reasoning: URLs in sentences often end with periods/commas
+        url_clean = re.sub(r'[.,;!?)\]]+$', '', url_clean)
+
+        if url_clean and url_clean not in seen:
+            seen.add(url_clean)
+            unique_urls.append(url_clean)
+
+    return unique_urls
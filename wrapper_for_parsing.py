@@ -1,35 +1,179 @@
-from parse_emails import parsing_wrapper
-from extract_body_features import body_wrapper
-from extract_header_features import header_wrapper
-from io_helpers import change_filename
+from parse_emails import parsing_wrapper, get_sources, iter_jobs, iter_parsed, open_job, parse_eml_message, get_manifest_fname, remove_output, PARSED_FIELDS, PARSED_ROW_GROUP_SIZE
+from extract_body_features import body_wrapper, get_all_features as get_body_features
+from extract_header_features import header_wrapper, get_features_from_msg, headers_from_message
+from io_helpers import change_filename, JsonlWriter, Manifest, truncate_partial_line, open_writer, OUTPUT_FORMATS, ROW_GROUP_SIZE, INDEX_KEYS, is_compressed
+from feature_registry import BODY_FEATURES, HEADER_FEATURES, COSTS, parse_feature_list, select_groups
 import argparse
 import os
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input", "-i", nargs="+", help="The name of the file to fix", required=True)
 parser.add_argument("--output", "-o", help="The name of the file to output to", required=False)
 parser.add_argument("--debug", "-d", help="debug mode", action="store_true", required=False)
 parser.add_argument("--sample", "-s", help="use a sample of files instead of all files from dir, specify number of samples desired", required=False)
+parser.add_argument("--workers", "-w", type=int, default=1, help="number of worker processes to parse with (default 1, no pool)", required=False)
+parser.add_argument("--ordered", action="store_true", help="with --workers > 1, keep parsed lines in input order", required=False)
+parser.add_argument("--attachment-store", "-a", help="directory to write attachment bytes to instead of inlining them as base64", required=False)
+parser.add_argument("--resume", "-r", action="store_true", help="only parse files missing from the parse manifest and only extract features for the new parsed lines", required=False)
+parser.add_argument("--manifest-hash", action="store_true", help="also record a sha256 of every source in the parse manifest", required=False)
+parser.add_argument("--max-message-bytes", type=int, help="messages bigger than this only have their headers parsed, and are marked truncated", required=False)
+parser.add_argument("--max-attachment-bytes", type=int, help="attachments bigger than this are only recorded by hash and size, without their data", required=False)
+parser.add_argument("--fused", "-f", action="store_true", help="parse each email once and compute body and header features in the same pass, instead of re-reading the parsed file per stage", required=False)
+parser.add_argument("--joined", "-j", action="store_true", help="with --fused, write one joined record of email_id, og_fname, body features, header features and URLs per email instead of the three separate outputs", required=False)
+parser.add_argument("--features", type=parse_feature_list, help="comma separated body and/or header feature groups to compute, default all (see feature_registry.py)", required=False)
+parser.add_argument("--max-cost", choices=COSTS, help="skip the feature groups more expensive than this (see feature_registry.py)", required=False)
+parser.add_argument("--format", choices=OUTPUT_FORMATS, default="jsonl", help="format of the parsed and feature files, jsonl (default) or parquet (needs pyarrow). The URL list stays plain text", required=False)
+parser.add_argument("--index", action="store_true", help="also write an .idx index of every parsed, feature and joined file, from email_id and og_fname to the byte offset of the line, for lookup_email.py (jsonl only)", required=False)
+parser.add_argument("--extensions", "-e", nargs="+", help="with a directory input, only parse the files with these extensions (ex. -e eml mbox), checked before --sample. Not applied to Maildir messages", required=False)
 
 
 
 
-def fully_process(infile, outfile, debug, sample):
-    parsed_fname = parsing_wrapper(infile, outfile, debug, sample)
+def fully_process(infile, outfile, debug, sample, workers = 1, ordered = False, attachment_store = None, resume = False, manifest_hash = False, max_message_bytes = None, max_attachment_bytes = None, body_groups = None, header_groups = None, format = "jsonl", index = False, exts = None):
+    # With resume, the parse manifest decides which emails are new, and the feature stages
+    # only process the parsed lines they have not written features for yet
+    parsed_fname = parsing_wrapper(infile, outfile, debug, sample, workers, ordered, attachment_store, resume, manifest_hash, max_message_bytes=max_message_bytes, max_attachment_bytes=max_attachment_bytes, format=format, index=index, exts=exts)
     print("\n\n\t Initial Parsing completed. Begninning Body Feature + URL extraction\n")
-    body_features_fname, url_fname = body_wrapper(parsed_fname, change_filename(parsed_fname, "json", "body_features"), debug)
+    ext = OUTPUT_FORMATS[format]
+    body_features_fname, url_fname = body_wrapper(parsed_fname, change_filename(parsed_fname, ext, "body_features", format == "jsonl"), debug, resume, body_groups, format, index)
     print("\n\n\t Body Feature + URL extraction completed. Beginning Header feature extraction\n")
-    header_features_fname = header_wrapper(parsed_fname, change_filename(parsed_fname, "json", "header_features"), debug)
+    header_features_fname = header_wrapper(parsed_fname, change_filename(parsed_fname, ext, "header_features", format == "jsonl"), debug, resume, header_groups, format, index)
 
     print(f"Parsed Filename: {os.path.basename(parsed_fname)}")
     print(f"Body Features Filename: {os.path.basename(body_features_fname)}")
     print(f"URL Features Filename: {os.path.basename(url_fname)}")
     print(f"Header Features Filename {os.path.basename(header_features_fname)}")
 
+def _fused_worker(job, hash_sources = False, body_groups = None, header_groups = None, **parse_options):
+    og_fname, _, entry = job
+    try:
+        with open_job(job, hash_sources) as raw:
+            out_dict, msg = parse_eml_message(raw, og_fname, **parse_options)
+        body_features, urls = get_body_features(out_dict["body"], og_fname, body_groups)
+        header_features = get_features_from_msg(headers_from_message(msg), og_fname, header_groups)
+    except Exception as e:
+        print(f"Error processing {og_fname}: {e}")
+        raise e
+    return entry, out_dict, body_features, urls, header_features
+
+
+def fused_process(infile, outfile, debug, sample, workers = 1, ordered = False, attachment_store = None, resume = False, manifest_hash = False, joined = False, max_message_bytes = None, max_attachment_bytes = None, body_groups = None, header_groups = None, format = "jsonl", index = False, exts = None):
+    """
+    Single pass version of fully_process.
+    Reasoning: fully_process writes the parsed file, then reads it back once for body features
+    and once more for header features, which also re-parses every raw_headers string. Here each
+    email is parsed once and both feature sets come from the in-memory parse, inside the same
+    worker process, so the pipeline costs one parse and one write per email.
+    Writes the parsed, body feature, URL and header feature files fully_process would, or with
+    joined=True a single file with one flat feature record per email.
+    """
+    ext = OUTPUT_FORMATS[format]
+    index_keys = INDEX_KEYS if index else None
+    body_fields = BODY_FEATURES.schema(body_groups)
+    header_fields = HEADER_FEATURES.schema(header_groups)
+    if not outfile:
+        outfile = change_filename(infile[0], ext, "joined" if joined else "parsed")
+    if joined:
+        out_fnames = [outfile]
+        fields = [("email_id", str), ("og_fname", str)] + body_fields + header_fields + [("URLs", [str])]
+    else:
+        body_features_fname = change_filename(outfile, ext, "body_features", format == "jsonl")
+        url_fname = change_filename(body_features_fname, "txt", "URLs", True)
+        header_features_fname = change_filename(outfile, ext, "header_features", format == "jsonl")
+        fields = PARSED_FIELDS
+        out_fnames = [outfile, body_features_fname, url_fname, header_features_fname]
+    if os.path.exists(outfile) and not resume:
+        if input(f"please enter anything if you want to first delete the existing output files {out_fnames}: \n"):
+            remove_output(outfile)
+            for fname in out_fnames[1:]:
+                if os.path.exists(fname):
+                    os.remove(fname)
+    if resume:
+        for fname in out_fnames:
+            truncate_partial_line(fname)
+
+    sources = get_sources(infile, sample, exts)
+    skipped = [0]
+    t1 = time.time()
+    with Manifest(get_manifest_fname(outfile), manifest_hash) as manifest:
+        # the feature writers never flush on their own, only in flush_all with the parsed file and the manifest, so a
+        # crash can not leave feature lines of emails the manifest does not have (written again by --resume), or the reverse
+        flushed_by_manifest = {"buffer_size": None, "flush_interval": None}
+        feature_writers = [] if joined else [open_writer(body_features_fname, format, [("email_id", str)] + body_fields, "a", index_keys=index_keys, **flushed_by_manifest), JsonlWriter(url_fname, **flushed_by_manifest),
+                                             open_writer(header_features_fname, format, [("email_id", str)] + header_fields, "a", index_keys=index_keys, **flushed_by_manifest)]
+
+        def flush_all():
+            # feature files first, the manifest last, so a source is only marked done once every output has it
+            for fw in feature_writers:
+                fw.flush()
+            manifest.flush()
+
+        try:
+            # row groups of the parsed file hold whole emails, the joined file only has features
+            with open_writer(outfile, format, fields, "a", flush_all, ROW_GROUP_SIZE if joined else PARSED_ROW_GROUP_SIZE, index_keys) as writer:
+                jobs = iter_jobs(sources, manifest, resume, skipped)
+                results = iter_parsed(jobs, workers, ordered, hash_sources=manifest_hash, worker=_fused_worker, body_groups=body_groups, header_groups=header_groups, attachment_store=attachment_store, max_message_bytes=max_message_bytes, max_attachment_bytes=max_attachment_bytes)
+                for i, (entry, out_dict, body_features, urls, header_features) in enumerate(results):
+                    # recorded before the writes, a write can flush every output and the manifest with it
+                    manifest.record(entry)
+                    if joined:
+                        record = {"email_id": out_dict["email_id"], "og_fname": out_dict["og_fname"]}
+                        record.update(body_features)
+                        record.update(header_features)
+                        record["URLs"] = urls
+                        writer.write(record)
+                    else:
+                        body_w, url_w, header_w = feature_writers
+                        # feature lines carry the email_id like those of the separate stages
+                        key = {"email_id": out_dict["email_id"]}
+                        body_w.write({**key, **body_features}, out_dict)
+                        for url in urls:
+                            url_w.write_line(url.strip())
+                        header_w.write({**key, **header_features}, out_dict)
+                        writer.write(out_dict)
+                    if i % 1000 == 0 and i != 0:
+                        t2 = time.time()
+                        print(f"{i} EML files processed at {str(i / (t2-t1))[:8]} per second")
+                    if debug:
+                        print(f"Headers: {out_dict["header_list"]}")
+                        print(f"\nBody Text: \n{out_dict["body"][:500]}")
+        finally:
+            for fw in feature_writers:
+                fw.close()
+    if resume:
+        print(f"{skipped[0]} already parsed files skipped")
+
+    for fname in out_fnames:
+        print(f"Output Filename: {os.path.basename(fname)}")
+    return out_fnames
+
 if __name__ == '__main__':
     args = parser.parse_args()
     infile = args.input
     outfile = args.output
     debug = args.debug
     sample = args.sample
-    fully_process(infile, outfile, debug, sample)
\ No newline at end of file
+    workers = args.workers
+    ordered = args.ordered
+    attachment_store = args.attachment_store
+    resume = args.resume
+    manifest_hash = args.manifest_hash
+    max_message_bytes = args.max_message_bytes
+    max_attachment_bytes = args.max_attachment_bytes
+    format = args.format
+    if resume and format == "parquet":
+        parser.error("--resume needs --format jsonl, a parquet file can not be appended to")
+    if args.index and format == "parquet":
+        parser.error("--index needs --format jsonl, a parquet row has no byte offset")
+    if outfile and is_compressed(outfile) and (resume or args.index):
+        parser.error("--resume and --index need an uncompressed output, a compressed file can not be appended to in place or read at an offset")
+    try:
+        # one --features list for both stages, each gets the groups it has
+        body_groups, header_groups = select_groups([BODY_FEATURES, HEADER_FEATURES], args.features, args.max_cost)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.fused or args.joined:
+        fused_process(infile, outfile, debug, sample, workers, ordered, attachment_store, resume, manifest_hash, args.joined, max_message_bytes, max_attachment_bytes, body_groups, header_groups, format, args.index, args.extensions)
+    else:
+        fully_process(infile, outfile, debug, sample, workers, ordered, attachment_store, resume, manifest_hash, max_message_bytes, max_attachment_bytes, body_groups, header_groups, format, args.index, args.extensions)
\ No newline at end of file